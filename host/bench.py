@@ -0,0 +1,99 @@
+# Micro-benchmarks of the hot paths (see bench_cases.py) under CPython and,
+# when found, the MicroPython unix port (`micropython` on PATH or the
+# MICROPYTHON environment variable). Results are compared with the stored
+# baseline; --save rewrites it, so regressions show up as a diff of
+# bench_baseline.json.
+# usage: python3 host/bench.py [-n calls] [--save] [--check] [--tol 0.25]
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+HOST_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(HOST_DIR, '..', 'src')
+BASELINE = os.path.join(HOST_DIR, 'bench_baseline.json')
+
+def run_cpython(n):
+	import bench_cases
+	return bench_cases.run(n)
+
+def find_micropython():
+	exe = os.environ.get('MICROPYTHON')
+	if exe:
+		return exe
+	return shutil.which('micropython')
+
+def run_micropython(exe, n):
+	env = dict(os.environ)
+	env['MICROPYPATH'] = os.pathsep.join([SRC_DIR, HOST_DIR])
+	cmd = [exe, '-X', 'heapsize=4M', os.path.join(HOST_DIR, 'bench_cases.py'), '--json', '-n' + str(n)]
+	out = subprocess.run(cmd, env=env, stdout=subprocess.PIPE, check=True).stdout.decode()
+	return json.loads(out.strip().splitlines()[-1])['cases']
+
+def _rounded(res):
+	out = dict()
+	for name, r in res.items():
+		out[name] = dict({'us': round(r['us'], 2), 'alloc_b': round(r['alloc_b'], 1), \
+			'per_s': int(r['per_s'])})
+	return out
+
+# A case regresses when it got slower than tol, or allocates noticeably
+# more (CPython's traced peaks move by a few bytes between runs).
+def compare(res, base, tol):
+	lines = []
+	regressions = 0
+	for name in sorted(res):
+		r = res[name]
+		b = base.get(name)
+		if b is None:
+			lines.append("{:22s} {:9.2f} us {:8.1f} B {:9d}/s  (new)".format(name, r['us'], \
+				r['alloc_b'], r['per_s']))
+			continue
+		d = (r['us'] - b['us']) / b['us'] if b['us'] > 0 else 0.0
+		flag = ''
+		if d > tol or r['alloc_b'] > 1.1 * b['alloc_b'] + 8.0:
+			flag = '  REGRESSION'
+			regressions += 1
+		lines.append("{:22s} {:9.2f} us {:8.1f} B {:9d}/s  {:+6.1f}% {:+8.1f} B{}".format(name, \
+			r['us'], r['alloc_b'], r['per_s'], 100.0 * d, r['alloc_b'] - b['alloc_b'], flag))
+	return lines, regressions
+
+def main(argv):
+	ap = argparse.ArgumentParser(description="hot path micro-benchmarks")
+	ap.add_argument('-n', type=int, default=2000, help="calls per case")
+	ap.add_argument('--save', action='store_true', help="store the results as the new baseline")
+	ap.add_argument('--check', action='store_true', help="exit with 1 on regressions")
+	ap.add_argument('--tol', type=float, default=0.25, help="allowed slowdown (fraction)")
+	args = ap.parse_args(argv[1:])
+	results = dict({'cpython': _rounded(run_cpython(args.n))})
+	exe = find_micropython()
+	if exe:
+		results['micropython'] = _rounded(run_micropython(exe, args.n))
+	else:
+		print("micropython unix port not found: CPython only")
+	base = dict()
+	if os.path.exists(BASELINE):
+		with open(BASELINE) as f:
+			base = json.load(f)
+	total = 0
+	for impl in sorted(results):
+		print("== {}".format(impl))
+		lines, reg = compare(results[impl], base.get(impl, dict()), args.tol)
+		total += reg
+		for l in lines:
+			print(l)
+	if args.save:
+		base.update(results)
+		with open(BASELINE, 'w') as f:
+			json.dump(base, f, indent=1, sort_keys=True)
+			f.write('\n')
+		print("baseline saved to {}".format(BASELINE))
+	if args.check and total:
+		return 1
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv))
@@ -0,0 +1,69 @@
+# Latency vs throughput of the IMU batching (src/txbatch.py) on the host
+# simulation: the IMU timer runs for a while with every batch size, and
+# for each one the cost per sample, the Uarduino writes and bytes per
+# second and the latency the batching adds are printed. k=1 is the plain
+# one-message-per-sample output; in text mode fewer lines than k may fit a
+# batch (`per batch` is the actual mean).
+# `dropped` counts bytes the Uarduino queue had to drop: the link (and its
+# chunk pacing) could not keep up.
+# usage: python3 host/bench_batch.py [sampling_ms] [seconds] [text|bin]
+
+import contextlib
+import io
+import sys
+
+import vsim
+
+BATCH_SIZES = (1, 2, 4, 8)
+WAIT_MS = 1000 # long enough not to cut the batches short
+
+def run(k, sampling_ms=20, seconds=10.0, binary=True):
+	sim = vsim.Sim(trace_alloc=False)
+	sim.attach_i2c(1, vsim.Mpu6050())
+	sim.install()
+	import uarduino
+	import i2ch
+	import txbatch
+	from vsproto import OUT_MODE_BIN, OUT_MODE_TEXT
+	a = uarduino.Uarduino()
+	i = i2ch.I2cAcc(uardu=a, zero_alloc=True, dt_sampling_ms=sampling_ms, \
+		out_mode=OUT_MODE_BIN if binary else OUT_MODE_TEXT)
+	if k > 1:
+		i.batch = txbatch.ImuBatch(a, k, WAIT_MS)
+	with contextlib.redirect_stdout(io.StringIO()):
+		i.power_on()
+		i.set_default_range()
+		i.start()
+		sim.advance(seconds)
+		i.pause()
+		a.flush()
+	cb = sim.stats['I2cAcc._timed_cb'].as_dict()
+	queued, sent, dropped = a.stats()
+	r = dict({'k': k, 'per_batch': 1.0, 'samples': cb['calls'], 'cb_us': cb['mean_us'], \
+		'writes_s': a.writes / seconds, 'bytes_s': sent / seconds, 'dropped': dropped, \
+		'lat_mean_ms': 0.0, 'lat_max_ms': 0})
+	if not (i.batch is None):
+		s = i.batch.stats()
+		r['k'] = s['k']
+		r['per_batch'] = s['samples'] / max(1, s['batches'])
+		r['lat_mean_ms'] = s['lat_mean_ms']
+		r['lat_max_ms'] = s['lat_max_ms']
+	# time on the wire of one message, at the Uarduino baud rate
+	r['wire_ms'] = 10000.0 * sent / max(1, a.writes) / a.baudrate
+	return r
+
+def main(argv):
+	sampling_ms = int(argv[1]) if len(argv) > 1 else 20
+	seconds = float(argv[2]) if len(argv) > 2 else 10.0
+	binary = not (len(argv) > 3 and argv[3] == 'text')
+	print("IMU every {} ms, {} output, {:.0f} s".format(sampling_ms, 'binary' if binary else 'text', seconds))
+	print("{:>3s} {:>9s} {:>8s} {:>9s} {:>9s} {:>9s} {:>8s} {:>10s} {:>9s} {:>8s}".format('k', \
+		'per batch', 'samples', 'cb us', 'writes/s', 'bytes/s', 'dropped', 'lat mean', 'lat max', 'wire ms'))
+	for k in BATCH_SIZES:
+		r = run(k, sampling_ms, seconds, binary)
+		print("{k:3d} {per_batch:9.1f} {samples:8d} {cb_us:9.1f} {writes_s:9.1f} {bytes_s:9.0f} {dropped:8d} " \
+			"{lat_mean_ms:10.1f} {lat_max_ms:9d} {wire_ms:8.1f}".format(**r))
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv))
@@ -0,0 +1,255 @@
+# Benchmark cases for the sampling, parsing and transmit hot paths.
+# Runs under CPython (through bench.py) and under the MicroPython unix
+# port, so it sticks to what both support. The hardware is replaced by
+# the minimal stubs below rather than by host/vsim, so that the numbers
+# are the firmware's own cost and not the fakes'.
+# usage: micropython host/bench_cases.py [--json]   (MICROPYPATH=src:host)
+
+import gc
+import sys
+
+_MPY = sys.implementation.name == 'micropython'
+
+if not _MPY:
+	import tracemalloc
+	import upyshim
+	upyshim.install()
+
+import utime
+
+# --- hardware stubs (registered as the `machine` module) ---
+class _Pin:
+	IN = 1
+	OUT = 3
+	PULL_UP = 2
+
+	def __init__(self, *args, **kw):
+		self.v = 0
+
+	def init(self, *args, **kw):
+		pass
+
+	def value(self, v=None):
+		if v is None:
+			return self.v
+		self.v = v
+
+# one MPU6050 sample (ax ay az temp rx ry rz, big endian), ~1 g on z
+_IMU_SAMPLE = b'\x00\xaf\xff\x10\x10\x00\xf0\xb0\x00\x12\xff\xee\x00\x05'
+
+class _I2C:
+	def __init__(self, *args, **kw):
+		pass
+
+	def writeto_mem(self, addr, reg, buf):
+		pass
+
+	def readfrom_mem_into(self, addr, reg, buf):
+		n = len(buf)
+		if n == 14:
+			buf[0:14] = _IMU_SAMPLE
+		else:
+			for i in range(n):
+				buf[i] = 0
+
+# Serves `epoch` once per refill(); writes are swallowed.
+class _UART:
+	def __init__(self, *args, **kw):
+		self.epoch = b''
+		self.pos = 0
+
+	def init(self, *args, **kw):
+		pass
+
+	def deinit(self):
+		pass
+
+	def refill(self):
+		self.pos = 0
+
+	def any(self):
+		return len(self.epoch) - self.pos
+
+	def readinto(self, buf, n=-1):
+		left = len(self.epoch) - self.pos
+		if left <= 0:
+			return None
+		n = len(buf) if n < 0 else n
+		if n > left:
+			n = left
+		buf[0:n] = self.epoch[self.pos:self.pos + n]
+		self.pos += n
+		return n
+
+	def write(self, buf):
+		return len(buf)
+
+class _Timer:
+	def __init__(self, *args, **kw):
+		pass
+
+	def init(self, *args, **kw):
+		pass
+
+	def deinit(self):
+		pass
+
+class _machine:
+	Pin = _Pin
+	I2C = _I2C
+	UART = _UART
+	Timer = _Timer
+
+	@staticmethod
+	def sleep(ms):
+		pass
+
+sys.modules['machine'] = _machine
+
+import uarduino
+import i2ch
+import gpsh
+import imudsp
+import txpolicy
+from nmea import NmeaParser
+from vsproto import OUT_MODE_BIN, PROTO_MSG_GPS
+
+# chunk pacing is real time: without the gap every call drains its own
+# bytes, i.e. the steady state of the device
+uarduino.UARDUINO_CHUNK_GAP_MS = 0
+
+NMEA_RMC = "$GPRMC,120001.40,A,4504.20774,N,00740.80078,E,20.000,98.40,181026,,,A*64"
+NMEA_GGA = "$GPGGA,120001.40,4504.20774,N,00740.80078,E,1,09,0.92,240.3,M,48.0,M,,*56"
+NMEA_EPOCH = (NMEA_RMC + "\r\n" + NMEA_GGA + "\r\n").encode()
+
+IMU_DEADLINE_US = 20000
+
+def _imu(zero_alloc=False, out_mode=0):
+	a = uarduino.Uarduino()
+	i = i2ch.I2cAcc(uardu=a, zero_alloc=zero_alloc, out_mode=out_mode)
+	i.power_on()
+	return i
+
+def _gps():
+	a = uarduino.Uarduino()
+	g = gpsh.UartGps(uardu=a)
+	g.uart.epoch = NMEA_EPOCH
+	g.uart_initialized = True
+	return g
+
+def cases():
+	out = []
+	i = _imu()
+	out.append(('imu_timed_cb', lambda: i._timed_cb(None)))
+	iz = _imu(True)
+	out.append(('imu_timed_cb_za', lambda: iz._timed_cb(None)))
+	ib = _imu(True, OUT_MODE_BIN)
+	out.append(('imu_timed_cb_bin', lambda: ib._timed_cb(None)))
+	# FIR + decimation by 5 + attitude: the mean per input sample
+	idsp = _imu(True, OUT_MODE_BIN)
+	idsp.dt_sampling_ms = 10
+	idsp.dsp = imudsp.ImuDsp(decim=5, lpf=imudsp.DSP_LPF_FIR, fusion=True)
+	idsp.configure()
+	out.append(('imu_timed_cb_dsp', lambda: idsp._timed_cb(None)))
+	ip = _imu()
+	ip.sample_all()
+	out.append(('imu_print_on_repl', ip._print_on_repl))
+	g = _gps()
+	def gps_cb():
+		g.uart.refill()
+		g._timed_cb(None)
+	out.append(('gps_timed_cb', gps_cb))
+	# same epoch every time: a stationary receiver, suppressed by the deadband
+	gt = _gps()
+	gt.txpolicy = txpolicy.TxPolicy(PROTO_MSG_GPS, gt.uardu, (0, 0, 0, 20, 20, 20, 5, 100, 10, 0))
+	def gps_cb_txp():
+		gt.uart.refill()
+		gt._timed_cb(None)
+	out.append(('gps_timed_cb_txp', gps_cb_txp))
+	gp = _gps()
+	gp.uart.refill()
+	gp._read_and_parse()
+	out.append(('gps_print_on_repl', gp._print_on_repl))
+	pd = gpsh.GPS_POS_DICT.copy()
+	out.append(('parse_nmea_rmc', lambda: gpsh.parse_nmea_sentence(NMEA_RMC, pd)))
+	out.append(('parse_nmea_gga', lambda: gpsh.parse_nmea_sentence(NMEA_GGA, pd)))
+	p = NmeaParser(gpsh.GpsRecord())
+	eb = bytearray(NMEA_EPOCH)
+	out.append(('nmea_feed_epoch', lambda: p.feed(eb)))
+	a = uarduino.Uarduino()
+	line = "1550.0\tACC\t-0.9026,0.0287,11.4100,0.0548,0.0404,0.0110"
+	out.append(('uarduino_send_str', lambda: a.send_str(line)))
+	return out
+
+def _null():
+	pass
+
+def _time_us(fn, n):
+	t0 = utime.ticks_us()
+	for k in range(n):
+		fn()
+	return utime.ticks_diff(utime.ticks_us(), t0)
+
+# bytes allocated per call: the heap growth with the GC off on MicroPython,
+# the mean traced peak of single calls on CPython
+def _alloc_per_call(fn, n):
+	gc.collect()
+	if _MPY:
+		gc.disable()
+		a0 = gc.mem_alloc()
+		for k in range(n):
+			fn()
+		a = gc.mem_alloc() - a0
+		gc.enable()
+		return a / n
+	started = not tracemalloc.is_tracing()
+	if started:
+		tracemalloc.start()
+	total = 0
+	for k in range(n):
+		tracemalloc.reset_peak()
+		m0 = tracemalloc.get_traced_memory()[0]
+		fn()
+		total += tracemalloc.get_traced_memory()[1] - m0
+	if started:
+		tracemalloc.stop()
+	return total / n
+
+# Returns {case: {'us': per call, 'alloc_b': per call, 'per_s': calls/s}}.
+# Timing runs with the GC enabled, so collections are part of the cost;
+# the best of `repeat` runs is kept to filter out scheduling noise.
+def run(n=2000, n_alloc=50, only=None, repeat=5):
+	res = dict()
+	t_null = min([_time_us(_null, n) for k in range(repeat)])
+	for name, fn in cases():
+		if only and name not in only:
+			continue
+		for k in range(10):
+			fn()
+		gc.collect()
+		us = (min([_time_us(fn, n) for k in range(repeat)]) - t_null) / n
+		if us <= 0:
+			us = 0.001
+		res[name] = dict({'us': us, 'alloc_b': _alloc_per_call(fn, n_alloc), 'per_s': 1e6 / us})
+	return res
+
+def impl_name():
+	return sys.implementation.name
+
+def main(argv):
+	n = 2000
+	for a in argv[1:]:
+		if a.startswith('-n'):
+			n = int(a[2:])
+	res = run(n)
+	if '--json' in argv:
+		import json
+		print(json.dumps(dict({'impl': impl_name(), 'cases': res})))
+		return 0
+	for name in sorted(res):
+		r = res[name]
+		print("{:22s} {:10.1f} us {:8.0f} B {:10.0f}/s".format(name, r['us'], r['alloc_b'], r['per_s']))
+	return 0
+
+if __name__ == '__main__':
+	main(sys.argv)
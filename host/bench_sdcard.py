@@ -0,0 +1,79 @@
+# Block throughput of src/sdcard.py against the file-backed fake card:
+# single and multi-block reads and writes, reported as blocks/s of bus
+# time at the given SPI clock, together with the SPI calls per block
+# (the per-call overhead is what dominates on the ESP32).
+# usage: python3 host/bench_sdcard.py [n_blocks] [multi_blocks] [spi_hz]
+
+import os
+import sys
+import tempfile
+import time
+
+import upyshim
+upyshim.install()
+
+from fakesd import FakeSdSpi, FakeCsPin
+import sdcard
+
+SECTOR = 512
+
+def _measure(spi, fn, n_blocks):
+	c0 = spi.bytes_clocked
+	k0 = spi.calls
+	b0 = spi.bus_seconds()
+	t0 = time.perf_counter()
+	fn()
+	t1 = time.perf_counter()
+	bus = spi.bus_seconds() - b0
+	return dict({'blocks': n_blocks, 'bus_s': bus, 'host_s': t1 - t0, \
+		'blocks_per_s': n_blocks / bus if bus > 0 else 0.0, \
+		'bytes_per_block': (spi.bytes_clocked - c0) / float(n_blocks), \
+		'calls_per_block': (spi.calls - k0) / float(n_blocks)})
+
+def run(n_blocks=256, multi=8, spi_hz=10000000):
+	path = os.path.join(tempfile.mkdtemp(), 'card.img')
+	spi = FakeSdSpi(path, sectors=max(4096, 2 * n_blocks))
+	sd = sdcard.SDCard(spi, FakeCsPin(), baudrate=spi_hz)
+	buf1 = bytearray(SECTOR)
+	bufm = bytearray(SECTOR * multi)
+	for i in range(len(bufm)):
+		bufm[i] = (i * 7) & 0xFF
+	n_multi = n_blocks // multi
+	def write_single():
+		for b in range(n_blocks):
+			sd.writeblocks(b, bufm[0:SECTOR])
+	def write_multi():
+		for b in range(n_multi):
+			sd.writeblocks(b * multi, bufm)
+	def read_single():
+		for b in range(n_blocks):
+			sd.readblocks(b, buf1)
+	def read_multi():
+		for b in range(n_multi):
+			sd.readblocks(b * multi, bufm)
+	out = dict()
+	out['write_single'] = _measure(spi, write_single, n_blocks)
+	out['write_multi'] = _measure(spi, write_multi, n_multi * multi)
+	out['read_single'] = _measure(spi, read_single, n_blocks)
+	out['read_multi'] = _measure(spi, read_multi, n_multi * multi)
+	# the last multi-block read must give back what was written
+	out['verify'] = bytes(bufm) == bytes(bytearray((i * 7) & 0xFF for i in range(len(bufm))))
+	spi.close()
+	os.remove(path)
+	return out
+
+def main(argv):
+	n = int(argv[1]) if len(argv) > 1 else 256
+	multi = int(argv[2]) if len(argv) > 2 else 8
+	spi_hz = int(argv[3]) if len(argv) > 3 else 10000000
+	r = run(n, multi, spi_hz)
+	print("{:14s} {:>8s} {:>12s} {:>12s} {:>12s}".format('', 'blocks', 'blocks/s', 'bytes/block', 'calls/block'))
+	for k in ('read_single', 'read_multi', 'write_single', 'write_multi'):
+		m = r[k]
+		print("{:14s} {:8d} {:12.0f} {:12.1f} {:12.1f}".format(k, m['blocks'], m['blocks_per_s'], \
+			m['bytes_per_block'], m['calls_per_block']))
+	print("verify: {}".format('ok' if r['verify'] else 'FAILED'))
+	return 0 if r['verify'] else 1
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv))
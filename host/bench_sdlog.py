@@ -0,0 +1,69 @@
+# Throughput of the SD logging pipeline (src/sdlog.py + src/sdcard.py)
+# against the file-backed fake card.
+# usage: python3 host/bench_sdlog.py [n_frames] [burst_sectors] [spi_hz]
+
+import os
+import sys
+import tempfile
+import time
+
+import upyshim
+upyshim.install()
+
+from fakesd import FakeSdSpi, FakeCsPin
+import sdcard
+import sdlog
+from vsproto import FrameEncoder, FrameDecoder, PROTO_MSG_IMU
+
+def run(n_frames=20000, burst=sdlog.SDLOG_BURST_SECTORS, spi_hz=1320000):
+	path = os.path.join(tempfile.mkdtemp(), 'card.img')
+	spi = FakeSdSpi(path, sectors=65536)
+	sd = sdcard.SDCard(spi, FakeCsPin())
+	spi.init(baudrate=spi_hz)
+	lg = sdlog.SdLogger(sd, 0, burst=burst)
+	enc = FrameEncoder(PROTO_MSG_IMU)
+	lg.start()
+	clocked0 = spi.bytes_clocked
+	t_log = 0.0
+	t_write = 0.0
+	for k in range(n_frames):
+		f = enc.encode(k, k & 0x7FFF, -k & 0x7FFF, 4096, 1, 2, 3)
+		t0 = time.perf_counter()
+		lg.log(f)
+		t1 = time.perf_counter()
+		lg.service()
+		t2 = time.perf_counter()
+		t_log += t1 - t0
+		t_write += t2 - t1
+	lg.stop()
+	bus_bytes = spi.bytes_clocked - clocked0
+	# read everything back and check the frames
+	spi.f.flush()
+	with open(path, 'rb') as f:
+		f.seek(sdlog.SDLOG_SECTOR)
+		data = f.read((lg.sectors_written - 1) * sdlog.SDLOG_SECTOR)
+	dec = FrameDecoder()
+	n_imu = sum(1 for m in dec.feed(data) if m[0] == PROTO_MSG_IMU)
+	spi.close()
+	os.remove(path)
+	return dict({'frames': n_frames, 'decoded': n_imu, 'dropped': lg.frames_dropped, \
+		'sectors': lg.sectors_written, 'bursts': lg.bursts, \
+		'log_us_per_frame': 1e6 * t_log / n_frames, \
+		'host_write_s': t_write, \
+		'bus_s': bus_bytes * 8.0 / spi_hz, \
+		'bus_frames_per_s': n_frames / (bus_bytes * 8.0 / spi_hz)})
+
+def main(argv):
+	n = int(argv[1]) if len(argv) > 1 else 20000
+	burst = int(argv[2]) if len(argv) > 2 else sdlog.SDLOG_BURST_SECTORS
+	spi_hz = int(argv[3]) if len(argv) > 3 else 1320000
+	r = run(n, burst, spi_hz)
+	for k in ('frames', 'decoded', 'dropped', 'sectors', 'bursts'):
+		print("{:20s} {:d}".format(k, r[k]))
+	print("{:20s} {:.2f}".format('log us/frame (host)', r['log_us_per_frame']))
+	print("{:20s} {:.3f}".format('bus time [s]', r['bus_s']))
+	print("{:20s} {:.0f}".format('frames/s (bus)', r['bus_frames_per_s']))
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv))
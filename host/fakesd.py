@@ -0,0 +1,226 @@
+# File-backed fake SD card speaking the SPI-mode protocol, to run
+# src/sdcard.py (and whatever sits on top of it) on the host.
+# It is passed to SDCard as the SPI bus; FakeCsPin is the chip select.
+# Every clocked byte is accounted for, so bus time at a given SPI clock
+# can be estimated with bus_seconds(); `calls` counts the SPI transfers,
+# which dominate on the device when polling byte by byte.
+
+import os
+
+SECTOR = 512
+
+_IDLE = 0
+_MULTI_READ = 1
+_WAIT_TOKEN = 2
+_WAIT_TOKEN_MULTI = 3
+_RECV_DATA = 4
+
+_TOKEN_DATA = 0xFE
+_TOKEN_CMD25 = 0xFC
+_TOKEN_STOP_TRAN = 0xFD
+
+class FakeCsPin:
+	OUT = 1
+	IN = 0
+
+	def __init__(self):
+		self.v = 1
+
+	def init(self, mode=None, value=None):
+		if value is not None:
+			self.v = value
+
+	def value(self, v=None):
+		if v is None:
+			return self.v
+		self.v = v
+
+	def __call__(self, v=None):
+		return self.value(v)
+
+class FakeSdSpi:
+	def __init__(self, path, sectors=65536, busy_bytes=16, read_latency=8):
+		self.path = path
+		self.sectors = sectors
+		self.busy_bytes = busy_bytes
+		self.read_latency = read_latency
+		mode = 'r+b' if os.path.exists(path) else 'w+b'
+		self.f = open(path, mode)
+		self.f.seek(0, 2)
+		if self.f.tell() < sectors * SECTOR:
+			self.f.truncate(sectors * SECTOR)
+		self.baudrate = 0
+		self.out = bytearray()
+		self.opos = 0
+		self.state = _IDLE
+		self.cmd = bytearray()
+		self.app_cmd = False
+		self.initialized = False
+		self.block = 0
+		self.rx = bytearray()
+		self.after_data = _IDLE
+		self.bytes_clocked = 0
+		self.bus_seconds_total = 0.0
+		self.commands = 0
+		self.blocks_read = 0
+		self.blocks_written = 0
+		self.calls = 0 # SPI method calls made by the driver
+		pass
+
+	def close(self):
+		self.f.close()
+
+	# --- machine.SPI interface ---
+	def init(self, baudrate=1000000, **kw):
+		self.baudrate = baudrate
+
+	def write(self, buf):
+		self.calls += 1
+		for b in buf:
+			self._xfer(b)
+
+	def readinto(self, buf, write=0x00):
+		self.calls += 1
+		for i in range(len(buf)):
+			buf[i] = self._xfer(write)
+
+	def read(self, n, write=0x00):
+		self.calls += 1
+		return bytes([self._xfer(write) for i in range(n)])
+
+	def write_readinto(self, wbuf, rbuf):
+		self.calls += 1
+		for i in range(len(wbuf)):
+			rbuf[i] = self._xfer(wbuf[i])
+
+	def bus_seconds(self):
+		return self.bus_seconds_total
+
+	# --- card side ---
+	def _queue(self, data):
+		if self.opos >= len(self.out):
+			self.out = bytearray()
+			self.opos = 0
+		self.out.extend(data)
+
+	def _read_sector(self, n):
+		self.f.seek(n * SECTOR)
+		data = self.f.read(SECTOR)
+		self.blocks_read += 1
+		return data
+
+	def _queue_block(self):
+		self._queue(b'\xff' * self.read_latency + bytes([_TOKEN_DATA]))
+		self._queue(self._read_sector(self.block))
+		self._queue(b'\xff\xff')
+		self.block += 1
+
+	def _xfer(self, b):
+		self.bytes_clocked += 1
+		if self.baudrate:
+			self.bus_seconds_total += 8.0 / self.baudrate
+		if self.opos < len(self.out):
+			out = self.out[self.opos]
+			self.opos += 1
+		elif self.state == _MULTI_READ:
+			self._queue_block()
+			out = self.out[self.opos]
+			self.opos += 1
+		else:
+			out = 0xFF
+		self._in(b)
+		return out
+
+	def _in(self, b):
+		st = self.state
+		if st == _RECV_DATA:
+			self.rx.append(b)
+			if len(self.rx) == SECTOR + 2:
+				self.f.seek(self.block * SECTOR)
+				self.f.write(self.rx[0:SECTOR])
+				self.blocks_written += 1
+				self.block += 1
+				self._queue(b'\x05' + b'\x00' * self.busy_bytes)
+				self.state = self.after_data
+			return
+		if st == _WAIT_TOKEN:
+			if b == _TOKEN_DATA:
+				self.rx = bytearray()
+				self.after_data = _IDLE
+				self.state = _RECV_DATA
+			return
+		if st == _WAIT_TOKEN_MULTI:
+			if b == _TOKEN_CMD25:
+				self.rx = bytearray()
+				self.after_data = _WAIT_TOKEN_MULTI
+				self.state = _RECV_DATA
+			elif b == _TOKEN_STOP_TRAN:
+				self._queue(b'\xff' + b'\x00' * self.busy_bytes)
+				self.state = _IDLE
+			return
+		if len(self.cmd) > 0:
+			self.cmd.append(b)
+			if len(self.cmd) == 6:
+				self._command()
+				self.cmd = bytearray()
+		elif (b & 0xC0) == 0x40:
+			self.cmd.append(b)
+
+	def _command(self):
+		c = self.cmd
+		idx = c[0] & 0x3F
+		arg = (c[1] << 24) | (c[2] << 16) | (c[3] << 8) | c[4]
+		self.commands += 1
+		app = self.app_cmd
+		self.app_cmd = False
+		r1 = 0x00 if self.initialized else 0x01
+		if idx == 12:
+			# stop transmission: drop whatever was being streamed
+			self.state = _IDLE
+			self.out = bytearray()
+			self.opos = 0
+			self._queue(b'\xff\x00')
+			return
+		if idx == 0:
+			self.initialized = False
+			self.state = _IDLE
+			self._queue(b'\xff\x01')
+		elif idx == 8:
+			self._queue(bytes([0xFF, r1, 0x00, 0x00, 0x01, 0xAA]))
+		elif idx == 58:
+			self._queue(bytes([0xFF, r1, 0xC0, 0xFF, 0x80, 0x00]))
+		elif idx == 55:
+			self.app_cmd = True
+			self._queue(bytes([0xFF, r1]))
+		elif idx == 41 and app:
+			self.initialized = True
+			self._queue(b'\xff\x00')
+		elif idx == 9:
+			csd = bytearray(16)
+			csd[0] = 0x40 # CSD version 2.0
+			c_size = self.sectors // 1024 - 1
+			csd[8] = (c_size >> 8) & 0xFF
+			csd[9] = c_size & 0xFF
+			self._queue(b'\xff\x00' + b'\xff' * self.read_latency + bytes([_TOKEN_DATA]))
+			self._queue(csd + b'\xff\xff')
+		elif idx == 16:
+			self._queue(b'\xff\x00')
+		elif idx == 17:
+			self.block = arg
+			self._queue(b'\xff\x00')
+			self._queue_block()
+		elif idx == 18:
+			self.block = arg
+			self._queue(b'\xff\x00')
+			self.state = _MULTI_READ
+		elif idx == 24:
+			self.block = arg
+			self._queue(b'\xff\x00')
+			self.state = _WAIT_TOKEN
+		elif idx == 25:
+			self.block = arg
+			self._queue(b'\xff\x00')
+			self.state = _WAIT_TOKEN_MULTI
+		else:
+			self._queue(bytes([0xFF, r1 | 0x04])) # illegal command
+		pass
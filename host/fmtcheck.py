@@ -0,0 +1,97 @@
+# Compares the precompiled text lines (src/vsfmt.py) with the str.format
+# output they replace: every count of every IMU channel, and random GPS
+# records. Prints the mismatches per field, and how many of them are exact
+# rounding ties (the value sits halfway between two printed ones, so only
+# the float rounding decided the last digit).
+# usage: python3 host/fmtcheck.py [gps records]
+
+import random
+import sys
+from fractions import Fraction
+
+import vsim
+
+IMU_COUNT_RANGE = 1 << 16 # offsets removed: up to twice the int16 range
+
+def _tie(exact, prec):
+	r = exact * 10 ** prec * 2
+	return r.denominator == 1 and r.numerator % 2 == 1
+
+def _report(name, n, bad, ties):
+	print("{:10s} {:8d} values {:6d} different {:6d} on exact ties".format(name, n, bad, ties))
+	return bad - ties
+
+def check_imu(i2ch):
+	from vsfmt import LineFormat, VSFMT_SCALED
+	untied = 0
+	for name in i2ch.IMU_TEXT_FIELDS:
+		k = i2ch.MPU_CHANNELS.index(name)
+		num, den = i2ch.MPU_RATIOS[k]
+		f = LineFormat(b'ACC', [(VSFMT_SCALED, 0, (num, den), i2ch.IMU_TEXT_PREC)])
+		v = [0]
+		bad = 0
+		ties = 0
+		for x in range(-IMU_COUNT_RANGE, IMU_COUNT_RANGE + 1):
+			v[0] = x
+			s = f.text(f.render(0, v)).split('\t')[2]
+			if s != "{:.{}f}".format(x * i2ch.MPU_SCALES[k], i2ch.IMU_TEXT_PREC):
+				bad += 1
+				if _tie(Fraction(x * num, den), i2ch.IMU_TEXT_PREC):
+					ties += 1
+		untied += _report(name, 2 * IMU_COUNT_RANGE + 1, bad, ties)
+	return untied
+
+def check_gps(gpsh, n):
+	from gpsrec import GpsRecord, GPSR_T, GPSR_DATE, GPSR_TIME, GPSR_LAT, GPSR_LON, GPSR_ALT, \
+		GPSR_SPEED, GPSR_COURSE, GPSR_HDOP, GPSR_SATS
+	rnd = random.Random(0)
+	rec = GpsRecord()
+	v = rec.v
+	f = gpsh.UartGps(autostart=False).text_fmt
+	names = gpsh.GPS_TEXT_FIELDS
+	bad = [0] * len(names)
+	ties = [0] * len(names)
+	for k in range(n):
+		v[GPSR_T] = rnd.randrange(1 << 30)
+		v[GPSR_DATE] = rnd.randrange(1000000)
+		v[GPSR_TIME] = rnd.randrange(86400000)
+		v[GPSR_LAT] = rnd.randrange(-900000000, 900000001)
+		v[GPSR_LON] = rnd.randrange(-1800000000, 1800000001)
+		v[GPSR_ALT] = rnd.randrange(-50000, 900000)
+		v[GPSR_SPEED] = rnd.choice((-1000, rnd.randrange(200000)))
+		v[GPSR_COURSE] = rnd.choice((-100, rnd.randrange(36000)))
+		v[GPSR_HDOP] = rnd.randrange(10001)
+		v[GPSR_SATS] = rnd.randrange(-1, 40)
+		tm = v[GPSR_TIME]
+		ref = "{:.1f}\tGPS\t{:06d},{:02d}{:02d}{:02d}.{:02d},{:.6f},{:.6f},{:.2f},{:.2f},{:.2f},{:.2f},{:d}".format( \
+			v[GPSR_T], v[GPSR_DATE], tm // 3600000, (tm // 60000) % 60, (tm // 1000) % 60, \
+			(tm % 1000) // 10, v[GPSR_LAT] / 10000000, v[GPSR_LON] / 10000000, v[GPSR_ALT] / 100, \
+			v[GPSR_SPEED] / 1000, v[GPSR_COURSE] / 100, v[GPSR_HDOP] / 100, v[GPSR_SATS])
+		got = f.text(f.render(v[GPSR_T], v))
+		if got == ref:
+			continue
+		a = got.split('\t')[2].split(',')
+		b = ref.split('\t')[2].split(',')
+		for j in range(len(names)):
+			if a[j] != b[j]:
+				bad[j] += 1
+				kind, index, dec, prec = gpsh.GPS_TEXT_SPEC[names[j]]
+				if _tie(Fraction(v[index], 10 ** dec), prec):
+					ties[j] += 1
+	untied = 0
+	for j in range(len(names)):
+		untied += _report(names[j], n, bad[j], ties[j])
+	return untied
+
+def main(argv):
+	n = int(argv[1]) if len(argv) > 1 else 100000
+	sim = vsim.Sim(trace_alloc=False)
+	sim.install()
+	import i2ch
+	import gpsh
+	untied = check_imu(i2ch) + check_gps(gpsh, n)
+	print("differences off a tie: {}".format(untied))
+	return 1 if untied else 0
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv))
@@ -0,0 +1,391 @@
+# Batch re-parsing of raw GPS receiver logs (NMEA and/or UBX NAV-PVT, as
+# read from the UART) into arrays of fixes, one array per pos_dict field.
+# usage: python3 host/gpsbatch.py capture... [--workers N] [--out dir] [--bench]
+#
+# The fields follow the firmware parsers (src/nmea.py, src/ubx.py), which
+# keep the semantics of gpsh.parse_nmea_sentence: Latitude/Longitude 100.0
+# and 190.0 when missing, SpeedKts/CourseDeg/Alt/AltRef -1.0, HDOP 100.0,
+# FixStatus/NoSats -1; RMC and GGA sentences with the same UtcTime merge
+# into one fix. UtcTime and UtcDate are integers as in the GPS frame
+# (vsproto.py): ms of day and ddmmyy. 'offset' is the byte offset of the
+# first message of the fix. As in pos_dict, a field no message of the fix
+# carried keeps its value from the previous fix (GPS_POS_DICT at first).
+# Whole files are decoded with NumPy array operations: sentence bounds
+# from the '$' and CR/LF positions, checksums from a prefix XOR of the
+# buffer, fields from the comma positions, numbers digit column by digit
+# column across all the sentences at once (same fixed-point arithmetic as
+# NmeaParser). Several files are parsed in parallel by a process pool.
+# --bench compares sentences/s with gpsh.parse_nmea_sentence (one line at
+# a time, on the simulator) and with the streaming NmeaParser.
+# Requires numpy.
+
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from nmea import NMEA_MAX_LEN, NMEA_IDX_RMC, NMEA_IDX_GGA, NMEA_IDX_OTHER, NMEA_TYPE_NAMES
+from ubx import UBX_SYNC1, UBX_SYNC2, UBX_CLS_NAV, UBX_ID_NAV_PVT, UBX_NAV_PVT_LEN, \
+	UBX_FMT_NAV_PVT, UBX_KT_MUL, UBX_KT_SHIFT, UBX_I32_MAX
+
+# output columns and their defaults; keep in sync with GPS_POS_DICT in
+# src/gpsh.py (UtcTime, UtcDate as integers)
+FIX_FIELDS = (('UtcTime', '<i8', 0), ('UtcDate', '<i4', 0), ('Status', 'S1', b'N'), \
+	('Latitude', '<f8', 100.0), ('Longitude', '<f8', 190.0), ('SpeedKts', '<f8', -1.0), \
+	('CourseDeg', '<f8', -1.0), ('MVar', '<f8', 0.0), ('Mode', 'S1', b'N'), \
+	('FixStatus', '<i2', -1), ('NoSats', '<i2', -1), ('HDOP', '<f8', 100.0), \
+	('Alt', '<f8', -1.0), ('AltRef', '<f8', -1.0), ('VelN', '<f8', 0.0), \
+	('VelE', '<f8', 0.0), ('VelD', '<f8', 0.0), ('HAcc', '<f8', -1.0), \
+	('VAcc', '<f8', -1.0), ('SAcc', '<f8', -1.0), ('offset', '<i8', 0))
+
+_NAV_PVT_NAMES = ('itow', 'year', 'month', 'day', 'hour', 'minute', 'sec', 'valid', 'tacc', \
+	'nano', 'fix_type', 'flags', 'flags2', 'num_sv', 'lon', 'lat', 'height', 'hmsl', 'hacc', \
+	'vacc', 'vel_n', 'vel_e', 'vel_d', 'g_speed', 'head_mot', 's_acc', 'head_acc', 'p_dop', \
+	'pad', 'head_veh', 'mag_dec', 'mag_acc')
+_NP_CODES = dict({'I': '<u4', 'i': '<i4', 'H': '<u2', 'h': '<i2', 'B': 'u1', 'b': 'i1'})
+
+def _fixes(n):
+	return dict([(name, np.full(n, dflt, dtype=dt)) for name, dt, dflt in FIX_FIELDS])
+
+def _pvt_dtype():
+	codes = []
+	count = ''
+	for ch in UBX_FMT_NAV_PVT[1:]:
+		if ch.isdigit():
+			count += ch
+		elif ch == 'x':
+			codes.append('V' + count)
+			count = ''
+		else:
+			codes += [_NP_CODES[ch]] * (int(count) if count else 1)
+			count = ''
+	return np.dtype(list(zip(_NAV_PVT_NAMES, codes)))
+
+_HEX = np.full(256, -1, dtype=np.int16)
+_HEX[48:58] = np.arange(10)
+_HEX[65:71] = np.arange(10, 16)
+_HEX[97:103] = np.arange(10, 16)
+
+# --- NMEA ---
+
+class _Fields:
+	def __init__(self, a, start, star, commas):
+		self.a = a
+		c0 = np.searchsorted(commas, start)
+		self.nf = np.searchsorted(commas, star) - c0 + 1
+		self.c0 = c0
+		self.star = star
+		self.commas = commas
+		pass
+
+	# [s, e) of field k of every sentence (k < nf; k can differ by sentence)
+	def bounds(self, k):
+		c = self.commas
+		last = len(c) - 1
+		s = c[np.minimum(self.c0 + k - 1, last)] + 1
+		e = np.where(k < self.nf - 1, c[np.minimum(self.c0 + k, last)], self.star)
+		return s, e
+
+	# first char of field k, or default (as a byte code)
+	def char(self, k, default):
+		s, e = self.bounds(k)
+		return np.where((e > s) & (k < self.nf), self.a[np.minimum(s, len(self.a) - 1)], default)
+
+	# NmeaParser._ffix: decimal as an integer with dec decimals
+	def fix(self, s, e, dec):
+		a = self.a
+		w = int((e - s).max()) if len(s) else 0
+		v = np.zeros(len(s), dtype=np.int64)
+		frac = np.full(len(s), -1, dtype=np.int64)
+		neg = np.zeros(len(s), dtype=bool)
+		p = s.copy()
+		last = len(a) - 1
+		for j in range(w):
+			m = p < e
+			c = a[np.minimum(p, last)]
+			d = c - np.uint8(48) # digits are 0..9, anything else wraps above
+			if j == 0:
+				neg = m & (c == 45)
+			take = m & (d <= 9) & (frac < dec)
+			v[take] = v[take] * 10 + d[take]
+			frac[take & (frac >= 0)] += 1
+			frac[m & (c == 46)] = 0
+			p += 1
+		np.maximum(frac, 0, out=frac)
+		v = v * (10 ** (dec - frac))
+		return np.where(neg, -v, v)
+
+	def float(self, k, dec, default):
+		s, e = self.bounds(k)
+		return np.where(e > s, self.fix(s, e, dec) / (10 ** dec), default)
+
+	# NmeaParser._fint: all digits, else default
+	def int(self, k, default):
+		a = self.a
+		s, e = self.bounds(k)
+		w = int((e - s).max()) if len(s) else 0
+		v = np.zeros(len(s), dtype=np.int64)
+		ok = e > s
+		for j in range(w):
+			m = s + j < e
+			c = a[np.minimum(s + j, len(a) - 1)].astype(np.int64) - 48
+			ok &= ~m | ((c >= 0) & (c <= 9))
+			v = np.where(m, v * 10 + c, v)
+		return np.where(ok, v, default)
+
+	# "hhmmss.ss" -> ms of day (gpsrec.nmea_time_to_ms), 0 if too short
+	def time_ms(self, k):
+		s, e = self.bounds(k)
+		a = self.a
+		d = [a[np.minimum(s + j, len(a) - 1)].astype(np.int64) - 48 for j in range(4)]
+		ms = ((d[0] * 10 + d[1]) * 60 + d[2] * 10 + d[3]) * 60000 + self.fix(s + 4, e, 3)
+		return np.where(e - s >= 6, ms, 0)
+
+	# Latitude / Longitude with their sentinel (NmeaParser._parse_latlon)
+	def angle(self, k, deg_digits, pos_char, invalid):
+		s, e = self.bounds(k)
+		a = self.a
+		deg = np.zeros(len(s), dtype=np.int64)
+		for j in range(deg_digits):
+			deg = deg * 10 + a[np.minimum(s + j, len(a) - 1)].astype(np.int64) - 48
+		e7 = deg * 10000000 + (self.fix(s + deg_digits, e, 5) * 100 + 30) // 60
+		v = np.where(self.char(k + 1, pos_char) == pos_char, e7, -e7) / 10000000
+		return np.where(e - s > 2, v, invalid)
+
+# Returns (fixes, counters): counters are (good, bad checksum, truncated)
+# per sentence type, as NmeaParser.counters() (a truncated sentence may be
+# attributed to another type when its bytes are damaged). The values are
+# int64 here: the sentences NmeaParser rejects as bad_value (a field
+# beyond the int32 record) are parsed and counted as good.
+def parse_nmea(data):
+	a = np.frombuffer(data, dtype=np.uint8)
+	n = len(a)
+	counters = dict([(name, (0, 0, 0)) for name in NMEA_TYPE_NAMES])
+	dollars = np.flatnonzero(a == 36)
+	term = np.flatnonzero((a == 13) | (a == 10))
+	if len(dollars) == 0 or len(term) == 0:
+		return _fixes(0), counters
+	k = np.searchsorted(term, dollars)
+	has_end = k < len(term)
+	end = np.where(has_end, term[np.minimum(k, len(term) - 1)], n)
+	nxt = np.append(dollars[1:], n)
+	ln = end - dollars - 1 # length without '$' and terminator
+	typ = np.full(len(dollars), NMEA_IDX_OTHER)
+	t5 = ln >= 5
+	p = np.minimum(dollars + 3, max(0, n - 3))
+	rmc = t5 & (a[p] == 82) & (a[p + 1] == 77) & (a[p + 2] == 67)
+	gga = t5 & (a[p] == 71) & (a[p + 1] == 71) & (a[p + 2] == 65)
+	typ[rmc] = NMEA_IDX_RMC
+	typ[gga] = NMEA_IDX_GGA
+	complete = has_end & (end < nxt) & (ln <= NMEA_MAX_LEN)
+	star = end - 3
+	framed = complete & (ln >= 4) & (a[np.clip(star, 0, n - 1)] == 42)
+	# checksum: XOR of line[0:n - 3], from the prefix XOR of the buffer
+	px = np.bitwise_xor.accumulate(a)
+	cs = px[np.clip(star - 1, 0, n - 1)] ^ px[dollars]
+	hi = _HEX[a[np.clip(end - 2, 0, n - 1)]]
+	lo = _HEX[a[np.clip(end - 1, 0, n - 1)]]
+	cs_ok = framed & (hi >= 0) & (lo >= 0) & (cs == ((hi << 4) | lo))
+	commas = np.flatnonzero(a == 44)
+	f = _Fields(a, dollars + 1, star, commas)
+	long_enough = f.nf >= 12
+	good = cs_ok & ((typ == NMEA_IDX_OTHER) | long_enough)
+	for idx, name in enumerate(NMEA_TYPE_NAMES):
+		m = typ == idx
+		counters[name] = (int(np.count_nonzero(good & m)), int(np.count_nonzero(framed & ~cs_ok & m)), \
+			int(np.count_nonzero(m & ~framed) + np.count_nonzero(m & cs_ok & ~good)))
+	sel = np.flatnonzero(good & (typ != NMEA_IDX_OTHER))
+	if len(sel) == 0:
+		return _fixes(0), counters
+	f = _Fields(a, dollars[sel] + 1, star[sel], commas)
+	is_rmc = typ[sel] == NMEA_IDX_RMC
+	tms = f.time_ms(1)
+	epoch = np.cumsum(np.append(True, tms[1:] != tms[:-1])) - 1
+	out = _fixes(int(epoch[-1]) + 1 if len(epoch) else 0)
+	first = np.append(True, epoch[1:] != epoch[:-1])
+	out['offset'] = dollars[sel][first]
+	out['UtcTime'] = tms[first]
+	# the last sentence of the epoch sets the position, the last RMC / GGA
+	# the fields only it carries
+	last = np.append(epoch[1:] != epoch[:-1], True)
+	f_lat = np.where(is_rmc[last], 3, 2) # RMC: time, status, lat..; GGA: time, lat..
+	fl = _Fields(a, dollars[sel][last] + 1, star[sel][last], commas)
+	out['Latitude'][epoch[last]] = fl.angle(f_lat, 2, 78, 100.0)
+	out['Longitude'][epoch[last]] = fl.angle(f_lat + 2, 3, 69, 190.0)
+	ne = len(out['offset'])
+	for m, parse in ((is_rmc, _rmc_fields), (~is_rmc, _gga_fields)):
+		r = np.flatnonzero(m)
+		if len(r) == 0:
+			continue
+		keep = np.append(epoch[r][1:] != epoch[r][:-1], True)
+		r = r[keep]
+		fr = _Fields(a, dollars[sel][r] + 1, star[sel][r], commas)
+		# fix -> last of these sentences up to it, -1 before the first
+		src = np.full(ne, -1)
+		src[epoch[r]] = np.arange(len(r))
+		src = np.maximum.accumulate(src)
+		has = src >= 0
+		for name, v in parse(fr).items():
+			out[name][has] = v[src[has]]
+	return out, counters
+
+def _rmc_fields(f):
+	st = f.char(2, 86)
+	return dict({'Status': np.where(st == 65, b'A', b'V'), \
+		'SpeedKts': f.float(7, 3, -1.0), 'CourseDeg': f.float(8, 2, -1.0), \
+		'UtcDate': f.int(9, 0), 'MVar': f.float(10, 2, 0.0), \
+		'Mode': np.where(f.nf > 12, f.char(12, 78), 78).astype(np.uint8).view('S1')})
+
+def _gga_fields(f):
+	return dict({'FixStatus': f.int(6, -1), 'NoSats': f.int(7, -1), \
+		'HDOP': f.float(8, 2, 100.0), 'Alt': f.float(9, 2, -1.0), 'AltRef': f.float(11, 2, -1.0)})
+
+# --- UBX ---
+
+_PVT = _pvt_dtype()
+
+# NAV-PVT messages, with UbxParser._parse_nav_pvt semantics; returns
+# (fixes, frames ok, bad checksum)
+def parse_ubx(data):
+	a = np.frombuffer(data, dtype=np.uint8)
+	n = len(a)
+	total = 8 + UBX_NAV_PVT_LEN
+	if n < total:
+		return _fixes(0), 0, 0
+	m = n - 5
+	c = np.flatnonzero((a[:m] == UBX_SYNC1) & (a[1:m + 1] == UBX_SYNC2) & (a[2:m + 2] == UBX_CLS_NAV) \
+		& (a[3:m + 3] == UBX_ID_NAV_PVT) & (a[4:m + 4] == UBX_NAV_PVT_LEN & 0xFF) \
+		& (a[5:m + 5] == UBX_NAV_PVT_LEN >> 8))
+	c = c[c + total <= n]
+	body = a[c[:, None] + 2 + np.arange(4 + UBX_NAV_PVT_LEN)].astype(np.int64)
+	w = 4 + UBX_NAV_PVT_LEN - np.arange(4 + UBX_NAV_PVT_LEN)
+	ok = ((body.sum(axis=1) & 0xFF) == a[c + total - 2]) & (((body * w).sum(axis=1) & 0xFF) == a[c + total - 1])
+	bad = int(np.count_nonzero(~ok))
+	c = c[ok]
+	if len(c) > 1 and np.any(np.diff(c) < total): # overlapping: keep the first
+		keep = np.ones(len(c), dtype=bool)
+		last_end = -1
+		for k in range(len(c)):
+			keep[k] = c[k] >= last_end
+			if keep[k]:
+				last_end = c[k] + total
+		c = c[keep]
+	v = a[c[:, None] + 6 + np.arange(UBX_NAV_PVT_LEN)].reshape(-1).view(_PVT)
+	out = _fixes(len(c))
+	out['offset'] = c
+	ms = ((v['hour'].astype(np.int64) * 60 + v['minute']) * 60 + v['sec']) * 1000 + v['nano'] // 1000000
+	ms = np.maximum(ms, 0)
+	out['UtcTime'] = ms
+	out['UtcDate'] = v['day'].astype(np.int32) * 10000 + v['month'].astype(np.int32) * 100 + v['year'] % 100
+	fix_ok = (v['flags'] & 0x01) != 0
+	diff = (v['flags'] & 0x02) != 0
+	out['Status'] = np.where(fix_ok, b'A', b'V')
+	out['Latitude'] = np.where(fix_ok, v['lat'] / 10000000, 100.0)
+	out['Longitude'] = np.where(fix_ok, v['lon'] / 10000000, 190.0)
+	# the fixed-point rounding of UbxParser._parse_nav_pvt
+	out['SpeedKts'] = ((v['g_speed'].astype(np.int64) * UBX_KT_MUL) >> UBX_KT_SHIFT) / 1000
+	out['CourseDeg'] = ((v['head_mot'].astype(np.int64) + 500) // 1000) / 100
+	out['MVar'] = v['mag_dec'] / 100
+	nofix = ~fix_ok | (v['fix_type'] < 2)
+	out['Mode'] = np.where(nofix, b'N', np.where(diff, b'D', b'A'))
+	out['FixStatus'] = np.where(nofix, 0, np.where(diff, 2, 1))
+	out['NoSats'] = v['num_sv']
+	out['HDOP'] = v['p_dop'] / 100
+	out['Alt'] = (v['hmsl'] // 10) / 100
+	out['AltRef'] = ((v['height'].astype(np.int64) - v['hmsl']) // 10) / 100
+	for name, src in (('VelN', 'vel_n'), ('VelE', 'vel_e'), ('VelD', 'vel_d')):
+		out[name] = v[src] / 1000
+	for name, src in (('HAcc', 'hacc'), ('VAcc', 'vacc'), ('SAcc', 's_acc')):
+		out[name] = np.minimum(v[src], UBX_I32_MAX) / 1000
+	return out, len(c), bad
+
+# --- files ---
+
+# Fixes of a whole buffer, NMEA and NAV-PVT together in stream order
+def parse_buffer(data):
+	nm, counters = parse_nmea(data)
+	ub, ubx_ok, ubx_bad = parse_ubx(data)
+	stats = dict([(name, v) for name, v in counters.items()])
+	stats['NAV-PVT'] = (ubx_ok, ubx_bad, 0)
+	if len(ub['offset']) == 0:
+		return nm, stats
+	if len(nm['offset']) == 0:
+		return ub, stats
+	order = np.argsort(np.concatenate([nm['offset'], ub['offset']]), kind='stable')
+	return dict([(name, np.concatenate([nm[name], ub[name]])[order]) for name, dt, dflt in FIX_FIELDS]), stats
+
+def parse_file(path):
+	with open(path, 'rb') as f:
+		data = f.read()
+	return parse_buffer(data)
+
+# {path: (fixes, stats)}, files spread over `workers` processes
+def parse_files(paths, workers=None):
+	if workers == 1 or len(paths) < 2:
+		return dict([(p, parse_file(p)) for p in paths])
+	with ProcessPoolExecutor(max_workers=workers) as ex:
+		return dict(zip(paths, ex.map(parse_file, paths)))
+
+def _sentences(stats):
+	return sum([v[0] for v in stats.values()])
+
+# sentences/s of gpsh.parse_nmea_sentence, NmeaParser and parse_nmea()
+def bench(data):
+	import vsim
+	sim = vsim.Sim(trace_alloc=False)
+	sim.install()
+	import gpsh
+	from nmea import NmeaParser
+	pd = gpsh.GPS_POS_DICT.copy()
+	t0 = time.perf_counter()
+	lines = [l for l in data.decode('ascii', 'replace').splitlines() if l[3:6] in ('RMC', 'GGA')]
+	for l in lines:
+		gpsh.parse_nmea_sentence(l, pd)
+	t_line = time.perf_counter() - t0 # splitting included, checksums not checked
+	p = NmeaParser(gpsh.GpsRecord())
+	t0 = time.perf_counter()
+	p.feed(data)
+	t_stream = time.perf_counter() - t0
+	t0 = time.perf_counter()
+	fx, counters = parse_nmea(data)
+	t_batch = time.perf_counter() - t0
+	n = _sentences(counters)
+	print("{:28s} {:12s} {:>14s}".format('', 'sentences', 'sentences/s'))
+	print("{:28s} {:12d} {:14.0f}".format('gpsh.parse_nmea_sentence', len(lines), len(lines) / t_line))
+	print("{:28s} {:12d} {:14.0f}".format('NmeaParser.feed', sum([v[0] for v in p.counters().values()]), \
+		n / t_stream))
+	print("{:28s} {:12d} {:14.0f}".format('gpsbatch.parse_nmea', n, n / t_batch))
+	pass
+
+def main(argv):
+	ap = argparse.ArgumentParser(description="parse raw GPS logs into arrays of fixes")
+	ap.add_argument('capture', nargs='+')
+	ap.add_argument('--workers', type=int, default=None)
+	ap.add_argument('--out', help="write <out>/<capture name>.npz")
+	ap.add_argument('--bench', action='store_true', help="sentences/s against the per-line parser")
+	args = ap.parse_args(argv[1:])
+	if args.bench:
+		with open(args.capture[0], 'rb') as f:
+			bench(f.read())
+		return 0
+	t0 = time.perf_counter()
+	res = parse_files(args.capture, args.workers)
+	dt = time.perf_counter() - t0
+	n = 0
+	for path, (fx, stats) in res.items():
+		n += _sentences(stats)
+		print("{}: {} fixes, {}".format(path, len(fx['offset']), ', '.join(["{} {}/{}/{}".format(k, *v) \
+			for k, v in stats.items()])))
+		if not (args.out is None):
+			os.makedirs(args.out, exist_ok=True)
+			np.savez(os.path.join(args.out, os.path.basename(path) + '.npz'), **fx)
+	print("{} files, {} messages, {:.2f} s, {:.0f} messages/s".format(len(res), n, dt, n / max(dt, 1e-9)))
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv))
@@ -0,0 +1,50 @@
+# Feeds a recorded NMEA byte stream through the firmware's streaming
+# parser (src/nmea.py) and prints the per sentence type counters.
+# usage: python3 host/nmea_replay.py capture.nmea [chunk_size]
+# chunk_size = 0 feeds randomly sized chunks, like a real UART would.
+
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from gpsrec import GpsRecord
+from nmea import NmeaParser, NMEA_TYPE_NAMES
+
+def replay(data, chunk_size=0, verbose=False):
+	rec = GpsRecord()
+	p = NmeaParser(rec)
+	pos = 0
+	rnd = random.Random(0)
+	while pos < len(data):
+		if chunk_size > 0:
+			n = chunk_size
+		else:
+			n = rnd.randint(1, 64)
+		chunk = data[pos:pos + n]
+		pos += n
+		if p.feed(chunk) and verbose:
+			print("{UtcDate},{UtcTime},{Latitude:.6f},{Longitude:.6f},{Alt:.2f},{SpeedKts:.2f},{CourseDeg:.2f},{HDOP:.2f},{NoSats:d}".format(**rec.as_dict()))
+	return p
+
+def main(argv):
+	if len(argv) < 2:
+		print("usage: nmea_replay.py capture.nmea [chunk_size]")
+		return 1
+	chunk_size = 0
+	if len(argv) > 2:
+		chunk_size = int(argv[2])
+	with open(argv[1], 'rb') as f:
+		data = f.read()
+	p = replay(data, chunk_size, verbose=True)
+	c = p.counters()
+	for k in range(len(NMEA_TYPE_NAMES)):
+		name = NMEA_TYPE_NAMES[k]
+		good, bad, trunc = c[name]
+		print("{:6s} good {:8d}  bad checksum {:6d}  truncated {:6d}  bad value {:6d}".format(name, \
+			good, bad, trunc, p.bad_value[k]))
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv))
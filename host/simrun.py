@@ -0,0 +1,60 @@
+# Runs src/main.py on the host simulation (host/vsim): GPS on UART2
+# replaying a capture (or a synthetic drive), MPU6050 on I2C1 replaying a
+# register dump (or a synthetic level sensor), optional SD card image on
+# SPI1. Prints the per-callback cost table and can save what the firmware
+# sent to the Arduino (UART1).
+# usage: python3 host/simrun.py [-t seconds] [--gps capture] [--gps-baud 9600]
+#        [--imu dump.bin] [--sd card.img] [--main script.py] [-o uart1.bin]
+#        [--pps pin]
+
+import argparse
+import sys
+
+import vsim
+
+def build(args):
+	sim = vsim.Sim(trace_alloc=not args.no_alloc)
+	gps_data = args.gps if args.gps else vsim.synth_nmea(max(60, int(args.seconds) + 10))
+	sim.attach_uart(2, vsim.GpsReplay(gps_data, baudrate=args.gps_baud, pps_pin=args.pps))
+	sim.attach_i2c(1, vsim.Mpu6050(args.imu, still=args.imu_still))
+	if args.sd:
+		from fakesd import FakeSdSpi
+		sim.attach_spi(1, FakeSdSpi(args.sd))
+	return sim
+
+def main(argv):
+	ap = argparse.ArgumentParser(description="run main.py on the host simulation")
+	ap.add_argument('-t', '--seconds', type=float, default=10.0)
+	ap.add_argument('--gps', help="NMEA/UBX capture replayed on UART2")
+	ap.add_argument('--gps-baud', type=int, default=9600)
+	ap.add_argument('--imu', help="MPU6050 dump, 14-byte reads of registers 59..72")
+	ap.add_argument('--imu-still', action='store_true', help="synthetic sensor at rest, with offsets")
+	ap.add_argument('--sd', help="raw SD card image attached to SPI1")
+	ap.add_argument('--main', help="script to run instead of src/main.py")
+	ap.add_argument('-o', '--out', help="file receiving the bytes sent on UART1")
+	ap.add_argument('--pps', type=int, help="pin raised by the GPS timepulse (TIMESYNC_PPS_PIN)")
+	ap.add_argument('--no-alloc', action='store_true', help="do not trace allocations")
+	args = ap.parse_args(argv[1:])
+	sim = build(args)
+	sim.install()
+	sim.run_main(args.seconds, args.main)
+	print(sim.report())
+	gps = sim.uart_peers[2]
+	print("GPS: {}".format(gps.stats()))
+	rt = sim.main_globals.get('rt') # vsasync runtime, if main.py used it
+	if not (rt is None):
+		print("runtime: {}".format(rt.stats()))
+	for name in ('i', 'u'): # txpolicy.TxPolicy, with TX_POLICY
+		p = getattr(sim.main_globals.get(name), 'txpolicy', None)
+		if not (p is None):
+			print("txpolicy {}: {}".format(name, p.stats()))
+	ts = sim.main_globals.get('ts') # timesync.TimeSync, with TIMESYNC
+	if not (ts is None):
+		print("timesync: {}".format(ts.stats()))
+	if args.out and 1 in sim.uarts:
+		with open(args.out, 'wb') as f:
+			f.write(sim.uarts[1].tx)
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv))
@@ -0,0 +1,62 @@
+# Minimal MicroPython compatibility layer for running firmware modules
+# from src/ under CPython (micropython.const, utime, ustruct, time.sleep_ms).
+# Hardware modules (machine) are not provided here.
+
+import os
+import struct
+import sys
+import time
+import types
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+TICKS_PERIOD = 1 << 30
+_t0 = time.perf_counter()
+
+def ticks_ms():
+	return int((time.perf_counter() - _t0) * 1000) % TICKS_PERIOD
+
+def ticks_us():
+	return int((time.perf_counter() - _t0) * 1000000) % TICKS_PERIOD
+
+def ticks_add(t, delta):
+	return (t + delta) % TICKS_PERIOD
+
+def ticks_diff(a, b):
+	d = (a - b) % TICKS_PERIOD
+	if d >= TICKS_PERIOD // 2:
+		d -= TICKS_PERIOD
+	return d
+
+def sleep_ms(ms):
+	time.sleep(ms / 1000.0)
+
+def sleep_us(us):
+	time.sleep(us / 1000000.0)
+
+def _const(x):
+	return x
+
+def install():
+	if SRC_DIR not in sys.path:
+		sys.path.insert(0, SRC_DIR)
+	if 'micropython' not in sys.modules:
+		m = types.ModuleType('micropython')
+		m.const = _const
+		sys.modules['micropython'] = m
+	if 'utime' not in sys.modules:
+		m = types.ModuleType('utime')
+		m.ticks_ms = ticks_ms
+		m.ticks_us = ticks_us
+		m.ticks_add = ticks_add
+		m.ticks_diff = ticks_diff
+		m.sleep_ms = sleep_ms
+		m.sleep_us = sleep_us
+		m.sleep = time.sleep
+		m.time = time.time
+		sys.modules['utime'] = m
+	sys.modules.setdefault('ustruct', struct)
+	# sdcard.py uses the MicroPython flavour of the time module
+	if not hasattr(time, 'sleep_ms'):
+		time.sleep_ms = sleep_ms
+	pass
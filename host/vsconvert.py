@@ -0,0 +1,531 @@
+# Converts a telemetry capture (what the firmware sent to the Arduino, or
+# the output of vsdecode.py) into per-sensor columns, for multi-hour
+# drives. Text lines (_print_on_repl) and binary frames (vsproto.py) are
+# both handled, detected from the start of the file.
+# usage: python3 host/vsconvert.py capture out_dir [--text|--bin] [--chunk-mb 16]
+#
+# The file is read in chunks of a few MB and every chunk is decoded with
+# NumPy array operations, not line by line or frame by frame:
+#   binary: sync words are located with a vectorized compare, frames are
+#           grouped by type and length, checked with a CRC computed across
+#           all the frames of a group at once and reinterpreted through a
+#           structured dtype. DELTA frames (txpolicy.py) need the previous
+#           values of their stream, so chunks holding them take a per-frame
+#           path for the affected streams.
+#   text:   lines, tags and field counts are found from the byte positions
+#           of newlines, tabs and commas; the lines of each kind are joined
+#           into one comma-separated string and parsed by np.fromstring.
+# Output: out_dir/<sensor>/<field>.npy, one array per field, appended to
+# chunk after chunk (np.load(path, mmap_mode='r') maps them). Memory use
+# depends on the chunk size only. Binary columns keep the fixed-point
+# values of the frames (see vsproto.py; 't_us' is unwrapped), text
+# columns the printed values (physical units; GPS time as ms of day).
+# Requires numpy.
+
+import argparse
+import os
+import struct
+import sys
+import time
+import warnings
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from vsproto import PROTO_FORMATS, PROTO_FIELDS, PROTO_NAMES, PROTO_SYNC1, PROTO_SYNC2, \
+	PROTO_HEADER_LEN, PROTO_CRC_LEN, PROTO_MAX_PAYLOAD, PROTO_MSG_IMU, PROTO_FIELDS_IMU, \
+	PROTO_MSG_DELTA, PROTO_DELTA_FLAGS, PROTO_MSG_IMU_BATCH, PROTO_FMT_IMU_BATCH, \
+	PROTO_IMU_BATCH_HEADER_LEN, PROTO_IMU_BATCH_SAMPLE_LEN, PROTO_FIELDS_STATUS, \
+	DeltaExpander, FrameDecoder, crc16
+
+CHUNK_MB_DEFAULT = 16
+SNIFF_BYTES = 1 << 16
+TICKS_PERIOD = 1 << 30 # keep in sync with vsextract.py
+
+# keep in sync with src/hotstat.py
+HOTSTAT_SRC_NAMES = ('IMU', 'GPS')
+
+_NPY_ALIGN = 64
+_NP_CODES = dict({'I': '<u4', 'i': '<i4', 'H': '<u2', 'h': '<i2', 'B': 'u1', 'b': 'i1'})
+
+# --- output ---
+
+# One growing .npy file: the header is rewritten with the final length on
+# close(), always padded to the same size. keep reopens an existing file
+# (written by this class) instead, keeping its first `keep` rows (-1: all).
+class NpyColumn:
+	def __init__(self, path, dtype=None, keep=None):
+		self.path = path
+		if keep is None:
+			self.dtype = np.dtype(dtype)
+			self.n = 0
+			self.f = open(path, 'wb')
+			self.hlen = -(-(10 + len(self._dict(20 * '9')) + 1) // _NPY_ALIGN) * _NPY_ALIGN
+			self._header()
+			return
+		self.f = open(path, 'r+b')
+		np.lib.format.read_magic(self.f)
+		shape, fortran, self.dtype = np.lib.format.read_array_header_1_0(self.f)
+		self.hlen = self.f.tell()
+		self.n = shape[0] if keep < 0 else min(keep, shape[0])
+		self.f.seek(self.hlen + self.n * self.dtype.itemsize)
+		self.f.truncate()
+		pass
+
+	def _dict(self, n):
+		return "{{'descr': {!r}, 'fortran_order': False, 'shape': ({},), }}".format( \
+			np.lib.format.dtype_to_descr(self.dtype), n)
+
+	def _header(self):
+		pre = b'\x93NUMPY\x01\x00' + struct.pack('<H', self.hlen - 10)
+		self.f.write(pre + self._dict(self.n).encode('latin1').ljust(self.hlen - 11) + b'\n')
+
+	def append(self, values):
+		a = np.ascontiguousarray(values, dtype=self.dtype)
+		self.f.write(a.tobytes())
+		self.n += len(a)
+
+	def close(self):
+		self.f.seek(0)
+		self._header()
+		self.f.close()
+
+class ColumnStore:
+	def __init__(self, out_dir):
+		self.out_dir = out_dir
+		self.sensors = dict() # name -> {field: NpyColumn}
+		pass
+
+	# cols: list of (field, array), all of the same length
+	def append(self, sensor, cols):
+		if len(cols) == 0 or len(cols[0][1]) == 0:
+			return
+		s = self.sensors.get(sensor)
+		if s is None:
+			d = os.path.join(self.out_dir, sensor)
+			os.makedirs(d, exist_ok=True)
+			s = dict([(name, NpyColumn(os.path.join(d, name + '.npy'), a.dtype)) for name, a in cols])
+			self.sensors[sensor] = s
+		for name, a in cols:
+			s[name].append(a)
+
+	def close(self):
+		for s in self.sensors.values():
+			for c in s.values():
+				c.close()
+
+	def rows(self):
+		return dict([(name, next(iter(s.values())).n) for name, s in self.sensors.items()])
+
+# Monotonic continuation of a wrapping ticks column across chunks
+class TicksUnwrap:
+	def __init__(self, period=TICKS_PERIOD):
+		self.period = period
+		self.last = None
+		self.acc = 0
+		pass
+
+	def __call__(self, col):
+		col = col.astype(np.int64)
+		if len(col) == 0:
+			return col
+		half = self.period // 2
+		if self.last is None:
+			prev = col[0]
+			self.acc = int(col[0])
+		else:
+			prev = self.last
+		d = np.diff(col, prepend=prev)
+		d = (d + half) % self.period - half
+		out = self.acc + np.cumsum(d)
+		self.last = int(col[-1])
+		self.acc = int(out[-1])
+		return out
+
+# --- binary ---
+
+def _np_dtype(fmt, fields):
+	codes = []
+	count = ''
+	for ch in fmt[1:]:
+		if ch.isdigit():
+			count += ch
+			continue
+		codes += [_NP_CODES[ch]] * (int(count) if count else 1)
+		count = ''
+	return np.dtype(list(zip(fields, codes)))
+
+def _crc_table():
+	# crc16() of a single byte from 0 is the table entry
+	return np.array([crc16(bytes([i]), 0, 1, 0) for i in range(256)], dtype=np.uint32)
+
+_CRC_TBL = _crc_table()
+
+# CRC16 of the rows of a 2D uint8 array, all at once
+def _crc_rows(data):
+	crc = np.full(data.shape[0], 0xFFFF, dtype=np.uint32)
+	for j in range(data.shape[1]):
+		crc = ((crc << 8) & 0xFFFF) ^ _CRC_TBL[((crc >> 8) ^ data[:, j]) & 0xFF]
+	return crc
+
+# bytes [start + ofs, start + ofs + n) of every start, as rows
+def _rows(a, starts, ofs, n):
+	return a[starts[:, None] + (ofs + np.arange(n))]
+
+class BinaryConverter:
+	def __init__(self, store):
+		self.store = store
+		self.dtypes = dict([(t, _np_dtype(fmt, PROTO_FIELDS[t])) for t, fmt in PROTO_FORMATS.items()])
+		self.unwrap = dict()
+		self.expander = DeltaExpander()
+		self.delta_streams = set() # base types seen in DELTA frames
+		self.frames = 0
+		self.crc_errors = 0
+		pass
+
+	# Decodes the frames of buf that are complete (all of them at eof) and
+	# returns the number of bytes consumed.
+	def feed(self, buf, eof=False):
+		a = np.frombuffer(buf, dtype=np.uint8)
+		n = len(a)
+		if n < PROTO_HEADER_LEN + PROTO_CRC_LEN:
+			return n if eof else 0
+		cand = np.flatnonzero((a[:-1] == PROTO_SYNC1) & (a[1:] == PROTO_SYNC2))
+		cand = cand[cand + PROTO_HEADER_LEN + PROTO_CRC_LEN <= n]
+		limit = n if eof else n - (PROTO_HEADER_LEN + PROTO_MAX_PAYLOAD + PROTO_CRC_LEN)
+		cand = cand[cand < limit]
+		types = a[cand + 2]
+		plen = a[cand + 4].astype(np.int64)
+		ends = cand + PROTO_HEADER_LEN + plen + PROTO_CRC_LEN
+		ok = ends <= n
+		cand, types, plen, ends = cand[ok], types[ok], plen[ok], ends[ok]
+		# CRC check, one group per (type, length)
+		valid = np.zeros(len(cand), dtype=bool)
+		keys = (types.astype(np.int64) << 8) | plen
+		for key in np.unique(keys):
+			t = int(key >> 8)
+			pl = int(key & 0xFF)
+			fixed = self.dtypes.get(t)
+			if not (fixed is None) and fixed.itemsize != pl:
+				continue
+			if fixed is None and t != PROTO_MSG_DELTA and t != PROTO_MSG_IMU_BATCH:
+				continue
+			g = np.flatnonzero(keys == key)
+			body = _rows(a, cand[g], 2, 3 + pl)
+			tail = _rows(a, cand[g], PROTO_HEADER_LEN + pl, 2).astype(np.uint32)
+			valid[g] = _crc_rows(body) == (tail[:, 0] | (tail[:, 1] << 8))
+		known = np.isin(types, list(self.dtypes) + [PROTO_MSG_DELTA, PROTO_MSG_IMU_BATCH])
+		self.crc_errors += int(np.count_nonzero(known & ~valid))
+		cand, types, plen, ends = cand[valid], types[valid], plen[valid], ends[valid]
+		# a sync word inside a payload only passes the CRC by chance: drop
+		# frames starting inside the previous one (rare, done frame by frame)
+		if len(cand) > 1 and np.any(cand[1:] < np.maximum.accumulate(ends)[:-1]):
+			keep = np.zeros(len(cand), dtype=bool)
+			last_end = 0
+			for k in range(len(cand)):
+				if cand[k] >= last_end:
+					keep[k] = True
+					last_end = ends[k]
+			cand, types, plen, ends = cand[keep], types[keep], plen[keep], ends[keep]
+		self.frames += len(cand)
+		self._decode(a, cand, types, plen)
+		if eof:
+			return n
+		if len(ends) > 0:
+			return int(max(ends[-1], limit))
+		return max(0, int(limit))
+
+	def _decode(self, a, cand, types, plen):
+		deltas = np.flatnonzero(types == PROTO_MSG_DELTA)
+		streams = set(int(t) for t in np.unique(types))
+		streams.discard(PROTO_MSG_DELTA)
+		if len(deltas) > 0:
+			for b in np.unique(a[cand[deltas] + PROTO_HEADER_LEN] & (0xFF ^ PROTO_DELTA_FLAGS)):
+				self.delta_streams.add(int(b))
+				if int(b) in self.dtypes:
+					streams.add(int(b)) # deltas only: from the previous chunk's values
+		imu_parts = []
+		for t in sorted(streams):
+			g = np.flatnonzero(types == t)
+			if t == PROTO_MSG_IMU_BATCH:
+				imu_parts += self._batches(a, cand[g], plen[g])
+				continue
+			if t in self.delta_streams:
+				sel = np.flatnonzero((types == t) | (types == PROTO_MSG_DELTA))
+				cols = self._expand(a, cand[sel], types[sel], plen[sel], t)
+			else:
+				dt = self.dtypes[t]
+				raw = _rows(a, cand[g], PROTO_HEADER_LEN, dt.itemsize)
+				rec = raw.reshape(-1).view(dt)
+				cols = [(name, rec[name]) for name in dt.names]
+				# where a DELTA in a later chunk starts from
+				self.expander.last[t] = (int(a[cand[g[-1]] + 3]), tuple(rec[-1].tolist()))
+			if t == PROTO_MSG_IMU:
+				imu_parts.append((cand[g].astype(np.int64) * 256, cols))
+				continue
+			self._append(PROTO_NAMES[t], cols)
+		if len(imu_parts) == 1:
+			self._append(PROTO_NAMES[PROTO_MSG_IMU], imu_parts[0][1])
+		elif len(imu_parts) > 1:
+			# plain and batched IMU frames in the same chunk: stream order
+			order = np.argsort(np.concatenate([p[0] for p in imu_parts]), kind='stable')
+			cols = []
+			for k, name in enumerate(PROTO_FIELDS_IMU):
+				v = np.concatenate([np.asarray(p[1][k][1], dtype=np.int64) for p in imu_parts])
+				cols.append((name, v[order].astype(imu_parts[0][1][k][1].dtype)))
+			self._append(PROTO_NAMES[PROTO_MSG_IMU], cols)
+
+	# IMU_BATCH frames into IMU columns, grouped by batch size
+	def _batches(self, a, starts, plen):
+		out = []
+		ns = (plen - PROTO_IMU_BATCH_HEADER_LEN) // PROTO_IMU_BATCH_SAMPLE_LEN
+		hdt = _np_dtype(PROTO_FMT_IMU_BATCH, ('t', 'n'))
+		sdt = np.dtype([('dt', 'u1'), ('ax', '<i2'), ('ay', '<i2'), ('az', '<i2'), \
+			('rx', '<i2'), ('ry', '<i2'), ('rz', '<i2')])
+		for k in np.unique(ns):
+			k = int(k)
+			if k <= 0:
+				continue
+			s = starts[ns == k]
+			hdr = _rows(a, s, PROTO_HEADER_LEN, hdt.itemsize).reshape(-1).view(hdt)
+			smp = _rows(a, s, PROTO_HEADER_LEN + PROTO_IMU_BATCH_HEADER_LEN, \
+				k * sdt.itemsize).reshape(-1).view(sdt).reshape(len(s), k)
+			t = (hdr['t'].astype(np.int64)[:, None] + np.cumsum(smp['dt'].astype(np.int64), axis=1)) & 0xFFFFFFFF
+			t = t.astype(np.uint32)
+			key = s.astype(np.int64)[:, None] * 256 + np.arange(k)
+			cols = [('t', t.reshape(-1))] + [(name, smp[name].reshape(-1)) for name in PROTO_FIELDS_IMU[1:]]
+			out.append((key.reshape(-1), cols))
+		return out
+
+	# per-frame path for a stream carrying DELTA frames
+	def _expand(self, a, starts, types, plen, base):
+		fmt = PROTO_FORMATS[base]
+		frames = []
+		for s, t, pl in zip(starts, types, plen):
+			s = int(s)
+			body = a[s + PROTO_HEADER_LEN:s + PROTO_HEADER_LEN + int(pl)].tobytes()
+			if t == PROTO_MSG_DELTA:
+				if (body[0] & ~PROTO_DELTA_FLAGS) != base:
+					continue
+				frames.append((int(t), int(a[s + 3]), body))
+			else:
+				frames.append((int(t), int(a[s + 3]), struct.unpack(fmt, body)))
+		rows = [v for mt, seq, v in self.expander.expand(frames) if mt == base]
+		dt = self.dtypes[base]
+		rec = np.array([tuple(r) for r in rows], dtype=dt) if rows else np.zeros(0, dtype=dt)
+		return [(name, rec[name]) for name in dt.names]
+
+	def _append(self, sensor, cols):
+		out = []
+		for name, v in cols:
+			if name == 't_us':
+				u = self.unwrap.get(sensor)
+				if u is None:
+					u = TicksUnwrap()
+					self.unwrap[sensor] = u
+				v = u(v)
+			out.append((name, v))
+		self.store.append(sensor, out)
+
+	def stats(self):
+		return dict({'frames': self.frames, 'crc_errors': self.crc_errors, \
+			'deltas_dropped': self.expander.dropped})
+
+# --- text ---
+
+def _tag(s):
+	return (s[0] << 16) | (s[1] << 8) | s[2]
+
+# (tag, commas) -> sensor, fields, integer fields
+TEXT_KINDS = dict({
+	(_tag(b'ACC'), 5): ('acc', ('t', 'ax', 'ay', 'az', 'rx', 'ry', 'rz'), ('t',)),
+	(_tag(b'ACC'), 7): ('acc_utc', ('t', 'ax', 'ay', 'az', 'rx', 'ry', 'rz', 'utc_s', 'sync'), ('t', 'sync')),
+	(_tag(b'ATT'), 1): ('att', ('t', 'roll', 'pitch'), ('t',)),
+	(_tag(b'GPS'), 8): ('gps', ('t', 'date', 'time_ms', 'lat', 'lon', 'alt', 'speed', 'course', \
+		'hdop', 'sats'), ('t', 'date', 'time_ms', 'sats')),
+})
+TEXT_TAG_STA = _tag(b'STA')
+
+def _hhmmss_to_ms(x):
+	hh = np.floor(x / 10000.0)
+	mm = np.floor(x / 100.0) - hh * 100.0
+	return np.round((x - hh * 10000.0 - mm * 100.0) * 1000.0 + mm * 60000.0 + hh * 3600000.0)
+
+def _parse_numbers(b, ncols):
+	with warnings.catch_warnings():
+		warnings.simplefilter('error')
+		try:
+			v = np.fromstring(b, dtype=np.float64, sep=',')
+		except (ValueError, DeprecationWarning):
+			return None
+	if len(v) % ncols:
+		return None
+	return v.reshape(-1, ncols)
+
+class TextConverter:
+	def __init__(self, store):
+		self.store = store
+		self.lines = 0
+		self.bad_lines = 0
+		pass
+
+	def feed(self, buf, eof=False):
+		a = np.frombuffer(buf, dtype=np.uint8)
+		nl = np.flatnonzero(a == 10)
+		if eof and len(a) > 0 and a[-1] != 10:
+			a = np.concatenate([a, np.array([10], dtype=np.uint8)])
+			nl = np.append(nl, len(a) - 1)
+		if len(nl) == 0:
+			return len(buf) if eof else 0
+		used = int(nl[-1]) + 1
+		a = a[:used]
+		starts = np.concatenate([[0], nl[:-1] + 1])
+		ends = nl
+		self.lines += len(starts)
+		tabs = np.flatnonzero(a == 9)
+		if len(tabs) == 0:
+			self.bad_lines += len(starts)
+			return min(used, len(buf))
+		k = np.minimum(np.searchsorted(tabs, starts), len(tabs) - 1)
+		tab = tabs[k]
+		ok = (tab >= starts) & (tab + 4 < ends)
+		tab = np.where(ok, tab, 0)
+		ok &= a[np.minimum(tab + 4, len(a) - 1)] == 9
+		tag = (a[tab + 1].astype(np.int64) << 16) | (a[tab + 2].astype(np.int64) << 8) | a[tab + 3]
+		commas = np.concatenate([[0], np.cumsum(a == 44)])
+		ncomma = commas[ends] - commas[starts]
+		isnl = a == 10
+		lid = np.cumsum(isnl) - isnl # line of every byte
+		# separators: the first tab and the newline become commas, the tag,
+		# the second tab and the CRs go
+		b = a.copy()
+		drop = a == 13
+		okl = np.flatnonzero(ok)
+		b[tab[okl]] = 44
+		drop[tab[okl][:, None] + np.arange(1, 5)] = True
+		b[isnl] = 44
+		known = np.zeros(len(starts), dtype=bool)
+		for (tg, nc), (sensor, fields, ints) in TEXT_KINDS.items():
+			sel = ok & (tag == tg) & (ncomma == nc)
+			if not np.any(sel):
+				continue
+			known |= sel
+			m = sel[lid] & ~drop
+			v = _parse_numbers(b[m].tobytes()[:-1], len(fields))
+			if v is None:
+				v = self._slow(a, starts[sel], ends[sel], tab[sel], len(fields))
+			self._append(sensor, fields, ints, v)
+		sta = np.flatnonzero(ok & (tag == TEXT_TAG_STA))
+		if len(sta) > 0:
+			known[sta] = True
+			self._status(a, starts[sta], ends[sta], tab[sta])
+		self.bad_lines += int(np.count_nonzero(~known))
+		return min(used, len(buf))
+
+	# line by line, skipping what does not parse
+	def _slow(self, a, starts, ends, tab, ncols):
+		rows = []
+		for s, e, t in zip(starts, ends, tab):
+			try:
+				r = [float(a[s:t].tobytes())] + [float(x) for x in a[t + 5:e].tobytes().strip().split(b',')]
+			except ValueError:
+				self.bad_lines += 1
+				continue
+			if len(r) == ncols:
+				rows.append(r)
+			else:
+				self.bad_lines += 1
+		return np.array(rows, dtype=np.float64).reshape(-1, ncols)
+
+	def _append(self, sensor, fields, ints, v):
+		cols = []
+		for j, name in enumerate(fields):
+			c = v[:, j]
+			if name == 'time_ms':
+				c = _hhmmss_to_ms(c)
+			if name in ints:
+				c = np.round(c).astype(np.int64)
+			cols.append((name, c))
+		self.store.append(sensor, cols)
+
+	# STA lines (one a second at most): source name and histogram are not numbers
+	def _status(self, a, starts, ends, tab):
+		rows = []
+		for s, e, t in zip(starts, ends, tab):
+			try:
+				f = a[t + 5:e].tobytes().strip().split(b',')
+				name = f[0].decode()
+				src = HOTSTAT_SRC_NAMES.index(name) if name in HOTSTAT_SRC_NAMES else -1
+				r = [int(float(a[s:t].tobytes())), src] + [int(x) for x in f[1:10]] + \
+					[int(x) for x in f[10].split(b'/')]
+			except (ValueError, IndexError, UnicodeDecodeError):
+				self.bad_lines += 1
+				continue
+			if len(r) == len(PROTO_FIELDS_STATUS):
+				rows.append(r)
+			else:
+				self.bad_lines += 1
+		if rows:
+			v = np.array(rows, dtype=np.int64)
+			self.store.append('sta', [(name, v[:, j]) for j, name in enumerate(PROTO_FIELDS_STATUS)])
+
+	def stats(self):
+		return dict({'lines': self.lines, 'bad_lines': self.bad_lines})
+
+# --- driver ---
+
+# Binary as soon as the head holds a frame with a valid CRC: text lines
+# can be mixed in a binary stream (a sensor or the STA report left in text
+# mode) and the binary converter skips them.
+def sniff_text(path):
+	with open(path, 'rb') as f:
+		head = f.read(SNIFF_BYTES)
+	if FrameDecoder().feed(head):
+		return False
+	return any([(b'\t' + t + b'\t') in head for t in (b'ACC', b'GPS', b'ATT', b'STA')])
+
+def convert(path, out_dir, text=None, chunk_bytes=CHUNK_MB_DEFAULT << 20):
+	if text is None:
+		text = sniff_text(path)
+	store = ColumnStore(out_dir)
+	conv = TextConverter(store) if text else BinaryConverter(store)
+	carry = b''
+	total = 0
+	with open(path, 'rb') as f:
+		while True:
+			chunk = f.read(chunk_bytes)
+			eof = len(chunk) == 0
+			total += len(chunk)
+			buf = carry + chunk
+			used = conv.feed(buf, eof)
+			carry = buf[used:]
+			if eof:
+				break
+	store.close()
+	st = conv.stats()
+	st['bytes'] = total
+	st['rows'] = store.rows()
+	return st
+
+def main(argv):
+	ap = argparse.ArgumentParser(description="convert a telemetry capture into .npy columns")
+	ap.add_argument('capture')
+	ap.add_argument('out_dir')
+	g = ap.add_mutually_exclusive_group()
+	g.add_argument('--text', action='store_true', help="text lines (_print_on_repl)")
+	g.add_argument('--bin', action='store_true', help="binary frames (vsproto.py)")
+	ap.add_argument('--chunk-mb', type=int, default=CHUNK_MB_DEFAULT)
+	args = ap.parse_args(argv[1:])
+	text = True if args.text else (False if args.bin else None)
+	t0 = time.perf_counter()
+	st = convert(args.capture, args.out_dir, text, args.chunk_mb << 20)
+	dt = time.perf_counter() - t0
+	for sensor, n in sorted(st.pop('rows').items()):
+		print("{:10s} {:10d} rows".format(sensor, n))
+	print(', '.join(["{}: {}".format(k, v) for k, v in st.items()]))
+	print("{:.2f} s, {:.1f} MB/s".format(dt, st['bytes'] / 1e6 / max(dt, 1e-9)))
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv))
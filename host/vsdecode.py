@@ -0,0 +1,107 @@
+# Host-side decoder for the binary Uarduino frames (src/vsproto.py).
+# Prints the decoded samples in the same text format as _print_on_repl.
+# usage: python3 host/vsdecode.py capture.bin [out.txt]
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from vsproto import FrameDecoder, DeltaExpander, expand_batches, PROTO_MSG_IMU, PROTO_MSG_GPS, PROTO_MSG_STATUS, \
+	PROTO_MSG_IMU_UTC, PROTO_MSG_ATT, PROTO_U16_INVALID, PROTO_U8_INVALID
+
+# keep in sync with src/i2ch.py
+MPU_LSB_TO_MS2 = (9.806/4096.0)
+MPU_LSB_TO_RADS = (3.1415/180.0)*(205.0/32768.0)
+
+# keep in sync with src/timesync.py
+TIMESYNC_UTC_INVALID = 0xFFFFFFFF
+
+# keep in sync with src/hotstat.py
+HOTSTAT_SRC_NAMES = ('IMU', 'GPS')
+HOTSTAT_MEM_UNKNOWN = 0xFFFFFFFF
+
+READ_CHUNK = 1 << 16
+
+def imu_to_text(v):
+	t, ax, ay, az, rx, ry, rz = v
+	return "{:.1f}\tACC\t{:.4f},{:.4f},{:.4f},{:.4f},{:.4f},{:.4f}".format(t, \
+		ax * MPU_LSB_TO_MS2, ay * MPU_LSB_TO_MS2, az * MPU_LSB_TO_MS2, \
+		rx * MPU_LSB_TO_RADS, ry * MPU_LSB_TO_RADS, rz * MPU_LSB_TO_RADS)
+
+# t is printed in ms like the text lines, UTC (s of day) and sync appended
+def imu_utc_to_text(v):
+	t_us, utc_ms, utc_us, sync = v[0:4]
+	if utc_ms == TIMESYNC_UTC_INVALID:
+		utc = "-1"
+	else:
+		utc = "{:d}.{:06d}".format(utc_ms // 1000, (utc_ms % 1000) * 1000 + utc_us)
+	return "{},{},{:d}".format(imu_to_text((t_us / 1000.0,) + tuple(v[4:])), utc, sync)
+
+def att_to_text(v):
+	t, roll, pitch = v
+	return "{:.1f}\tATT\t{:.5f},{:.5f}".format(t, roll * 1e-6, pitch * 1e-6)
+
+def _u16(v, scale):
+	if v == PROTO_U16_INVALID:
+		return -1.0
+	return v / scale
+
+def gps_to_text(v):
+	t, date, tod, lat, lon, alt, spd, crs, hdop, sats = v
+	hh = tod // 3600000
+	mm = (tod // 60000) % 60
+	ss = (tod % 60000) / 1000.0
+	utc_time = "{:02d}{:02d}{:05.2f}".format(hh, mm, ss)
+	if sats == PROTO_U8_INVALID:
+		sats = -1
+	return "{:.1f}\tGPS\t{:06d},{:s},{:.6f},{:.6f},{:.2f},{:.2f},{:.2f},{:.2f},{:d}".format(t, \
+		date, utc_time, lat * 1e-7, lon * 1e-7, alt / 100.0, _u16(spd, 100.0), \
+		_u16(crs, 100.0), _u16(hdop, 100.0), sats)
+
+def status_to_text(v):
+	t, src, bin_us, calls, mean, mx, overruns, missed, jitter, late, mem = v[0:11]
+	name = HOTSTAT_SRC_NAMES[src] if src < len(HOTSTAT_SRC_NAMES) else str(src)
+	if mem == HOTSTAT_MEM_UNKNOWN:
+		mem = -1
+	return "{:.1f}\tSTA\t{:s},{:d},{:d},{:d},{:d},{:d},{:d},{:d},{:d},{:d},{:s}".format(t, \
+		name, bin_us, calls, mean, mx, overruns, missed, jitter, late, mem, \
+		'/'.join([str(h) for h in v[11:]]))
+
+TEXT_CONVERTERS = dict({PROTO_MSG_IMU: imu_to_text, PROTO_MSG_GPS: gps_to_text, \
+	PROTO_MSG_IMU_UTC: imu_utc_to_text, PROTO_MSG_ATT: att_to_text, \
+	PROTO_MSG_STATUS: status_to_text})
+
+# DELTA frames (txpolicy.py) are expanded into their base type, IMU_BATCH
+# frames (txbatch.py) into IMU ones
+def decode_stream(f_in, f_out):
+	dec = FrameDecoder()
+	exp = DeltaExpander()
+	while True:
+		chunk = f_in.read(READ_CHUNK)
+		if not chunk:
+			break
+		for msg_type, seq, values in expand_batches(exp.expand(dec.feed(chunk))):
+			conv = TEXT_CONVERTERS.get(msg_type)
+			if conv is not None:
+				f_out.write(conv(values))
+				f_out.write('\n')
+	return dec, exp
+
+def main(argv):
+	if len(argv) < 2:
+		print("usage: vsdecode.py capture.bin [out.txt]")
+		return 1
+	f_out = sys.stdout
+	if len(argv) > 2:
+		f_out = open(argv[2], 'w')
+	with open(argv[1], 'rb') as f_in:
+		dec, exp = decode_stream(f_in, f_out)
+	if f_out is not sys.stdout:
+		f_out.close()
+	sys.stderr.write("frames: {}, crc errors: {}, seq gaps: {}, skipped bytes: {}, deltas dropped: {}\n".format( \
+		dec.frames_ok, dec.crc_errors, dec.seq_gaps, dec.skipped_bytes, exp.dropped))
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv))
@@ -0,0 +1,161 @@
+# Extracts the sessions logged by sdlog.SdRegion from a raw card image
+# (e.g. `dd if=/dev/sdX of=card.img`) into per-sensor arrays.
+# usage: python3 host/vsextract.py card.img region_start_block [out_dir]
+# (region_start_block: main.SD_LOG_START_BLOCK)
+# Without out_dir the session index is printed; with it, one CSV per
+# session and sensor is written (raw fixed-point values, see vsproto.py;
+# the ticks_us 't_us' columns are unwrapped into a monotonic count).
+
+import os
+import struct
+import sys
+from array import array
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from vsproto import FrameDecoder, PROTO_FIELDS, PROTO_NAMES, PROTO_MSG_SYNC
+
+# keep in sync with src/sdlog.py
+SECTOR = 512
+SDLOG_MAGIC = b'VSLG'
+SDLOG_FMT_HEADER = '<4sBBHIII'
+SDREG_MAGIC = b'VSRG'
+SDREG_FMT_SUPER = '<4sBBHII'
+SDREG_ENTRY_OFS = 32
+SDREG_FMT_ENTRY = '<HHIII'
+SDREG_ENTRY_LEN = 16
+SDREG_FLAG_OPEN = 0x01
+
+READ_SECTORS = 2048
+
+TICKS_PERIOD = 1 << 30 # utime ticks wrap, ~18 min for ticks_us
+
+def read_index(f, region_start):
+	f.seek(region_start * SECTOR)
+	sb = f.read(SECTOR)
+	magic, version, res, n, start, blocks = struct.unpack_from(SDREG_FMT_SUPER, sb, 0)
+	if magic != SDREG_MAGIC:
+		raise ValueError("no superblock at block {}".format(region_start))
+	sessions = []
+	for k in range(n):
+		sess, flags, s_start, s_n, t0 = struct.unpack_from(SDREG_FMT_ENTRY, sb, \
+			SDREG_ENTRY_OFS + k * SDREG_ENTRY_LEN)
+		sessions.append(dict({'session': sess, 'open': bool(flags & SDREG_FLAG_OPEN), \
+			'start': s_start, 'blocks': s_n, 't0': t0}))
+	return dict({'start': start, 'blocks': blocks, 'sessions': sessions})
+
+def _new_columns():
+	out = dict()
+	for msg_type, fields in PROTO_FIELDS.items():
+		out[PROTO_NAMES[msg_type]] = dict([(name, array('q')) for name in fields])
+	return out
+
+# Decodes one session into {'imu': {field: array}, 'gps': ..., 'sync': ...}.
+# Sessions left open are read past their indexed length until the data
+# stops (a sector holding no valid frame).
+def read_session(f, entry, limit_block=None):
+	cols = _new_columns()
+	dec = FrameDecoder()
+	f.seek(entry['start'] * SECTOR)
+	header = f.read(SECTOR)
+	if header[0:4] != SDLOG_MAGIC:
+		raise ValueError("no session header at block {}".format(entry['start']))
+	pos = entry['start'] + 1
+	end = entry['start'] + entry['blocks']
+	open_ended = entry['open'] or entry['blocks'] == 0
+	if open_ended and limit_block is not None:
+		end = limit_block
+	while pos < end:
+		n = min(READ_SECTORS, end - pos)
+		data = f.read(n * SECTOR)
+		if not data:
+			break
+		stop = False
+		for s in range(0, len(data), SECTOR):
+			frames = dec.feed(data[s:s + SECTOR])
+			if open_ended and pos + s // SECTOR >= entry['start'] + entry['blocks']:
+				# past the index: stop at empty sectors or at another session's data
+				if not frames or (frames[0][0] == PROTO_MSG_SYNC and frames[0][2][2] != entry['session']):
+					stop = True
+					break
+			for msg_type, seq, values in frames:
+				name = PROTO_NAMES.get(msg_type)
+				if name is None:
+					continue
+				c = cols[name]
+				for field, v in zip(PROTO_FIELDS[msg_type], values):
+					c[field].append(v)
+		if stop:
+			break
+		pos += n
+	return cols
+
+# Monotonic version of a wrapping ticks column; steps between consecutive
+# values must be shorter than half a period (they are, for the samples).
+def unwrap_ticks(col, period=TICKS_PERIOD):
+	out = array('q')
+	half = period // 2
+	acc = 0
+	last = None
+	for v in col:
+		if last is not None:
+			acc += (v - last + half) % period - half
+		else:
+			acc = v
+		last = v
+		out.append(acc)
+	return out
+
+def extract(path, region_start):
+	with open(path, 'rb') as f:
+		idx = read_index(f, region_start)
+		sessions = idx['sessions']
+		region_end = idx['start'] + idx['blocks']
+		out = dict()
+		for k, entry in enumerate(sessions):
+			if k + 1 < len(sessions):
+				limit = sessions[k + 1]['start']
+			else:
+				limit = region_end
+			cols = read_session(f, entry, limit)
+			for c in cols.values():
+				if 't_us' in c:
+					c['t_us'] = unwrap_ticks(c['t_us'])
+			out[entry['session']] = cols
+	return idx, out
+
+def write_csv(cols, path):
+	names = list(cols.keys())
+	with open(path, 'w') as f:
+		f.write(','.join(names) + '\n')
+		for row in zip(*[cols[n] for n in names]):
+			f.write(','.join([str(v) for v in row]) + '\n')
+
+def main(argv):
+	if len(argv) < 3:
+		print("usage: vsextract.py card.img region_start_block [out_dir]")
+		return 1
+	region_start = int(argv[2])
+	if len(argv) < 4:
+		with open(argv[1], 'rb') as f:
+			idx = read_index(f, region_start)
+		print("region: start {start}, {blocks} blocks".format(**idx))
+		for e in idx['sessions']:
+			print("session {session:5d}: start {start:10d} blocks {blocks:8d} t0 {t0:10d}{}".format( \
+				' (open)' if e['open'] else '', **e))
+		return 0
+	out_dir = argv[3]
+	os.makedirs(out_dir, exist_ok=True)
+	idx, sessions = extract(argv[1], region_start)
+	for sess, cols in sessions.items():
+		for name, c in cols.items():
+			n = len(c[next(iter(c))])
+			if n == 0:
+				continue
+			path = os.path.join(out_dir, "session{:05d}_{}.csv".format(sess, name))
+			write_csv(c, path)
+			print("{}: {} rows".format(path, n))
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv))
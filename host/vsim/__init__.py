@@ -0,0 +1,21 @@
+# Host-side simulation of the ESP32 runtime: fake `machine`, `utime`,
+# `ustruct`, `micropython`, `uasyncio` and `_thread` modules on a virtual
+# clock, so that the firmware in src/ (main.py included) runs
+# deterministically on Linux.
+#
+#   import vsim
+#   sim = vsim.Sim()
+#   sim.attach_uart(2, vsim.GpsReplay(vsim.synth_nmea(60)))
+#   sim.attach_i2c(1, vsim.Mpu6050())
+#   sim.install()
+#   sim.run_main(10.0)
+#   print(sim.report())
+#
+# Virtual time only moves on sleeps and Sim.advance(); timer callbacks
+# fire at their due time and take no virtual time, so repeated runs give
+# the same output. The host time and allocations of every callback are
+# recorded (Sim.stats, Sim.report()).
+
+from .sim import Sim, CallbackStats, SRC_DIR
+from .clock import VirtualClock, TICKS_PERIOD, ticks_add, ticks_diff
+from .devices import GpsReplay, Mpu6050, synth_nmea, split_messages
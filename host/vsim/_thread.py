@@ -0,0 +1,109 @@
+# Minimal _thread on the virtual clock: enough of the API for
+# src/vsdual.py (start_new_thread, stack_size, get_ident). Sim.install()
+# registers it as sys.modules['_thread'].
+# Each firmware thread is a host thread, but only one of them runs at a
+# time: the running one keeps going until it sleeps, then the one with the
+# earliest wake time (then the earliest to sleep) takes over and moves the
+# clock to that time, firing the machine.Timer callbacks that fall due.
+# So runs are deterministic; unlike the device, a thread is never
+# preempted between sleeps (the GIL switches every few bytecodes there).
+
+import sys
+import threading
+
+_clock = None # set by Sim.install()
+_stack_size = 0
+
+class _Runner:
+	def __init__(self, ident, order):
+		self.ident = ident
+		self.order = order
+		self.wake_us = 0
+		self.go = threading.Event()
+
+# The running thread and the ones waiting for their wake time. The thread
+# that started the first one (main.py's) takes part as well; it alone gets
+# the KeyboardInterrupt that ends Sim.run_main().
+class _Scheduler:
+	def __init__(self, clock):
+		self.clock = clock
+		self.runners = dict()
+		self.order = 0
+		self.main = self._add(threading.get_ident())
+		pass
+
+	def _add(self, ident):
+		r = _Runner(ident, self.order)
+		r.wake_us = self.clock.us
+		self.order += 1
+		self.runners[ident] = r
+		return r
+
+	def _next(self):
+		stop = self.clock.interrupt_us
+		best = None
+		best_key = None
+		for r in self.runners.values():
+			key = (r.wake_us, r.order)
+			if r is self.main and not (stop is None) and stop <= r.wake_us:
+				key = (stop, -1) # Ctrl-C wakes it, before the others due then
+			if best is None or key < best_key:
+				best = r
+				best_key = key
+		return best
+
+	# hands over to the next thread and waits for the turn of `me`
+	def _switch(self, me):
+		nxt = self._next()
+		if nxt is me:
+			return
+		me.go.clear()
+		nxt.go.set()
+		me.go.wait()
+
+	def sleep_us(self, us):
+		me = self.runners[threading.get_ident()]
+		me.wake_us = self.clock.us + int(us)
+		me.order = self.order
+		self.order += 1
+		self._switch(me)
+		self.clock.advance(max(0, me.wake_us - self.clock.us))
+
+	def start(self, fn, args):
+		r = [None]
+		ready = threading.Event()
+		def body():
+			r[0] = self._add(threading.get_ident())
+			ready.set()
+			r[0].go.wait()
+			try:
+				fn(*args)
+			except BaseException as e:
+				sys.stderr.write("Unhandled exception in thread started by {!r}: {!r}\n".format(fn, e))
+			finally:
+				del self.runners[r[0].ident]
+				self._next().go.set()
+		t = threading.Thread(target=body, daemon=True)
+		t.start()
+		ready.wait()
+		return r[0].ident
+
+_sched = None
+
+def start_new_thread(fn, args, kwargs=None):
+	global _sched
+	if _sched is None:
+		_sched = _Scheduler(_clock)
+		_clock.sched = _sched
+	if kwargs:
+		return _sched.start(lambda *a: fn(*a, **kwargs), args)
+	return _sched.start(fn, args)
+
+def stack_size(size=0):
+	global _stack_size
+	old = _stack_size
+	_stack_size = size
+	return old
+
+def get_ident():
+	return threading.get_ident()
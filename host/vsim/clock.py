@@ -0,0 +1,88 @@
+# Virtual time base of the simulation. Time only moves when the firmware
+# sleeps (or the runner calls advance()); timers fire at their exact due
+# time, in due order, and their callbacks take no virtual time.
+
+TICKS_PERIOD = 1 << 30
+
+def ticks_add(t, delta):
+	return (t + delta) % TICKS_PERIOD
+
+def ticks_diff(a, b):
+	d = (a - b) % TICKS_PERIOD
+	if d >= TICKS_PERIOD // 2:
+		d -= TICKS_PERIOD
+	return d
+
+class VirtualClock:
+	def __init__(self, step_us=0):
+		self.us = 0
+		self.step_us = step_us # added on every ticks read, for busy-wait loops
+		self.timers = []
+		self.depth = 0 # > 0 while a callback runs: sleeps do not fire timers
+		self.interrupt_us = None # raise KeyboardInterrupt (Ctrl-C) here
+		self.sched = None # _thread scheduler, once a thread is started
+		pass
+
+	def ticks_us(self):
+		self.us += self.step_us
+		return self.us % TICKS_PERIOD
+
+	def ticks_ms(self):
+		self.us += self.step_us
+		return (self.us // 1000) % TICKS_PERIOD
+
+	def add_timer(self, t):
+		if t not in self.timers:
+			self.timers.append(t)
+
+	def remove_timer(self, t):
+		if t in self.timers:
+			self.timers.remove(t)
+
+	def next_due(self, end_us):
+		best = None
+		for t in self.timers:
+			if t.due_us <= end_us and (best is None or t.due_us < best.due_us):
+				best = t
+		return best
+
+	# Moves time forward by `us`, firing the timers that fall due on the
+	# way. Inside a callback time still moves, but nothing else is fired
+	# (soft timer callbacks do not preempt each other).
+	def advance(self, us):
+		end = self.us + int(us)
+		stop = self.interrupt_us
+		if self.depth == 0:
+			if not (stop is None) and end >= stop:
+				end = stop
+			while True:
+				t = self.next_due(end)
+				if t is None:
+					break
+				if t.due_us > self.us:
+					self.us = t.due_us
+				t.fire()
+		if end > self.us:
+			self.us = end
+		if self.depth == 0 and not (stop is None) and self.us >= stop:
+			self.interrupt_us = None
+			raise KeyboardInterrupt()
+		pass
+
+	# runs until the next timer is due (machine.idle)
+	def idle(self):
+		t = self.next_due(1 << 62)
+		if t is None:
+			self.advance(1000)
+		else:
+			self.advance(max(0, t.due_us - self.us))
+
+	def sleep_ms(self, ms):
+		self.sleep_us(int(ms * 1000))
+
+	# with threads, the other ones run until this one's wake time
+	def sleep_us(self, us):
+		if self.sched is None or self.depth > 0:
+			self.advance(int(us))
+		else:
+			self.sched.sleep_us(us)
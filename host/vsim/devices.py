@@ -0,0 +1,442 @@
+# Peripherals on the other end of the fake buses: a GPS receiver replaying
+# a recorded NMEA/UBX stream and an MPU6050 replaying a register dump.
+# The SD card is host/fakesd.FakeSdSpi.
+
+import math
+import struct
+
+from ubx import ubx_build, ubx_checksum, UBX_CLS_ACK, UBX_CLS_CFG, UBX_CLS_NAV, \
+	UBX_CLS_NMEA, UBX_ID_ACK_ACK, UBX_ID_NAV_PVT
+
+# UBX message ids of the NMEA sentences (class 0xF0), for CFG-MSG
+NMEA_IDS = dict({b'GGA': 0x00, b'GLL': 0x01, b'GSA': 0x02, b'GSV': 0x03, b'RMC': 0x04, \
+	b'VTG': 0x05, b'GRS': 0x06, b'GST': 0x07, b'ZDA': 0x08, b'GBS': 0x09, b'DTM': 0x0A, \
+	b'GNS': 0x0D, b'TXT': 0x41})
+
+_UBX_ID_CFG_PRT = 0x00
+_UBX_ID_CFG_MSG = 0x01
+_UBX_ID_CFG_RATE = 0x08
+
+# messages that open a navigation epoch, by preference
+_EPOCH_KEYS = ((UBX_CLS_NMEA, 0x04), (UBX_CLS_NMEA, 0x00), (UBX_CLS_NAV, UBX_ID_NAV_PVT))
+
+# Splits a capture into messages: [(key, bytes)], key = (class, id) with
+# NMEA sentences under class 0xF0 as in CFG-MSG; None for anything else.
+def split_messages(data):
+	out = []
+	pos = 0
+	n = len(data)
+	while pos < n:
+		if data[pos] == 0x24: # '$'
+			end = data.find(b'\n', pos)
+			end = n if end < 0 else end + 1
+			mid = NMEA_IDS.get(bytes(data[pos + 3:pos + 6]))
+			out.append(((UBX_CLS_NMEA, mid) if not (mid is None) else None, bytes(data[pos:end])))
+			pos = end
+		elif data[pos] == 0xB5 and pos + 6 <= n and data[pos + 1] == 0x62:
+			ln = data[pos + 4] | (data[pos + 5] << 8)
+			end = min(n, pos + 8 + ln)
+			out.append(((data[pos + 2], data[pos + 3]), bytes(data[pos:end])))
+			pos = end
+		else:
+			end = pos + 1
+			while end < n and data[end] != 0x24 and data[end] != 0xB5:
+				end += 1
+			out.append((None, bytes(data[pos:end])))
+			pos = end
+	return out
+
+def _nmea_cs(body):
+	c = 0
+	for b in body.encode():
+		c ^= b
+	return "${}*{:02X}\r\n".format(body, c)
+
+# Synthetic RMC+GGA stream: a vehicle driving on a circle, one epoch per
+# 1/rate_hz seconds. Used when no capture is given.
+def synth_nmea(seconds=60, rate_hz=5, lat=45.07, lon=7.68, speed_kts=20.0):
+	out = []
+	r = speed_kts * 0.514444 * 60.0 / (2.0 * math.pi) # one lap per minute
+	for k in range(int(seconds * rate_hz)):
+		t = k / float(rate_hz)
+		a = 2.0 * math.pi * t / 60.0
+		la = lat + (r * math.sin(a)) / 111320.0
+		lo = lon + (r * (1.0 - math.cos(a))) / (111320.0 * math.cos(math.radians(lat)))
+		course = (math.degrees(a) + 90.0) % 360.0
+		hh = int(t // 3600) % 24
+		mm = int(t // 60) % 60
+		ss = t % 60
+		utc = "{:02d}{:02d}{:05.2f}".format(12 + hh, mm, ss)
+		ns = "{:02d}{:08.5f}".format(int(la), (la - int(la)) * 60.0)
+		ew = "{:03d}{:08.5f}".format(int(lo), (lo - int(lo)) * 60.0)
+		out.append(_nmea_cs("GPRMC,{},A,{},N,{},E,{:.3f},{:.2f},181026,,,A".format(utc, ns, ew, \
+			speed_kts, course)))
+		out.append(_nmea_cs("GPGGA,{},{},N,{},E,1,09,0.92,{:.1f},M,48.0,M,,".format(utc, ns, ew, \
+			240.0 + 2.0 * math.sin(a))))
+	return ''.join(out).encode()
+
+# ms within the second of the UTC time in an RMC/GGA sentence or NAV-PVT
+# message, None when there is none
+def _utc_ms(raw):
+	if raw[0:1] == b'$':
+		f = raw.split(b',')
+		if len(f) < 2 or len(f[1]) < 6:
+			return None
+		try:
+			return int(round(float(f[1][4:]) * 1000.0)) % 1000
+		except ValueError:
+			return None
+	if raw[0:2] == b'\xb5\x62' and raw[2] == UBX_CLS_NAV and raw[3] == UBX_ID_NAV_PVT and len(raw) >= 6 + 20:
+		nano = struct.unpack_from('<i', raw, 6 + 16)[0]
+		return int(round(nano / 1e6)) % 1000
+	return None
+
+# GPS receiver on a UART. Epochs (from one RMC/GGA/NAV-PVT to the next)
+# are released every navigation period and stream out at the receiver's
+# baud rate; nothing is received while the UART speed does not match.
+# CFG-RATE/MSG/PRT written by the firmware are applied (CFG-MSG with rate
+# 0 filters those messages out of the replay) and CFG frames are ACKed,
+# except CFG-PRT, whose ACK is lost in the speed change.
+# With pps_pin set, the replay runs on its own schedule (not only when the
+# UART is read) and raises that pin at the start of every epoch whose UTC
+# time is a whole second, as the receiver timepulse does.
+class GpsReplay:
+	def __init__(self, data, baudrate=9600, rate_hz=1, loop=True, ack=True, pps_pin=None):
+		if isinstance(data, str):
+			with open(data, 'rb') as f:
+				data = f.read()
+		self.msgs = split_messages(data)
+		self.baudrate = baudrate
+		self.period_us = 1000000 // rate_hz
+		self.loop = loop
+		self.ack = ack
+		keys = set([m[0] for m in self.msgs])
+		self.epoch_key = None
+		for k in _EPOCH_KEYS:
+			if k in keys:
+				self.epoch_key = k
+				break
+		self.epochs = []
+		start = 0
+		for i in range(1, len(self.msgs)):
+			if self.msgs[i][0] == self.epoch_key:
+				self.epochs.append((start, i))
+				start = i
+		if self.msgs:
+			self.epochs.append((start, len(self.msgs)))
+		self.epoch_utc = [_utc_ms(self.msgs[a][1]) for a, b in self.epochs]
+		self.pps_pin = pps_pin
+		self.sim = None
+		self.uart_id = None
+		self.due_us = 0
+		self.pps_edges = 0
+		self.rates = dict() # (class, id) -> rate set by CFG-MSG
+		self.cmd = bytearray()
+		self.reply = bytearray()
+		self.epoch = -1
+		self.ep_data = b''
+		self.ep_t = 0
+		self.sent = 0
+		self.next_t = 0
+		self.done = False
+		self.epochs_sent = 0
+		self.bytes_sent = 0
+		self.bytes_lost = 0
+		self.cfg_frames = 0
+		self.acks = 0
+		pass
+
+	def _epoch_bytes(self, k):
+		a, b = self.epochs[k]
+		out = []
+		for key, raw in self.msgs[a:b]:
+			if not (key is None) and self.rates.get(key, 1) == 0:
+				continue
+			out.append(raw)
+		return b''.join(out)
+
+	def _start_epoch(self, t):
+		k = self.epoch + 1
+		if k >= len(self.epochs):
+			if not self.loop or not self.epochs:
+				self.done = True
+				return False
+			k = 0
+		self.epoch = k
+		self.ep_data = self._epoch_bytes(k)
+		self.ep_t = t
+		if not (self.sim is None) and self.epoch_utc[k] == 0 and t >= self.sim.clock.us:
+			pin = self.sim.pins.get(self.pps_pin)
+			if not (pin is None):
+				pin.drive(0)
+				pin.drive(1)
+				self.pps_edges += 1
+		self.sent = 0
+		self.next_t = t + self.period_us
+		self.epochs_sent += 1
+		return True
+
+	def pump(self, uart, now):
+		out = bytearray()
+		if self.reply:
+			out.extend(self.reply)
+			self.reply = bytearray()
+		bps = self.baudrate / 10.0
+		while not self.done:
+			if self.epoch < 0:
+				if not self._start_epoch(0):
+					break
+			can = min(len(self.ep_data), int((now - self.ep_t) * bps / 1000000.0))
+			if can > self.sent:
+				out.extend(self.ep_data[self.sent:can])
+				self.sent = can
+			if self.sent < len(self.ep_data) or now < self.next_t:
+				break
+			# a long epoch delays the next one
+			line_free = self.ep_t + int(len(self.ep_data) * 1000000.0 / bps)
+			if not self._start_epoch(max(self.next_t, line_free)):
+				break
+		if not out:
+			return
+		if uart.baudrate != self.baudrate:
+			self.bytes_lost += len(out)
+			return
+		self.bytes_sent += len(out)
+		uart.rx_put(out)
+
+	# Called by Sim.install(). With a PPS pin the replay also acts as a
+	# clock timer, due at the start of the next epoch.
+	def bind(self, sim, uart_id):
+		if self.pps_pin is None:
+			return
+		self.sim = sim
+		self.uart_id = uart_id
+		self.due_us = sim.clock.us
+		sim.clock.add_timer(self)
+
+	def fire(self):
+		clock = self.sim.clock
+		uart = self.sim.uarts.get(self.uart_id)
+		if uart is None:
+			self.due_us = clock.us + 10000 # not opened yet
+			return
+		self.pump(uart, clock.us)
+		if self.done:
+			clock.remove_timer(self)
+		else:
+			self.due_us = max(self.next_t, clock.us + 1)
+
+	def on_write(self, uart, data, now):
+		if uart.baudrate != self.baudrate:
+			return
+		self.cmd.extend(data)
+		buf = self.cmd
+		while True:
+			k = buf.find(b'\xb5\x62')
+			if k < 0:
+				del buf[:]
+				return
+			if k > 0:
+				del buf[0:k]
+			if len(buf) < 6:
+				return
+			ln = buf[4] | (buf[5] << 8)
+			if len(buf) < 8 + ln:
+				return
+			frame = bytes(buf[0:8 + ln])
+			del buf[0:8 + ln]
+			ck_a, ck_b = ubx_checksum(frame, 2, 6 + ln)
+			if ck_a == frame[6 + ln] and ck_b == frame[7 + ln]:
+				self._command(frame[2], frame[3], frame[6:6 + ln])
+
+	def _command(self, cls, mid, payload):
+		if cls != UBX_CLS_CFG:
+			return
+		self.cfg_frames += 1
+		if mid == _UBX_ID_CFG_RATE and len(payload) >= 2:
+			meas = payload[0] | (payload[1] << 8)
+			if meas > 0:
+				self.period_us = meas * 1000
+		elif mid == _UBX_ID_CFG_MSG and len(payload) >= 3:
+			rate = payload[3] if len(payload) == 8 else payload[2]
+			self.rates[(payload[0], payload[1])] = rate
+		elif mid == _UBX_ID_CFG_PRT and len(payload) >= 12:
+			self.baudrate = struct.unpack_from('<I', payload, 8)[0]
+			return
+		if self.ack:
+			self.acks += 1
+			self.reply.extend(ubx_build(UBX_CLS_ACK, UBX_ID_ACK_ACK, bytes([cls, mid])))
+
+	def stats(self):
+		return dict({'baudrate': self.baudrate, 'period_ms': self.period_us // 1000, \
+			'epochs': self.epochs_sent, 'bytes_sent': self.bytes_sent, \
+			'bytes_lost': self.bytes_lost, 'cfg_frames': self.cfg_frames, 'acks': self.acks, \
+			'pps_edges': self.pps_edges})
+
+# register numbers, see src/i2ch.py
+_XA_OFFS = 6
+_XG_OFFS = 19
+_SMPLRT_DIV = 25
+_CONFIG = 26
+_GYRO_CONFIG = 27
+_ACCEL_CONFIG = 28
+_FIFO_EN = 35
+_INT_STATUS = 58
+_SENSORVAL = 59
+_USER_CTRL = 106
+_PWR_MGMT1 = 107
+_FIFO_COUNT = 114
+_FIFO_RW = 116
+_WHO_AM_I = 117
+_FIFO_SIZE = 1024
+_INT_FIFO_OFLOW = 0x10
+
+# factory accelerometer trims (XA/YA/ZA_OFFS, +/-16g LSB, bit 0 reserved)
+_ACC_TRIMS = (-2781, 1102, 1450)
+# biases of the still sensor [+/-8g and +/-250 dps counts]
+_STILL_BIAS = (120, -60, -300, 0, 35, -20, 8)
+
+# MPU6050 register model. `dump` is a file (or bytes) of consecutive 14-byte
+# reads of registers 59..72, as returned by i2c.readfrom_mem(0x68, 59, 14)
+# on the device; one record per output sample. Without a dump a gently
+# swinging, level sensor is synthesized (with still=True: a level sensor at
+# rest, with offsets and a little noise). Samples advance with the virtual
+# clock at the rate set by CONFIG/SMPLRT_DIV, and fill the FIFO when it is
+# enabled (overflow keeps the newest bytes and sets INT_STATUS.FIFO_OFLOW).
+# Changes to the accel/gyro offset registers shift the readings.
+class Mpu6050:
+	def __init__(self, dump=None, loop=True, still=False):
+		if isinstance(dump, str):
+			with open(dump, 'rb') as f:
+				dump = f.read()
+		self.records = []
+		if dump:
+			for k in range(0, len(dump) - 13, 14):
+				self.records.append(bytes(dump[k:k + 14]))
+		self.loop = loop
+		self.still = still
+		self.regs = bytearray(128)
+		self.reset()
+		self.reads = 0
+		self.writes = 0
+		self.fifo_overflows = 0
+		pass
+
+	def reset(self):
+		for i in range(len(self.regs)):
+			self.regs[i] = 0
+		self.regs[_WHO_AM_I] = 0x68
+		self.regs[_PWR_MGMT1] = 0x40 # asleep after power-up
+		for j in range(3):
+			struct.pack_into('>h', self.regs, _XA_OFFS + 2 * j, _ACC_TRIMS[j])
+		self.fifo = bytearray()
+		self.fifo_k = 0 # index of the last sample pushed into the FIFO
+
+	def period_us(self):
+		dlpf = self.regs[_CONFIG] & 0x07
+		base = 8000 if dlpf == 0 or dlpf == 7 else 1000
+		return (self.regs[_SMPLRT_DIV] + 1) * 1000000.0 / base
+
+	def _index(self, now):
+		return int(now // self.period_us())
+
+	def sample(self, k):
+		if self.regs[_PWR_MGMT1] & 0x40:
+			return bytes(14)
+		lsb_g = 16384 >> ((self.regs[_ACCEL_CONFIG] >> 3) & 3)
+		lsb_dps = 131.0 / (1 << ((self.regs[_GYRO_CONFIG] >> 3) & 3))
+		if self.records:
+			n = len(self.records)
+			v = list(struct.unpack('>7h', self.records[k % n if self.loop else min(k, n - 1)]))
+		elif self.still:
+			v = [_STILL_BIAS[j] + ((k * 7 + j * 3) % 5) - 2 for j in range(7)]
+			v[2] += lsb_g
+			v[3] = -3920
+		else:
+			t = k * self.period_us() / 1000000.0
+			a = 2.0 * math.pi * 0.5 * t
+			v = [int(0.05 * lsb_g * math.sin(a)), int(0.02 * lsb_g * math.cos(a)), \
+				lsb_g, -3920, int(5.0 * lsb_dps * math.cos(a)), 0, int(1.0 * lsb_dps * math.sin(0.4 * a))]
+		# offset registers, relative to their power-up values
+		for j in range(3):
+			d = (struct.unpack_from('>h', self.regs, _XA_OFFS + 2 * j)[0] & ~1) - (_ACC_TRIMS[j] & ~1)
+			v[j] += int(round(d * lsb_g / 2048.0))
+			d = struct.unpack_from('>h', self.regs, _XG_OFFS + 2 * j)[0]
+			v[4 + j] += int(round(d * lsb_dps / 32.8))
+		return struct.pack('>7h', *[max(-32768, min(32767, x)) for x in v])
+
+	def _fifo_record(self, k):
+		en = self.regs[_FIFO_EN]
+		s = self.sample(k)
+		out = b''
+		if en & 0x08:
+			out += s[0:6]
+		if en & 0x80:
+			out += s[6:8]
+		if en & 0x40:
+			out += s[8:10]
+		if en & 0x20:
+			out += s[10:12]
+		if en & 0x10:
+			out += s[12:14]
+		return out
+
+	def _fifo_update(self, now):
+		k1 = self._index(now)
+		if not (self.regs[_USER_CTRL] & 0x40) or not self.regs[_FIFO_EN]:
+			self.fifo_k = k1
+			return
+		k0 = self.fifo_k
+		if k1 <= k0:
+			return
+		rec_len = len(self._fifo_record(k0))
+		# only the samples that can still be in the FIFO are generated
+		first = max(k0 + 1, k1 - _FIFO_SIZE // max(rec_len, 1) - 1)
+		for k in range(first, k1 + 1):
+			self.fifo.extend(self._fifo_record(k))
+		if len(self.fifo) > _FIFO_SIZE:
+			del self.fifo[0:len(self.fifo) - _FIFO_SIZE]
+			self.regs[_INT_STATUS] |= _INT_FIFO_OFLOW
+			self.fifo_overflows += 1
+		self.fifo_k = k1
+
+	def write(self, reg, data, now):
+		self.writes += 1
+		self._fifo_update(now)
+		for i in range(len(data)):
+			r = (reg + i) & 0x7F
+			v = data[i]
+			if r == _USER_CTRL:
+				if v & 0x04:
+					self.fifo = bytearray()
+				if (v & 0x40) and not (self.regs[_USER_CTRL] & 0x40):
+					self.fifo_k = self._index(now)
+				v &= ~0x07 # reset bits clear themselves
+			elif r == _PWR_MGMT1 and (v & 0x80):
+				self.reset()
+				continue
+			elif r == _FIFO_RW:
+				self.fifo.append(v)
+				continue
+			elif r == _SMPLRT_DIV or r == _CONFIG:
+				self.regs[r] = v
+				self.fifo_k = self._index(now)
+				continue
+			self.regs[r] = v
+
+	def read(self, reg, n, now):
+		self.reads += 1
+		self._fifo_update(now)
+		if reg == _FIFO_RW:
+			out = bytes(self.fifo[0:n])
+			del self.fifo[0:n]
+			return out + bytes(n - len(out))
+		view = bytearray(self.regs)
+		view[_SENSORVAL:_SENSORVAL + 14] = self.sample(self._index(now))
+		struct.pack_into('>H', view, _FIFO_COUNT, len(self.fifo))
+		out = bytearray()
+		for i in range(n):
+			out.append(view[(reg + i) & 0x7F])
+		if reg <= _INT_STATUS < reg + n:
+			self.regs[_INT_STATUS] = 0 # cleared on read
+		return bytes(out)
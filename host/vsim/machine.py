@@ -0,0 +1,301 @@
+# Fake `machine` module. Sim.install() registers it as sys.modules['machine']
+# and binds it to the running simulation (_sim); the peripherals look up
+# the devices attached to their bus/port id there.
+
+_sim = None
+
+def _now():
+	return _sim.clock.us
+
+class Pin:
+	IN = 1
+	OUT = 3
+	OPEN_DRAIN = 7
+	PULL_UP = 2
+	PULL_DOWN = 1
+	IRQ_RISING = 1
+	IRQ_FALLING = 2
+
+	def __init__(self, id, mode=-1, pull=-1, value=None):
+		self.id = id
+		self.mode = mode
+		self.pull = pull
+		self.v = 0 if value is None else value
+		self.handler = None
+		self.trigger = 0
+		_sim.pins[id] = self
+		pass
+
+	# accepts the odd positional forms used in the firmware, e.g. init(27, Pin.OUT)
+	def init(self, *args, **kw):
+		if 'mode' in kw:
+			self.mode = kw['mode']
+		if 'value' in kw and kw['value'] is not None:
+			self.v = kw['value']
+
+	def value(self, v=None):
+		if v is None:
+			return self.v
+		self.v = 1 if v else 0
+
+	def __call__(self, v=None):
+		return self.value(v)
+
+	def on(self):
+		self.v = 1
+
+	def off(self):
+		self.v = 0
+
+	def irq(self, handler=None, trigger=IRQ_RISING | IRQ_FALLING, **kw):
+		self.handler = handler
+		self.trigger = trigger if not (handler is None) else 0
+		pass
+
+	# drives the pin from outside (e.g. a PPS edge), running the IRQ handler
+	def drive(self, v):
+		v = 1 if v else 0
+		old = self.v
+		self.v = v
+		if self.handler is None or v == old:
+			return
+		if (v and (self.trigger & Pin.IRQ_RISING)) or (not v and (self.trigger & Pin.IRQ_FALLING)):
+			_sim.call(self.handler, self)
+
+class UART:
+	def __init__(self, id, baudrate=115200, **kw):
+		self.id = id
+		self.baudrate = baudrate
+		self.rxbuf_size = 256
+		self.rx = bytearray()
+		self.tx = bytearray() # everything written, when the simulation keeps it
+		self.tx_bytes = 0
+		self.rx_overruns = 0
+		self.peer = _sim.uart_peers.get(id)
+		_sim.uarts[id] = self
+		self.init(baudrate, **kw)
+		pass
+
+	def init(self, baudrate=None, bits=8, parity=None, stop=1, rxbuf=None, **kw):
+		if baudrate:
+			self.baudrate = baudrate
+		if rxbuf:
+			self.rxbuf_size = rxbuf
+		pass
+
+	def deinit(self):
+		pass
+
+	def _pull(self):
+		if not (self.peer is None):
+			self.peer.pump(self, _now())
+
+	# called by the peer: bytes beyond the driver's rx buffer are lost
+	def rx_put(self, data):
+		room = self.rxbuf_size - len(self.rx)
+		if len(data) > room:
+			self.rx_overruns += len(data) - max(room, 0)
+			data = data[0:max(room, 0)]
+		self.rx.extend(data)
+
+	def any(self):
+		self._pull()
+		return len(self.rx)
+
+	def read(self, n=-1):
+		self._pull()
+		if not self.rx:
+			return None
+		if n < 0 or n > len(self.rx):
+			n = len(self.rx)
+		out = bytes(self.rx[0:n])
+		del self.rx[0:n]
+		return out
+
+	def readinto(self, buf, n=-1):
+		self._pull()
+		if not self.rx:
+			return None
+		if n < 0 or n > len(buf):
+			n = len(buf)
+		n = min(n, len(self.rx))
+		buf[0:n] = self.rx[0:n]
+		del self.rx[0:n]
+		return n
+
+	def readline(self):
+		self._pull()
+		if not self.rx:
+			return None
+		k = self.rx.find(b'\n')
+		n = len(self.rx) if k < 0 else k + 1
+		out = bytes(self.rx[0:n])
+		del self.rx[0:n]
+		return out
+
+	def write(self, buf):
+		data = bytes(buf)
+		self.tx_bytes += len(data)
+		if _sim.keep_tx:
+			self.tx.extend(data)
+		if not (self.peer is None):
+			self.peer.on_write(self, data, _now())
+		return len(data)
+
+class I2C:
+	def __init__(self, id, scl=None, sda=None, freq=400000, **kw):
+		self.id = id
+		self.freq = freq
+		self.devices = _sim.i2c_devices.setdefault(id, dict())
+		self.ptr = dict()
+		pass
+
+	def _dev(self, addr):
+		d = self.devices.get(addr)
+		if d is None:
+			raise OSError(19) # ENODEV, as on the ESP32
+		return d
+
+	def scan(self):
+		return sorted(self.devices.keys())
+
+	def writeto_mem(self, addr, memaddr, buf, addrsize=8):
+		self._dev(addr).write(memaddr, bytes(buf), _now())
+
+	def readfrom_mem(self, addr, memaddr, nbytes, addrsize=8):
+		return bytes(self._dev(addr).read(memaddr, nbytes, _now()))
+
+	def readfrom_mem_into(self, addr, memaddr, buf, addrsize=8):
+		data = self._dev(addr).read(memaddr, len(buf), _now())
+		buf[0:len(buf)] = data
+
+	# plain transfers: the first byte written sets the register pointer
+	def writeto(self, addr, buf, stop=True):
+		buf = bytes(buf)
+		d = self._dev(addr)
+		if buf:
+			self.ptr[addr] = buf[0]
+			if len(buf) > 1:
+				d.write(buf[0], buf[1:], _now())
+		return 1
+
+	def readfrom(self, addr, nbytes, stop=True):
+		return bytes(self._dev(addr).read(self.ptr.get(addr, 0), nbytes, _now()))
+
+	def readfrom_into(self, addr, buf, stop=True):
+		data = self._dev(addr).read(self.ptr.get(addr, 0), len(buf), _now())
+		buf[0:len(buf)] = data
+
+# Forwards to the device attached to the bus (e.g. fakesd.FakeSdSpi);
+# an empty bus reads 0xFF.
+class SPI:
+	MSB = 0
+	LSB = 1
+
+	def __init__(self, id, baudrate=1000000, **kw):
+		self.id = id
+		self.dev = _sim.spi_devices.get(id)
+		self.init(baudrate=baudrate, **kw)
+		pass
+
+	def init(self, baudrate=1000000, **kw):
+		self.baudrate = baudrate
+		if not (self.dev is None):
+			self.dev.init(baudrate=baudrate)
+
+	def deinit(self):
+		pass
+
+	def write(self, buf):
+		if not (self.dev is None):
+			self.dev.write(buf)
+
+	def readinto(self, buf, write=0x00):
+		if self.dev is None:
+			for i in range(len(buf)):
+				buf[i] = 0xFF
+		else:
+			self.dev.readinto(buf, write)
+
+	def read(self, nbytes, write=0x00):
+		buf = bytearray(nbytes)
+		self.readinto(buf, write)
+		return bytes(buf)
+
+	def write_readinto(self, write_buf, read_buf):
+		if self.dev is None:
+			for i in range(len(read_buf)):
+				read_buf[i] = 0xFF
+		else:
+			self.dev.write_readinto(write_buf, read_buf)
+
+class Timer:
+	ONE_SHOT = 0
+	PERIODIC = 1
+
+	def __init__(self, id=-1, **kw):
+		self.id = id
+		self.mode = Timer.PERIODIC
+		self.period_us = 0
+		self.due_us = 0
+		self.callback = None
+		if kw:
+			self.init(**kw)
+		pass
+
+	def init(self, mode=PERIODIC, period=-1, callback=None, freq=-1):
+		clock = _sim.clock
+		clock.remove_timer(self)
+		if freq > 0:
+			self.period_us = int(1000000 // freq)
+		else:
+			self.period_us = int(period * 1000)
+		if self.period_us <= 0:
+			raise ValueError("period must be positive")
+		self.mode = mode
+		self.callback = callback
+		self.due_us = clock.us + self.period_us
+		clock.add_timer(self)
+		pass
+
+	def deinit(self):
+		_sim.clock.remove_timer(self)
+
+	def value(self):
+		return max(0, self.due_us - _now()) // 1000
+
+	def fire(self):
+		if self.mode == Timer.PERIODIC:
+			self.due_us += self.period_us
+		else:
+			_sim.clock.remove_timer(self)
+		if not (self.callback is None):
+			_sim.call(self.callback, self)
+
+def sleep(ms):
+	_sim.clock.sleep_ms(ms)
+
+def lightsleep(ms=None):
+	if ms is None:
+		_sim.clock.idle()
+	else:
+		_sim.clock.sleep_ms(ms)
+
+def idle():
+	_sim.clock.idle()
+
+def freq(hz=None):
+	if hz is None:
+		return 240000000
+
+def unique_id():
+	return b'\x24\x0a\xc4\x00\x00\x01'
+
+def reset():
+	raise SystemExit("machine.reset()")
+
+def disable_irq():
+	return 0
+
+def enable_irq(state=0):
+	pass
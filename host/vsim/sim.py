@@ -0,0 +1,185 @@
+import array
+import os
+import struct
+import sys
+import time
+import tracemalloc
+import types
+
+from . import clock as _clock
+from . import machine as _machine
+from . import uasyncio as _uasyncio
+from . import _thread as _thr
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'src')
+if SRC_DIR not in sys.path:
+	sys.path.insert(0, SRC_DIR)
+
+# Host-side cost of one callback (timer or pin IRQ). Times are host
+# seconds, not virtual time. Allocations are CPython's: the peak traced
+# size during the call (tracemalloc) and the net change in allocated
+# blocks, i.e. what the callback left behind.
+class CallbackStats:
+	def __init__(self, name):
+		self.name = name
+		self.calls = 0
+		self.total_s = 0.0
+		self.max_s = 0.0
+		self.alloc_peak_max = 0
+		self.alloc_peak_total = 0
+		self.net_blocks = 0
+		self.errors = 0
+		pass
+
+	def as_dict(self):
+		n = max(self.calls, 1)
+		return dict({'name': self.name, 'calls': self.calls, \
+			'mean_us': 1e6 * self.total_s / n, 'max_us': 1e6 * self.max_s, \
+			'alloc_peak_mean': self.alloc_peak_total / float(n), \
+			'alloc_peak_max': self.alloc_peak_max, \
+			'net_blocks_per_call': self.net_blocks / float(n), 'errors': self.errors})
+
+class Sim:
+	def __init__(self, step_us=0, trace_alloc=True, keep_tx=True):
+		self.clock = _clock.VirtualClock(step_us)
+		self.trace_alloc = trace_alloc
+		self.keep_tx = keep_tx
+		self.uart_peers = dict()
+		self.i2c_devices = dict()
+		self.spi_devices = dict()
+		self.uarts = dict()
+		self.pins = dict()
+		self.stats = dict()
+		self.main_globals = None
+		pass
+
+	# --- wiring, before install() ---
+	def attach_uart(self, uart_id, peer):
+		self.uart_peers[uart_id] = peer
+
+	def attach_i2c(self, bus_id, device, addr=0x68):
+		self.i2c_devices.setdefault(bus_id, dict())[addr] = device
+
+	def attach_spi(self, bus_id, device):
+		self.spi_devices[bus_id] = device
+
+	# Registers the fake modules. Must run before any firmware module is
+	# imported; firmware modules already imported are dropped so they bind
+	# to this simulation.
+	def install(self):
+		_machine._sim = self
+		for uart_id, peer in self.uart_peers.items():
+			if hasattr(peer, 'bind'):
+				peer.bind(self, uart_id)
+		_uasyncio._clock = self.clock
+		_uasyncio.new_event_loop()
+		_thr._clock = self.clock
+		_thr._sched = None
+		c = self.clock
+		ut = types.ModuleType('utime')
+		ut.ticks_ms = c.ticks_ms
+		ut.ticks_us = c.ticks_us
+		ut.ticks_cpu = c.ticks_us
+		ut.ticks_add = _clock.ticks_add
+		ut.ticks_diff = _clock.ticks_diff
+		ut.sleep_ms = c.sleep_ms
+		ut.sleep_us = c.sleep_us
+		ut.sleep = lambda s: c.sleep_us(s * 1000000)
+		ut.time = lambda: c.us // 1000000
+		ut.localtime = lambda secs=None: time.gmtime(c.us // 1000000 if secs is None else secs)[0:8]
+		mp = types.ModuleType('micropython')
+		mp.const = lambda x: x
+		mp.schedule = lambda fn, arg: self.call(fn, arg)
+		mp.alloc_emergency_exception_buf = lambda n: None
+		mp.mem_info = lambda *a: None
+		sys.modules['machine'] = _machine
+		sys.modules['utime'] = ut
+		sys.modules['micropython'] = mp
+		sys.modules['ustruct'] = struct
+		sys.modules['uarray'] = array
+		sys.modules['uasyncio'] = _uasyncio
+		sys.modules['_thread'] = _thr
+		# sdcard.py uses the MicroPython flavour of the time module
+		time.sleep_ms = c.sleep_ms
+		time.sleep_us = c.sleep_us
+		for name in os.listdir(SRC_DIR):
+			if name.endswith('.py'):
+				sys.modules.pop(name[:-3], None)
+		if self.trace_alloc and not tracemalloc.is_tracing():
+			tracemalloc.start()
+		pass
+
+	# Runs one callback as the device would, recording its cost. An
+	# exception is printed and counted; the timer keeps running.
+	def call(self, fn, arg):
+		name = getattr(fn, '__qualname__', None) or repr(fn)
+		st = self.stats.get(name)
+		if st is None:
+			st = CallbackStats(name)
+			self.stats[name] = st
+		c = self.clock
+		c.depth += 1
+		tracing = tracemalloc.is_tracing()
+		if tracing:
+			tracemalloc.reset_peak()
+			mem0 = tracemalloc.get_traced_memory()[0]
+		blocks0 = sys.getallocatedblocks()
+		t0 = time.perf_counter()
+		try:
+			fn(arg)
+		except Exception as e:
+			st.errors += 1
+			sys.stderr.write("callback {}: {!r}\n".format(name, e))
+		finally:
+			dt = time.perf_counter() - t0
+			c.depth -= 1
+		st.net_blocks += sys.getallocatedblocks() - blocks0
+		if tracing:
+			peak = tracemalloc.get_traced_memory()[1] - mem0
+			st.alloc_peak_total += peak
+			if peak > st.alloc_peak_max:
+				st.alloc_peak_max = peak
+		st.calls += 1
+		st.total_s += dt
+		if dt > st.max_s:
+			st.max_s = dt
+		pass
+
+	def advance(self, seconds):
+		self.clock.advance(int(seconds * 1000000))
+
+	# Executes main.py (or another script) and then lets the timers run
+	# until `seconds` of virtual time have passed since the call. A script
+	# that loops forever is stopped with KeyboardInterrupt, like Ctrl-C.
+	def run_main(self, seconds, path=None):
+		if path is None:
+			path = os.path.join(SRC_DIR, 'main.py')
+		with open(path) as f:
+			code = compile(f.read(), path, 'exec')
+		g = dict({'__name__': '__main__', '__file__': path})
+		self.main_globals = g
+		c = self.clock
+		c.interrupt_us = c.us + int(seconds * 1000000)
+		try:
+			exec(code, g)
+			c.advance(c.interrupt_us - c.us)
+		except KeyboardInterrupt:
+			pass
+		finally:
+			c.interrupt_us = None
+		return g
+
+	def report(self):
+		lines = ["virtual time {:.3f} s".format(self.clock.us / 1e6)]
+		lines.append("{:32s} {:>7s} {:>9s} {:>9s} {:>10s} {:>10s} {:>7s}".format('callback', \
+			'calls', 'mean us', 'max us', 'alloc B', 'blocks/cb', 'errors'))
+		for name in sorted(self.stats):
+			d = self.stats[name].as_dict()
+			lines.append("{:32s} {:7d} {:9.1f} {:9.1f} {:10.0f} {:10.2f} {:7d}".format(name[-32:], \
+				d['calls'], d['mean_us'], d['max_us'], d['alloc_peak_mean'], \
+				d['net_blocks_per_call'], d['errors']))
+		for k in sorted(self.uarts):
+			u = self.uarts[k]
+			lines.append("UART{} @ {} baud: {} bytes out, {} rx overruns".format(k, u.baudrate, \
+				u.tx_bytes, u.rx_overruns))
+		return '\n'.join(lines)
@@ -0,0 +1,165 @@
+# Minimal uasyncio on the virtual clock: enough of the API for
+# src/vsasync.py (run, create_task, sleep/sleep_ms, Event, StreamReader,
+# Task.cancel). Sim.install() registers it as sys.modules['uasyncio'].
+# Scheduling is deterministic: ready tasks run in wake time order, then
+# creation order; waiting for the next wake time advances the clock,
+# which also fires the machine.Timer callbacks that fall due.
+
+_clock = None # set by Sim.install()
+
+class CancelledError(BaseException):
+	pass
+
+class _Sleep:
+	def __init__(self, us):
+		self.us = us
+
+	def __await__(self):
+		yield self
+
+class _Wait:
+	def __init__(self, ev):
+		self.ev = ev
+
+	def __await__(self):
+		yield self
+
+class Task:
+	def __init__(self, coro, loop):
+		self.coro = coro
+		self.loop = loop
+		self.done = False
+		self.cancelled = False
+		self.waiting = None # Event the task is blocked on
+		self.result = None
+
+	def cancel(self):
+		if self.done:
+			return False
+		self.cancelled = True
+		if not (self.waiting is None):
+			self.waiting.waiters.remove(self)
+			self.waiting = None
+		self.loop._schedule(self, _clock.us)
+		return True
+
+class Event:
+	def __init__(self):
+		self.state = False
+		self.waiters = []
+
+	def is_set(self):
+		return self.state
+
+	def set(self):
+		self.state = True
+		for t in self.waiters:
+			t.waiting = None
+			t.loop._schedule(t, _clock.us)
+		self.waiters = []
+
+	def clear(self):
+		self.state = False
+
+	async def wait(self):
+		if not self.state:
+			await _Wait(self)
+		return True
+
+# Polls the stream every millisecond of virtual time (the real one waits
+# on select/poll).
+class StreamReader:
+	def __init__(self, s):
+		self.s = s
+
+	async def readinto(self, buf):
+		while True:
+			n = self.s.readinto(buf)
+			if n:
+				return n
+			await _Sleep(1000)
+
+	async def read(self, n=-1):
+		while True:
+			d = self.s.read(n)
+			if d:
+				return d
+			await _Sleep(1000)
+
+Stream = StreamReader
+
+class _Loop:
+	def __init__(self):
+		self.queue = [] # (wake_us, seq, task)
+		self.seq = 0
+
+	def _schedule(self, task, wake_us):
+		self.queue = [q for q in self.queue if q[2] is not task]
+		self.seq += 1
+		self.queue.append((wake_us, self.seq, task))
+
+	def create_task(self, coro):
+		t = Task(coro, self)
+		self._schedule(t, _clock.us)
+		return t
+
+	def run_until_complete(self, main):
+		while not main.done:
+			if not self.queue:
+				raise RuntimeError("deadlock: no task can run")
+			self.queue.sort(key=lambda q: (q[0], q[1]))
+			wake, seq, t = self.queue.pop(0)
+			if wake > _clock.us:
+				_clock.advance(wake - _clock.us)
+			self._step(t)
+		if main.cancelled and main.result is None:
+			raise CancelledError()
+		return main.result
+
+	def _step(self, t):
+		try:
+			if t.cancelled:
+				t.cancelled = False
+				req = t.coro.throw(CancelledError())
+			else:
+				req = t.coro.send(None)
+		except StopIteration as e:
+			t.done = True
+			t.result = e.value
+			return
+		except CancelledError:
+			t.done = True
+			t.cancelled = True
+			return
+		if isinstance(req, _Sleep):
+			self._schedule(t, _clock.us + req.us)
+		elif isinstance(req, _Wait):
+			if req.ev.state:
+				self._schedule(t, _clock.us)
+			else:
+				t.waiting = req.ev
+				req.ev.waiters.append(t)
+		else:
+			self._schedule(t, _clock.us)
+
+_loop = _Loop()
+
+def get_event_loop():
+	return _loop
+
+def new_event_loop():
+	global _loop
+	_loop = _Loop()
+	return _loop
+
+def create_task(coro):
+	return _loop.create_task(coro)
+
+def run(coro):
+	return _loop.run_until_complete(_loop.create_task(coro))
+
+async def sleep_ms(ms):
+	await _Sleep(int(ms * 1000))
+
+async def sleep(s):
+	await _Sleep(int(s * 1000000))
@@ -0,0 +1,412 @@
+# Session store on top of the columns of vsconvert.py (one directory per
+# sensor, one .npy per field, append-only), for tools that need a time
+# window of an hour-long session without reading all of it.
+# usage: python3 host/vsstore.py build session_dir
+#        python3 host/vsstore.py info session_dir
+#        python3 host/vsstore.py query session_dir sensor t0 t1 [--utc]
+#
+# Next to the columns of every sensor, refresh() keeps:
+#   _index.npy  sparse time index: for every STORE_INDEX_STRIDE-th row, its
+#               time [ms] (the 't' ticks_ms or 't_us' column, unwrapped)
+#               and its UTC [s of day, continuing past midnight; NaN if
+#               unknown] where the sensor has one (gps, imu_utc, acc_utc)
+#   _pyrL.npy   level L of the plotting pyramid: min/max/mean of every data
+#               field over bins of STORE_PYR_FACTOR**L rows, with the time
+#               of the first row and the row count of the bin
+# Both are extended when the columns grow (append() or a new vsconvert.py
+# output), only from the last complete entry on.
+# Columns and pyramids are opened with np.load(mmap_mode='r'): window()
+# and pyramid() return slices of them, nothing is read until it is used.
+# Times are per clock (ticks_ms 't', or ticks_us 't_us' in ms, which
+# wraps differently): across clocks, query by UTC. A UTC query on a
+# sensor without UTC goes through the time index of one on the same clock
+# that has it (interpolated between index rows, so to within the clock
+# drift over a few seconds).
+# Requires numpy.
+
+import argparse
+import os
+import sys
+
+import numpy as np
+
+from vsconvert import NpyColumn, TicksUnwrap, TICKS_PERIOD
+
+STORE_INDEX_STRIDE = 1024
+STORE_PYR_FACTOR = 16
+STORE_BUILD_ROWS = 1 << 20 # rows read at once by refresh()
+STORE_DAY_S = 86400.0
+STORE_INDEX_DTYPE = np.dtype([('t', '<i8'), ('utc', '<f8')])
+# not data: no pyramid
+STORE_TIME_FIELDS = ('t', 't_us', 'utc_ms', 'utc_us', 'utc_s', 'sync', 'date', 'time_ms', 'src')
+STORE_UTC_INVALID = 0xFFFFFFFF # keep in sync with src/timesync.py
+
+_INDEX = '_index'
+_PYR = '_pyr'
+
+# Time column of a sensor [ms] and its wrap period (None: already unwrapped)
+def _time_of(cols):
+	if 't_us' in cols:
+		return 't_us', 1000, None
+	return 't', 1, TICKS_PERIOD
+
+# UTC [s of day] of rows, NaN where unknown
+def _utc_of(cols, rows):
+	if 'utc_s' in cols: # text ACC lines with UTC
+		v = np.asarray(cols['utc_s'][rows], dtype=np.float64)
+		return np.where(v < 0, np.nan, v)
+	if 'utc_ms' in cols: # imu_utc frames
+		ms = np.asarray(cols['utc_ms'][rows], dtype=np.int64)
+		v = ms / 1000.0 + np.asarray(cols['utc_us'][rows], dtype=np.float64) * 1e-6
+		return np.where(ms == STORE_UTC_INVALID, np.nan, v)
+	if 'time_ms' in cols: # gps
+		ms = np.asarray(cols['time_ms'][rows], dtype=np.int64)
+		return np.where((ms < 0) | (ms == STORE_UTC_INVALID), np.nan, ms / 1000.0)
+	return None
+
+class Sensor:
+	def __init__(self, path):
+		self.path = path
+		self.name = os.path.basename(path)
+		self.cols = dict()
+		self.index = None
+		self.levels = []
+		self.open()
+		pass
+
+	def open(self):
+		self.cols = dict()
+		for fn in sorted(os.listdir(self.path)):
+			if fn.endswith('.npy') and not fn.startswith('_'):
+				self.cols[fn[:-4]] = np.load(os.path.join(self.path, fn), mmap_mode='r')
+		self.rows = min([len(c) for c in self.cols.values()]) if self.cols else 0
+		self.tname, self.tdiv, self.period = _time_of(self.cols)
+		self.fields = [f for f in self.cols if not (f in STORE_TIME_FIELDS)]
+		self.has_utc = not (_utc_of(self.cols, slice(0, 0)) is None)
+		self.index = self._load(_INDEX)
+		self.levels = []
+		while True:
+			p = self._load(_PYR + str(len(self.levels) + 1))
+			if p is None:
+				break
+			self.levels.append(p)
+		pass
+
+	def _file(self, name):
+		return os.path.join(self.path, name + '.npy')
+
+	def _load(self, name):
+		if not os.path.exists(self._file(name)):
+			return None
+		a = np.load(self._file(name), mmap_mode='r')
+		return a if len(a) > 0 else np.zeros(0, dtype=a.dtype)
+
+	def _unwrapper(self):
+		return TicksUnwrap(self.period if not (self.period is None) else 1 << 62)
+
+	def _raw_ms(self, r0, r1):
+		return np.asarray(self.cols[self.tname][r0:r1], dtype=np.int64) // self.tdiv
+
+	# unwrapped times [ms] of rows r0..r1, from the index row before r0
+	def times(self, r0, r1):
+		e = (r0 // STORE_INDEX_STRIDE) * STORE_INDEX_STRIDE
+		raw = self._raw_ms(e, r1)
+		u = self._unwrapper()
+		u.last = int(raw[0])
+		u.acc = int(self.index['t'][e // STORE_INDEX_STRIDE])
+		return u(raw)[r0 - e:]
+
+	# Extends index and pyramids over the rows added since the last call
+	def refresh(self):
+		self.open()
+		if self.rows == 0:
+			return
+		self._refresh_index()
+		self.open()
+		self._refresh_pyramids()
+		self.open()
+		pass
+
+	def _refresh_index(self):
+		n_old = 0 if self.index is None else len(self.index)
+		keep = max(0, n_old - 1) # the last entry is recomputed along the way
+		u = self._unwrapper()
+		last_utc = None
+		if n_old == 0:
+			col = NpyColumn(self._file(_INDEX), STORE_INDEX_DTYPE)
+		else:
+			u.last = int(self._raw_ms(keep * STORE_INDEX_STRIDE, keep * STORE_INDEX_STRIDE + 1)[0])
+			u.acc = int(self.index['t'][keep])
+			utc = np.array(self.index['utc'][:keep])
+			utc = utc[~np.isnan(utc)]
+			if len(utc):
+				last_utc = float(utc[-1])
+			col = NpyColumn(self._file(_INDEX), keep=keep)
+		r = keep * STORE_INDEX_STRIDE
+		while r < self.rows:
+			r1 = min(self.rows, r + STORE_BUILD_ROWS)
+			t = u(self._raw_ms(r, r1))
+			rows = np.arange(r, r1, STORE_INDEX_STRIDE)
+			e = np.zeros(len(rows), dtype=STORE_INDEX_DTYPE)
+			e['t'] = t[rows - r]
+			e['utc'] = np.nan
+			if self.has_utc:
+				utc = _utc_of(self.cols, rows)
+				# continue past midnight
+				for k in range(len(utc)):
+					if np.isnan(utc[k]):
+						continue
+					if not (last_utc is None):
+						utc[k] += STORE_DAY_S * np.round((last_utc - utc[k]) / STORE_DAY_S)
+					last_utc = utc[k]
+				e['utc'] = utc
+			col.append(e)
+			r = r1
+		col.close()
+		pass
+
+	def _dtype_pyr(self):
+		d = [('t', '<i8'), ('n', '<i4')]
+		for f in self.fields:
+			d += [(f + '_min', '<f4'), (f + '_max', '<f4'), (f + '_mean', '<f4')]
+		return np.dtype(d)
+
+	def _refresh_pyramids(self):
+		dt = self._dtype_pyr()
+		F = STORE_PYR_FACTOR
+		level = 1
+		n_src = self.rows
+		while n_src > F:
+			old = self.levels[level - 1] if level <= len(self.levels) else None
+			if old is None or old.dtype != dt:
+				start = 0
+				col = NpyColumn(self._file(_PYR + str(level)), dt)
+			else:
+				start = max(0, len(old) - 1) # the last bin may have grown
+				col = NpyColumn(self._file(_PYR + str(level)), keep=start)
+			for b0 in range(start * F, n_src, STORE_BUILD_ROWS):
+				b1 = min(n_src, b0 + STORE_BUILD_ROWS)
+				if level == 1:
+					col.append(self._bins_rows(b0, b1, dt))
+				else:
+					col.append(self._bins_bins(np.load(self._file(_PYR + str(level - 1)), \
+						mmap_mode='r')[b0:b1], dt))
+			n_src = col.n
+			col.close()
+			level += 1
+		pass
+
+	def _bins_rows(self, r0, r1, dt):
+		starts = np.arange(0, r1 - r0, STORE_PYR_FACTOR)
+		out = np.zeros(len(starts), dtype=dt)
+		out['t'] = self.times(r0, r1)[starts]
+		out['n'] = np.diff(np.append(starts, r1 - r0))
+		for f in self.fields:
+			v = np.asarray(self.cols[f][r0:r1], dtype=np.float64)
+			out[f + '_min'] = np.minimum.reduceat(v, starts)
+			out[f + '_max'] = np.maximum.reduceat(v, starts)
+			out[f + '_mean'] = np.add.reduceat(v, starts) / out['n']
+		return out
+
+	def _bins_bins(self, b, dt):
+		starts = np.arange(0, len(b), STORE_PYR_FACTOR)
+		out = np.zeros(len(starts), dtype=dt)
+		out['t'] = b['t'][starts]
+		out['n'] = np.add.reduceat(b['n'], starts)
+		for f in self.fields:
+			out[f + '_min'] = np.minimum.reduceat(b[f + '_min'], starts)
+			out[f + '_max'] = np.maximum.reduceat(b[f + '_max'], starts)
+			s = np.add.reduceat(b[f + '_mean'].astype(np.float64) * b['n'], starts)
+			out[f + '_mean'] = s / out['n']
+		return out
+
+	# rows [r0, r1) with t0 <= time < t1 [ms]
+	def rows_of(self, t0, t1):
+		return self._row(t0), self._row(t1)
+
+	def _row(self, t):
+		if self.index is None or self.rows == 0:
+			return 0
+		k = int(np.searchsorted(self.index['t'], t, side='right')) - 1
+		if k < 0:
+			return 0
+		r0 = k * STORE_INDEX_STRIDE
+		r1 = min(self.rows, r0 + STORE_INDEX_STRIDE)
+		return r0 + int(np.searchsorted(self.times(r0, r1), t))
+
+	# UTC [s] to time [ms]: the index narrows the rows down, their UTC and
+	# times are interpolated (extrapolated at the nominal rate outside)
+	def utc_to_t(self, utc):
+		if self.index is None or not self.has_utc or self.rows == 0:
+			return None
+		iu = np.asarray(self.index['utc'])
+		ok = np.flatnonzero(~np.isnan(iu))
+		S = STORE_INDEX_STRIDE
+		if len(ok) == 0:
+			r0, r1 = 0, self.rows # UTC known only between index rows, if at all
+		else:
+			k = int(np.searchsorted(iu[ok], utc))
+			r0 = max(0, (ok[max(0, k - 1)] - 1) * S)
+			r1 = min(self.rows, (ok[min(k, len(ok) - 1)] + 2) * S)
+		u = _utc_of(self.cols, slice(r0, r1))
+		valid = ~np.isnan(u)
+		if not np.any(valid):
+			return None
+		u = u[valid]
+		t = self.times(r0, r1)[valid].astype(np.float64)
+		ref = iu[ok[0]] if len(ok) else u[0]
+		u += STORE_DAY_S * np.round((ref - u) / STORE_DAY_S) # same day as the index
+		if utc < u[0]:
+			return t[0] + (utc - u[0]) * 1000.0
+		if utc > u[-1]:
+			return t[-1] + (utc - u[-1]) * 1000.0
+		return float(np.interp(utc, u, t))
+
+	def t_range(self):
+		if self.index is None or self.rows == 0:
+			return (0, 0)
+		return (int(self.index['t'][0]), int(self.times(self.rows - 1, self.rows)[-1]))
+
+	# UTC [s] of the first and last rows having one, None without: the rows
+	# up to the first index entry with UTC and from the last one on
+	def utc_range(self):
+		if self.index is None or not self.has_utc or self.rows == 0:
+			return None
+		iu = np.asarray(self.index['utc'])
+		ok = np.flatnonzero(~np.isnan(iu))
+		S = STORE_INDEX_STRIDE
+		if len(ok) == 0:
+			u = _utc_of(self.cols, slice(0, self.rows))
+			u = u[~np.isnan(u)]
+			if len(u) == 0:
+				return None
+			return (float(u[0]), float(u[-1]))
+		ends = []
+		for r0, r1, ref in ((max(0, (ok[0] - 1) * S), ok[0] * S + 1, iu[ok[0]]), \
+			(ok[-1] * S, self.rows, iu[ok[-1]])):
+			u = _utc_of(self.cols, slice(int(r0), int(r1)))
+			u = u[~np.isnan(u)]
+			u += STORE_DAY_S * np.round((ref - u) / STORE_DAY_S) # same day as the index
+			ends.append(u)
+		return (float(ends[0][0]), float(ends[1][-1]))
+
+class SessionStore:
+	def __init__(self, path):
+		self.path = path
+		self.sensors = dict()
+		self.open()
+		pass
+
+	def open(self):
+		self.sensors = dict()
+		if not os.path.isdir(self.path):
+			return
+		for name in sorted(os.listdir(self.path)):
+			p = os.path.join(self.path, name)
+			if os.path.isdir(p):
+				self.sensors[name] = Sensor(p)
+		pass
+
+	def refresh(self):
+		for s in self.sensors.values():
+			s.refresh()
+		pass
+
+	# Appends rows to a sensor: cols is a list of (field, array) as for
+	# vsconvert.ColumnStore, with the fields the sensor already has.
+	def append(self, sensor, cols):
+		s = self.sensors.get(sensor)
+		d = os.path.join(self.path, sensor)
+		if s is None:
+			os.makedirs(d, exist_ok=True)
+		for name, a in cols:
+			p = os.path.join(d, name + '.npy')
+			c = NpyColumn(p, keep=s.rows) if not (s is None) and name in s.cols else NpyColumn(p, a.dtype)
+			c.append(a)
+			c.close()
+		s = Sensor(d)
+		s.refresh()
+		self.sensors[sensor] = s
+		pass
+
+	# the sensor itself, or one with UTC on the same clock
+	def _sensor_utc(self, sensor):
+		s = self.sensors[sensor]
+		if s.has_utc:
+			return s
+		for o in self.sensors.values():
+			if o.has_utc and o.tname == s.tname:
+				return o
+		return None
+
+	# row range of sensor for [t0, t1) (ms, or s of day UTC with utc)
+	def rows(self, sensor, t0, t1, utc=False):
+		s = self.sensors[sensor]
+		if utc:
+			ref = self._sensor_utc(sensor)
+			if ref is None or ref.utc_to_t(t0) is None:
+				raise ValueError("no UTC for {}".format(sensor))
+			t0, t1 = ref.utc_to_t(t0), ref.utc_to_t(t1)
+		return s.rows_of(t0, t1)
+
+	# {field: memmap slice} of the rows in [t0, t1)
+	def window(self, sensor, t0, t1, fields=None, utc=False):
+		r0, r1 = self.rows(sensor, t0, t1, utc)
+		s = self.sensors[sensor]
+		if fields is None:
+			fields = list(s.cols)
+		return dict([(f, s.cols[f][r0:r1]) for f in fields])
+
+	# (t, min, max, mean) of field over [t0, t1), from the finest pyramid
+	# level with no more than max_points bins (the rows themselves when
+	# they are few enough)
+	def pyramid(self, sensor, field, t0, t1, max_points=2000, utc=False):
+		r0, r1 = self.rows(sensor, t0, t1, utc)
+		s = self.sensors[sensor]
+		if r1 - r0 <= max_points or len(s.levels) == 0:
+			v = s.cols[field][r0:r1]
+			return s.times(r0, r1) if r1 > r0 else np.zeros(0, dtype=np.int64), v, v, v
+		size = STORE_PYR_FACTOR
+		for p in s.levels:
+			b0 = r0 // size
+			b1 = -(-r1 // size)
+			if b1 - b0 <= max_points or p is s.levels[-1]:
+				b = p[b0:min(b1, len(p))]
+				return b['t'], b[field + '_min'], b[field + '_max'], b[field + '_mean']
+			size *= STORE_PYR_FACTOR
+
+def main(argv):
+	ap = argparse.ArgumentParser(description="session store over vsconvert.py columns")
+	ap.add_argument('cmd', choices=('build', 'info', 'query'))
+	ap.add_argument('session_dir')
+	ap.add_argument('sensor', nargs='?')
+	ap.add_argument('t0', nargs='?', type=float)
+	ap.add_argument('t1', nargs='?', type=float)
+	ap.add_argument('--utc', action='store_true', help="t0, t1 in s of day UTC (+86400 past midnight)")
+	args = ap.parse_args(argv[1:])
+	st = SessionStore(args.session_dir)
+	if args.cmd == 'build':
+		st.refresh()
+	if args.cmd in ('build', 'info'):
+		for name, s in st.sensors.items():
+			t0, t1 = s.t_range()
+			utc = ''
+			u = s.utc_range()
+			if not (u is None):
+				utc = ", UTC {:.3f}..{:.3f} s".format(u[0], u[-1])
+			print("{:10s} {:10d} rows, t {}..{} ms{}, {} pyramid levels".format(name, s.rows, \
+				t0, t1, utc, len(s.levels)))
+		return 0
+	if args.sensor is None or args.t1 is None:
+		ap.error("query needs sensor, t0 and t1")
+	w = st.window(args.sensor, args.t0, args.t1, utc=args.utc)
+	r0, r1 = st.rows(args.sensor, args.t0, args.t1, args.utc)
+	print("{}: rows {}..{}".format(args.sensor, r0, r1))
+	for f, v in w.items():
+		if len(v):
+			print("{:10s} min {:14.4f} max {:14.4f} mean {:14.4f}".format(f, float(np.min(v)), \
+				float(np.max(v)), float(np.mean(v))))
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv))
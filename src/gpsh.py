@@ -3,16 +3,44 @@
 
 import machine
 import utime
+from nmea import NmeaParser, NMEA_IDX_RMC, NMEA_IDX_GGA
+from ubx import UbxParser, ubx_cfg_rate, ubx_cfg_msg, ubx_cfg_prt_uart, \
+	UBX_CLS_NAV, UBX_ID_NAV_PVT, UBX_CLS_NMEA, UBX_ACK_NONE, UBX_ACK_ACK
+from vsproto import FrameEncoder, PROTO_MSG_GPS, OUT_MODE_TEXT, OUT_MODE_BIN, \
+	PROTO_U16_INVALID, PROTO_U8_INVALID
+from hotstat import HotStat, HOTSTAT_SRC_GPS
+from gpsrec import GpsRecord, GPSR_T, GPSR_DATE, GPSR_TIME, GPSR_STATUS, GPSR_LAT, GPSR_LON, \
+	GPSR_SPEED, GPSR_COURSE, GPSR_MVAR, GPSR_MODE, GPSR_FIX, GPSR_SATS, GPSR_HDOP, GPSR_ALT, \
+	GPSR_ALT_REF, GPSR_VEL_N, GPSR_VEL_E, GPSR_VEL_D, GPSR_HACC, GPSR_VACC, GPSR_SACC
+from vsfmt import LineFormat, field_prec, VSFMT_INT, VSFMT_FIX, VSFMT_TOD, VSFMT_CHAR
 
 #defines
 GPS_BAUDRATE = 9600
+GPS_TARGET_BAUDRATE = 115200
+GPS_RATE_HZ_DEFAULT = 5
+GPS_ACK_TIMEOUT_MS = 500
+GPS_UBX_RETRIES = 3
+GPS_UART_RXBUF = 1024
 GPS_RX_PIN = 32
 GPS_TX_PIN = 33
 GPS_UART_ID = 2
 GPS_TIMER_ID = 1
 GPS_ENABLED_SENTENCES = 2
+GPS_RXBUF_SIZE = 256
 
-#ublox-specific strings
+#input protocol
+GPS_PROTO_NMEA = 0
+GPS_PROTO_UBX = 1
+
+#NMEA message ids (UBX class 0xF0)
+GPS_NMEA_GGA = 0x00
+GPS_NMEA_GLL = 0x01
+GPS_NMEA_GSA = 0x02
+GPS_NMEA_GSV = 0x03
+GPS_NMEA_RMC = 0x04
+GPS_NMEA_VTG = 0x05
+
+#ublox-specific strings (canned frames, see ubx.ubx_build for arbitrary ones)
 GPS_CMD_UBLOX_SETFREQ_5HZ  = bytes([0xB5, 0x62, 0x06, 0x08, 0x06, 0x00, 0xC8, 0x00, 0x01, 0x00, 0x01, 0x00, 0xDE, 0x6A])
 GPS_CMD_UBLOX_SETFREQ_10HZ = bytes([0xB5, 0x62, 0x06, 0x08, 0x06, 0x00, 0x64, 0x00, 0x01, 0x00, 0x01, 0x00, 0x7A, 0x12])
 GPS_CMD_UBLOX_DISABLE_VTG = bytes([0xB5, 0x62, 0x06, 0x01, 0x08, 0x00, 0xF0, 0x05, 0x00, 0x00, 0x00, 0x00, 0x00, 0x01, 0x05, 0x47])
@@ -20,103 +48,305 @@ GPS_CMD_UBLOX_DISABLE_GGA = bytes([0xB5, 0x62, 0x06, 0x01, 0x08, 0x00, 0xF0, 0x0
 GPS_CMD_UBLOX_DISABLE_GLL = bytes([0xB5, 0x62, 0x06, 0x01, 0x08, 0x00, 0xF0, 0x01, 0x00, 0x00, 0x00, 0x00, 0x00, 0x01, 0x01, 0x2B])
 GPS_CMD_UBLOX_DISABLE_GSA = bytes([0xB5, 0x62, 0x06, 0x01, 0x08, 0x00, 0xF0, 0x02, 0x00, 0x00, 0x00, 0x00, 0x00, 0x01, 0x02, 0x32])
 GPS_CMD_UBLOX_DISABLE_GSV = bytes([0xB5, 0x62, 0x06, 0x01, 0x08, 0x00, 0xF0, 0x03, 0x00, 0x00, 0x00, 0x00, 0x00, 0x01, 0x03, 0x39])
+GPS_CMD_UBLOX_DISABLE_RMC = bytes([0xB5, 0x62, 0x06, 0x01, 0x08, 0x00, 0xF0, 0x04, 0x00, 0x00, 0x00, 0x00, 0x00, 0x01, 0x04, 0x40])
+GPS_CMD_UBLOX_ENABLE_NAVPVT = bytes([0xB5, 0x62, 0x06, 0x01, 0x03, 0x00, 0x01, 0x07, 0x01, 0x13, 0x51])
 
-#empty dict containing general positioning info
+#empty dict containing general positioning info (the keys of the
+#compatibility view of gpsrec.GpsRecord)
 GPS_POS_DICT = dict({'t': 0.0, 'UtcTime': "000000.00", 'Status': 'N', 'Latitude': 100.0, \
 	'Longitude': 190.0, 'SpeedKts': -1.0, 'CourseDeg': -1.0, 'UtcDate': "000000", \
 	'MVar': 0.0, 'Mode': 'N', 'FixStatus': -1, 'NoSats': -1, 'HDOP': 100.0, \
-	'Alt': -1.0, 'AltRef': -1.0, 'DiffAge': 0.0, 'DGPStation': 0.0})
+	'Alt': -1.0, 'AltRef': -1.0, 'DiffAge': 0.0, 'DGPStation': 0.0, \
+	'VelN': 0.0, 'VelE': 0.0, 'VelD': 0.0, 'HAcc': -1.0, 'VAcc': -1.0, 'SAcc': -1.0})
+
+#text output (vsfmt.py): field -> (kind, GpsRecord index, digits of the
+#date / decimals in the record, default printed decimals)
+GPS_TEXT_SPEC = dict({'UtcDate': (VSFMT_INT, GPSR_DATE, 6, 0), 'UtcTime': (VSFMT_TOD, GPSR_TIME, 0, 2), \
+	'Status': (VSFMT_CHAR, GPSR_STATUS, 0, 0), 'Latitude': (VSFMT_FIX, GPSR_LAT, 7, 6), \
+	'Longitude': (VSFMT_FIX, GPSR_LON, 7, 6), 'SpeedKts': (VSFMT_FIX, GPSR_SPEED, 3, 2), \
+	'CourseDeg': (VSFMT_FIX, GPSR_COURSE, 2, 2), 'MVar': (VSFMT_FIX, GPSR_MVAR, 2, 2), \
+	'Mode': (VSFMT_CHAR, GPSR_MODE, 0, 0), 'FixStatus': (VSFMT_INT, GPSR_FIX, 0, 0), \
+	'NoSats': (VSFMT_INT, GPSR_SATS, 0, 0), 'HDOP': (VSFMT_FIX, GPSR_HDOP, 2, 2), \
+	'Alt': (VSFMT_FIX, GPSR_ALT, 2, 2), 'AltRef': (VSFMT_FIX, GPSR_ALT_REF, 2, 2), \
+	'VelN': (VSFMT_FIX, GPSR_VEL_N, 3, 3), 'VelE': (VSFMT_FIX, GPSR_VEL_E, 3, 3), \
+	'VelD': (VSFMT_FIX, GPSR_VEL_D, 3, 3), 'HAcc': (VSFMT_FIX, GPSR_HACC, 3, 3), \
+	'VAcc': (VSFMT_FIX, GPSR_VACC, 3, 3), 'SAcc': (VSFMT_FIX, GPSR_SACC, 3, 3)})
+#fields of the GPS text line, in order
+GPS_TEXT_FIELDS = ('UtcDate', 'UtcTime', 'Latitude', 'Longitude', 'Alt', 'SpeedKts', 'CourseDeg', \
+	'HDOP', 'NoSats')
 
 class UartGps:
 	def __init__(self, uart_id = GPS_UART_ID, rx_pin = GPS_RX_PIN, \
 	tx_pin = GPS_TX_PIN, baudrate = GPS_BAUDRATE, autostart = False, \
-	uardu=None, raw_print=False):
+	uardu=None, raw_print=False, out_mode=OUT_MODE_TEXT, protocol=GPS_PROTO_NMEA, \
+	target_baudrate=GPS_TARGET_BAUDRATE, rate_hz=GPS_RATE_HZ_DEFAULT):
 		self.uart_id = uart_id
 		self.rx_pin = rx_pin
 		self.tx_pin = tx_pin
 		self.baudrate = baudrate
+		self.target_baudrate = target_baudrate
+		self.rate_hz = rate_hz
 		self.uardu = uardu
 		self.uart = machine.UART(self.uart_id, tx=self.tx_pin,rx=self.rx_pin)
 		self.uart_initialized = False
 		self.raw_print = raw_print
+		self.out_mode = out_mode
+		self.frame_enc = FrameEncoder(PROTO_MSG_GPS)
+		self.set_text_format()
+		self.sdlog = None # optional sdlog.SdLogger receiving every frame
+		self.txpolicy = None # optional txpolicy.TxPolicy filtering the Uarduino output
+		self.hotstat = None # callback statistics, see enable_hotstat()
+		self.timesync = None # optional timesync.TimeSync, fed with every fix
+		self.fix_seen = 0
 		self.timer = machine.Timer(GPS_TIMER_ID)
+		self.timer_on = False
 		self.paused = False
-		self.pos_dict = GPS_POS_DICT.copy()
+		self.pos = GpsRecord() # fixed-point fields, see gpsrec.py
+		self.pos_dict = self.pos # old name: pos_dict['Latitude'] etc. still work
+		self.rxbuf = bytearray(GPS_RXBUF_SIZE)
+		self.protocol = protocol
+		if protocol == GPS_PROTO_UBX:
+			self.parser = UbxParser(self.pos)
+		else:
+			self.parser = NmeaParser(self.pos)
+		# ACK/NAK listener used while configuring the receiver
+		if protocol == GPS_PROTO_UBX:
+			self.ubx = self.parser
+		else:
+			self.ubx = UbxParser(self.pos)
 		if autostart:
 			self.start()
 		pass
 	
 	def start(self):
+		self.configure()
+		self._start_timer()
+		pass
+	
+	# UART and receiver setup, without the timer (used by vsasync.py)
+	def configure(self):
 		self._initialize_uart()
-		self._disable_sentences()
-		self._set_freq(5)
-		self.timer.init(period=200, callback=self._timed_cb)
+		if self.target_baudrate and self.target_baudrate != self.baudrate:
+			self._set_baudrate(self.target_baudrate)
+		if self.protocol == GPS_PROTO_UBX:
+			self._enable_ubx_pvt()
+		else:
+			self._disable_sentences()
+		self._set_freq(self.rate_hz)
 		pass
 	
 	def pause(self):
 		if self.paused:
-			self.timer.init(period=200, callback=self._timed_cb)
+			self._start_timer()
 			self.paused = False
 		else:
 			self.timer.deinit()
+			self.timer_on = False
 			self.paused = True
 		pass
 	
 	def stop(self):
 		self.timer.deinit()
+		self.timer_on = False
 		self._deinitialize_uart()
 		pass
 	
+	def _start_timer(self):
+		period = 1000 // self.rate_hz
+		cb = self._timed_cb
+		if not (self.hotstat is None):
+			self.hotstat.period_us = period * 1000
+			cb = self.hotstat.wrap(cb)
+		self.timer.init(period=period, callback=cb)
+		self.timer_on = True
+		pass
+	
+	# Turns the callback statistics (hotstat.py) on or off, also while
+	# running. Off, the timer calls the bare callback.
+	def enable_hotstat(self, on=True):
+		if on and self.hotstat is None:
+			self.hotstat = HotStat(HOTSTAT_SRC_GPS, 1000 // self.rate_hz)
+		elif not on:
+			self.hotstat = None
+		if self.timer_on:
+			self._start_timer()
+		pass
+	
 	def _timed_cb(self, t_obj):
-		for i in range(GPS_ENABLED_SENTENCES):
-			rln = str(self._non_blocking_readln())[2:-5]
-			parse_nmea_sentence(rln, self.pos_dict)
-			#print(self.pos_dict)
-		self.pos_dict['t'] = utime.ticks_ms()
-		self._print_on_repl()
+		t_ms = utime.ticks_ms()
+		t_us = utime.ticks_us()
+		self._read_and_parse()
+		c = self.fix_count()
+		if c != self.fix_seen:
+			self.fix_seen = c
+			self._on_fix(t_ms, t_us)
+		self._output()
+		pass
+	
+	# Stamps a new fix with the time its bytes were read (not the time it
+	# was parsed) and hands it to the time reference, if any.
+	def _on_fix(self, t_ms, t_us):
+		v = self.pos.v
+		v[GPSR_T] = t_ms
+		if not (self.timesync is None):
+			self.timesync.on_fix(t_us, v[GPSR_TIME])
+		pass
+	
+	def _output(self):
+		if self.out_mode == OUT_MODE_BIN:
+			self._send_frame()
+		else:
+			f = None
+			if not (self.sdlog is None and self.txpolicy is None):
+				f = self._encode_frame()
+			if self.txpolicy is None or not (self.txpolicy.filter(f, False) is None):
+				self._print_on_repl()
+			if not (self.sdlog is None):
+				self.sdlog.log(f)
+		pass
+	
+	# sends the current position as a binary frame (see vsproto.py)
+	def _send_frame(self):
+		f = self._encode_frame()
+		if not (self.sdlog is None):
+			self.sdlog.log(f)
+		if not (self.txpolicy is None):
+			f = self.txpolicy.filter(f)
+		if not (self.uardu is None or f is None):
+			self.uardu.send_bytes(f)
+		pass
+	
+	def _encode_frame(self):
+		v = self.pos.v
+		return self.frame_enc.encode(v[GPSR_T] & 0xFFFFFFFF, v[GPSR_DATE], v[GPSR_TIME], \
+			v[GPSR_LAT], v[GPSR_LON], v[GPSR_ALT], _to_u16(v[GPSR_SPEED], 10), \
+			_to_u16(v[GPSR_COURSE], 1), _to_u16(v[GPSR_HDOP], 1), _to_u8(v[GPSR_SATS]))
+	
+	# Compiles the text line: fields are GPS_TEXT_SPEC names, prec the
+	# printed decimals, one for all or a dict per field (default: the
+	# GPS_TEXT_SPEC ones).
+	def set_text_format(self, fields=GPS_TEXT_FIELDS, prec=None):
+		spec = []
+		for name in fields:
+			kind, index, arg, p = GPS_TEXT_SPEC[name]
+			spec.append((kind, index, arg, field_prec(prec, name, p)))
+		self.text_fmt = LineFormat(b'GPS', spec)
 		pass
 	
-	# prints contents of position dict on REPL
+	# prints the current position on REPL (and sends it to the Arduino)
 	def _print_on_repl(self):
 		#s2send = "{t:.1f}\tGPS\t{UtcDate:s},{UtcTime:s},{Latitude:.10f},{Longitude:.10f},{Alt:.4f},{SpeedKts:.4f},{CourseDeg:.4f},{HDOP:.2f},{NoSats:d}".format(**self.pos_dict)
-		s2send = "{t:.1f}\tGPS\t{UtcDate:s},{UtcTime:s},{Latitude:.6f},{Longitude:.6f},{Alt:.2f},{SpeedKts:.2f},{CourseDeg:.2f},{HDOP:.2f},{NoSats:d}".format(**self.pos_dict)
+		f = self.text_fmt
+		v = self.pos.v
+		n = f.render(v[GPSR_T], v)
 		if self.raw_print:
-			print(s2send)
+			print(f.text(n))
 		if not (self.uardu is None):
-			self.uardu.send_str(s2send)
+			self.uardu.send_line(f.line(n))
 		pass
 
-	def _initialize_uart(self):
-		self.uart.init(baudrate=self.baudrate,bits=8,parity=None,stop=1,tx=self.tx_pin,rx=self.rx_pin,timeout=0) #no timeout to try avoid locking.
+	def _initialize_uart(self, baudrate=None):
+		if baudrate is None:
+			baudrate = self.baudrate
+		self.uart.init(baudrate=baudrate,bits=8,parity=None,stop=1,tx=self.tx_pin,rx=self.rx_pin,timeout=0, \
+			rxbuf=GPS_UART_RXBUF) #no timeout to try avoid locking.
 		self.uart_initialized = True
 		pass
 	
-	#TODO: Check if writing operations succeeded.
+	# Sends a UBX frame and waits for the matching ACK-ACK/ACK-NAK.
+	# Returns True only on ACK; NAK is not retried, a timeout is.
+	def _send_ubx(self, frame, retries=GPS_UBX_RETRIES, timeout_ms=GPS_ACK_TIMEOUT_MS):
+		cls = frame[2]
+		mid = frame[3]
+		for attempt in range(retries):
+			self.ubx.ack_result = UBX_ACK_NONE
+			self.uart.write(frame)
+			res = self._wait_ack(cls, mid, timeout_ms)
+			if res != UBX_ACK_NONE:
+				return res == UBX_ACK_ACK
+		return False
+	
+	def _wait_ack(self, cls, mid, timeout_ms):
+		t0 = utime.ticks_ms()
+		u = self.ubx
+		while utime.ticks_diff(utime.ticks_ms(), t0) < timeout_ms:
+			n = self.uart.readinto(self.rxbuf)
+			if n:
+				u.feed(self.rxbuf, n)
+				if u.ack_result != UBX_ACK_NONE and u.ack_cls == cls and u.ack_id == mid:
+					return u.ack_result
+			else:
+				utime.sleep_ms(5)
+		return UBX_ACK_NONE
+	
 	def _disable_sentences(self):
 		print("Disabling undesired sentences.")
 		error_state = False
-		nw = self.uart.write(GPS_CMD_UBLOX_DISABLE_VTG)
-		#nw = self.uart.write(GPS_CMD_UBLOX_DISABLE_GGA)
-		nw = self.uart.write(GPS_CMD_UBLOX_DISABLE_GLL)
-		nw = self.uart.write(GPS_CMD_UBLOX_DISABLE_GSV)
-		nw = self.uart.write(GPS_CMD_UBLOX_DISABLE_GSA)
+		for mid in (GPS_NMEA_VTG, GPS_NMEA_GLL, GPS_NMEA_GSV, GPS_NMEA_GSA):
+			if not self._send_ubx(ubx_cfg_msg(UBX_CLS_NMEA, mid, 0)):
+				error_state = True
 		if not error_state:
 			print("Success!")
 		else:
 			print("Error!")
-		pass
+		return not error_state
 		
+	# UBX mode: every NMEA sentence off, NAV-PVT on (one message per fix)
+	def _enable_ubx_pvt(self):
+		print("Switching to UBX NAV-PVT.")
+		error_state = False
+		for mid in (GPS_NMEA_VTG, GPS_NMEA_GLL, GPS_NMEA_GSV, GPS_NMEA_GSA, \
+			GPS_NMEA_GGA, GPS_NMEA_RMC):
+			if not self._send_ubx(ubx_cfg_msg(UBX_CLS_NMEA, mid, 0)):
+				error_state = True
+		if not self._send_ubx(ubx_cfg_msg(UBX_CLS_NAV, UBX_ID_NAV_PVT, 1)):
+			error_state = True
+		if not error_state:
+			print("Success!")
+		else:
+			print("Error!")
+		return not error_state
+	
 	def _set_freq(self, hzv = 5):
 		print("Setting frequency to " + str(hzv) + "Hz...")
-		if (hzv == 5):
-			nw = self.uart.write(GPS_CMD_UBLOX_SETFREQ_5HZ)
+		if hzv <= 0 or hzv > 25:
+			print("Fail: unsupported frequency!")
+			return False
+		if self._send_ubx(ubx_cfg_rate(1000 // hzv)):
+			self.rate_hz = hzv
 			print("OK")
-		elif (hzv == 10):
-			nw = self.uart.write(GPS_CMD_UBLOX_SETFREQ_10HZ)
+			return True
+		print("Fail: no ACK!")
+		return False
+	
+	# harmless command used to check that both ends talk at the same speed
+	def _probe(self):
+		return self._send_ubx(ubx_cfg_rate(1000 // self.rate_hz), retries=1)
+	
+	# Moves receiver and ESP32 UART to `baudrate`. The receiver may already
+	# be there (ESP32 reset while the GPS stayed powered), so that is tried
+	# first. The CFG-PRT ACK is usually lost in the switch, so the new speed
+	# is verified with a probe; on failure the old speed is restored.
+	def _set_baudrate(self, baudrate):
+		print("Setting GPS baudrate to " + str(baudrate) + "...")
+		old = self.baudrate
+		if not self._probe():
+			self._initialize_uart(baudrate)
+			if self._probe():
+				self.baudrate = baudrate
+				print("OK (already set)")
+				return True
+			self._initialize_uart(old)
+		self.uart.write(ubx_cfg_prt_uart(baudrate))
+		utime.sleep_ms(100) # let the frame leave before switching
+		self._initialize_uart(baudrate)
+		if self._probe():
+			self.baudrate = baudrate
 			print("OK")
-		else:
-			print("Fail: unsupported frequency!")
-		pass
+			return True
+		self._initialize_uart(old)
+		print("Fail: staying at " + str(old))
+		return False
 	
 	def _deinitialize_uart(self):
 		self.uart.deinit()
@@ -139,6 +369,32 @@ class UartGps:
 		else:
 			return None
 	
+	# completed fixes so far: NAV-PVT frames, or GGA (RMC without GGA);
+	# used by the runtimes that output on arrival rather than on a timer
+	def fix_count(self):
+		p = self.parser
+		if self.protocol == GPS_PROTO_UBX:
+			return p.pvt_count
+		n = p.good[NMEA_IDX_GGA]
+		if n == 0:
+			n = p.good[NMEA_IDX_RMC]
+		return n
+	
+	# hands everything waiting in the UART to the streaming parser;
+	# partial sentences are kept by the parser until the next call.
+	def _read_and_parse(self):
+		if not self.uart_initialized:
+			return 0
+		parsed = 0
+		while True:
+			n = self.uart.readinto(self.rxbuf)
+			if not n:
+				break
+			parsed += self.parser.feed(self.rxbuf, n)
+			if n < GPS_RXBUF_SIZE:
+				break
+		return parsed
+	
 	def _non_blocking_read(self):
 		n_avail = self.uart.any()
 		if n_avail > 0:
@@ -146,15 +402,29 @@ class UartGps:
 		else:
 			return None
 
+# fixed-point record field -> u16 frame field (v / div, rounded)
+def _to_u16(v, div):
+	if v < 0:
+		return PROTO_U16_INVALID
+	v = (v + div // 2) // div
+	if v >= PROTO_U16_INVALID:
+		return PROTO_U16_INVALID - 1
+	return v
+
+def _to_u8(v):
+	if v < 0 or v >= PROTO_U8_INVALID:
+		return PROTO_U8_INVALID
+	return v
+
 # For now, it only supports GPRMC and GPGGA				 
 def parse_nmea_sentence(line_in, pd):
 	list_in = line_in.replace('*', ',').split(',')
 	if list_in[0][3:] == "RMC":
 		pd['UtcTime'] = list_in[1]
 		if list_in[2] == 'A':
-			pd['Active'] = 'A'
+			pd['Status'] = 'A'
 		else:
-			pd['Active'] = 'V'
+			pd['Status'] = 'V'
 		if len(list_in[3]) > 2:
 			lat = float(list_in[3][0:2]) + float(list_in[3][2:]) / 60.0
 			if list_in[4] == 'N':
@@ -0,0 +1,117 @@
+# Fixed-point GPS position record (UartGps.pos): one preallocated
+# array('i'), written in place by the parsers (nmea.py, ubx.py) and read
+# by the frame encoder and the text output, so that a fix allocates no
+# floats or strings. The GPS_POS_DICT keys are still readable (and
+# writable) through rec['Latitude'] etc. or as_dict(), in their old types:
+# that view allocates, it is only there for compatibility.
+
+from array import array
+
+# field indices and units
+GPSR_T = 0 # ticks_ms at which the fix was read
+GPSR_DATE = 1 # UTC date, ddmmyy as an integer
+GPSR_TIME = 2 # UTC time [ms of day]
+GPSR_STATUS = 3 # 'A'/'V'/'N', as a char code
+GPSR_LAT = 4 # [1e-7 deg]
+GPSR_LON = 5 # [1e-7 deg]
+GPSR_SPEED = 6 # [1e-3 kts]
+GPSR_COURSE = 7 # [1e-2 deg]
+GPSR_MVAR = 8 # magnetic variation [1e-2 deg]
+GPSR_MODE = 9 # char code
+GPSR_FIX = 10 # GGA fix status
+GPSR_SATS = 11
+GPSR_HDOP = 12 # [1e-2]
+GPSR_ALT = 13 # above MSL [cm]
+GPSR_ALT_REF = 14 # geoid separation [cm]
+GPSR_VEL_N = 15 # [mm/s] (UBX only)
+GPSR_VEL_E = 16
+GPSR_VEL_D = 17
+GPSR_HACC = 18 # [mm] (UBX only)
+GPSR_VACC = 19
+GPSR_SACC = 20 # [mm/s]
+GPSR_N = 21
+
+# "unknown" values, the GPS_POS_DICT defaults in fixed point
+GPSR_LAT_INVALID = 1000000000 # 100.0 deg
+GPSR_LON_INVALID = 1900000000 # 190.0 deg
+GPSR_DEFAULTS = (0, 0, 0, 78, GPSR_LAT_INVALID, GPSR_LON_INVALID, -1000, -100, 0, 78, -1, -1, \
+	10000, -100, -100, 0, 0, 0, -1000, -1000, -1000)
+
+# GPS_POS_DICT key -> (index, scale: the key's value times scale is the
+# stored one; 0 for the fields kept as text)
+_KEYS = dict({'t': (GPSR_T, 1), 'UtcTime': (GPSR_TIME, 0), 'Status': (GPSR_STATUS, 0), \
+	'Latitude': (GPSR_LAT, 10000000), 'Longitude': (GPSR_LON, 10000000), \
+	'SpeedKts': (GPSR_SPEED, 1000), 'CourseDeg': (GPSR_COURSE, 100), 'UtcDate': (GPSR_DATE, 0), \
+	'MVar': (GPSR_MVAR, 100), 'Mode': (GPSR_MODE, 0), 'FixStatus': (GPSR_FIX, 1), \
+	'NoSats': (GPSR_SATS, 1), 'HDOP': (GPSR_HDOP, 100), 'Alt': (GPSR_ALT, 100), \
+	'AltRef': (GPSR_ALT_REF, 100), 'VelN': (GPSR_VEL_N, 1000), 'VelE': (GPSR_VEL_E, 1000), \
+	'VelD': (GPSR_VEL_D, 1000), 'HAcc': (GPSR_HACC, 1000), 'VAcc': (GPSR_VACC, 1000), \
+	'SAcc': (GPSR_SACC, 1000)})
+# never filled in by the parsers
+_CONST_KEYS = dict({'DiffAge': 0.0, 'DGPStation': 0.0})
+
+# "hhmmss.ss" -> ms of day, 0 if it does not parse
+def nmea_time_to_ms(s):
+	if len(s) < 6:
+		return 0
+	try:
+		return ((int(s[0:2]) * 60 + int(s[2:4])) * 60) * 1000 + int(float(s[4:]) * 1000.0 + 0.5)
+	except ValueError:
+		return 0
+
+def ms_to_nmea_time(ms):
+	return "{:02d}{:02d}{:02d}.{:02d}".format(ms // 3600000, (ms // 60000) % 60, \
+		(ms // 1000) % 60, (ms % 1000) // 10)
+
+class GpsRecord:
+	def __init__(self):
+		self.v = array('i', GPSR_DEFAULTS)
+		pass
+
+	def reset(self):
+		v = self.v
+		for i in range(GPSR_N):
+			v[i] = GPSR_DEFAULTS[i]
+		pass
+
+	def __getitem__(self, key):
+		if key in _CONST_KEYS:
+			return _CONST_KEYS[key]
+		i, scale = _KEYS[key]
+		x = self.v[i]
+		if scale == 1:
+			return x
+		if scale > 1:
+			return x / scale
+		if i == GPSR_TIME:
+			return ms_to_nmea_time(x)
+		if i == GPSR_DATE:
+			return "{:06d}".format(x)
+		return chr(x)
+
+	def __setitem__(self, key, value):
+		if key in _CONST_KEYS:
+			return
+		i, scale = _KEYS[key]
+		if scale == 1:
+			self.v[i] = int(value)
+		elif scale > 1:
+			x = value * scale
+			self.v[i] = int(x + 0.5) if x >= 0 else -int(0.5 - x)
+		elif i == GPSR_TIME:
+			self.v[i] = nmea_time_to_ms(value)
+		elif i == GPSR_DATE:
+			try:
+				self.v[i] = int(value)
+			except ValueError:
+				self.v[i] = 0
+		else:
+			self.v[i] = ord(value[0]) if len(value) > 0 else GPSR_DEFAULTS[i]
+
+	def as_dict(self):
+		d = dict()
+		for key in _KEYS:
+			d[key] = self[key]
+		for key in _CONST_KEYS:
+			d[key] = _CONST_KEYS[key]
+		return d
@@ -0,0 +1,178 @@
+# Lightweight timing statistics for the timer callbacks.
+# A HotStat wraps a callback and records, with ticks_us:
+#   - execution time, into a preallocated histogram of HOTSTAT_BINS bins
+#   - interval between calls: jitter against the nominal period, lateness
+#     and whole periods missed (callback started more than 1.5 periods late)
+#   - overruns (execution longer than the period)
+#   - the gc.mem_free() low watermark, sampled every HOTSTAT_MEM_EVERY calls
+# Counters cover the window since the last reset(); HotReport sends them
+# periodically over the Uarduino link and starts a new window.
+# When a handler's statistics are off the timer runs the bare callback,
+# so there is no cost at all.
+
+import gc
+import machine
+import utime
+from array import array
+from ustruct import pack_into
+from vsproto import FrameEncoder, PROTO_MSG_STATUS, PROTO_FMT_STATUS, PROTO_HEADER_LEN, \
+	OUT_MODE_TEXT, OUT_MODE_BIN
+
+HOTSTAT_BINS = 8
+HOTSTAT_BIN_US = 500
+HOTSTAT_MEM_EVERY = 16
+HOTSTAT_REPORT_MS = 5000
+HOTSTAT_TIMER_ID = 2
+
+HOTSTAT_SRC_IMU = 0
+HOTSTAT_SRC_GPS = 1
+HOTSTAT_SRC_NAMES = ('IMU', 'GPS')
+
+HOTSTAT_MEM_UNKNOWN = 0xFFFFFFFF
+
+_mem_free = getattr(gc, 'mem_free', None) # MicroPython only
+
+def _sat16(v):
+	if v > 0xFFFF:
+		return 0xFFFF
+	return v
+
+class HotStat:
+	def __init__(self, src, period_ms, bin_us=HOTSTAT_BIN_US):
+		self.src = src
+		self.period_us = period_ms * 1000
+		self.bin_us = bin_us
+		self.hist = array('I', [0] * HOTSTAT_BINS)
+		self.t_last = 0
+		self.started = False
+		self.reset()
+		pass
+
+	def reset(self):
+		for k in range(HOTSTAT_BINS):
+			self.hist[k] = 0
+		self.calls = 0
+		self.exec_sum = 0
+		self.exec_max = 0
+		self.overruns = 0
+		self.missed = 0
+		self.jitter_max = 0
+		self.late_max = 0
+		self.mem_min = HOTSTAT_MEM_UNKNOWN
+		pass
+
+	# returns the callback to hand to the timer
+	def wrap(self, fn):
+		def cb(t_obj):
+			t0 = utime.ticks_us()
+			self._begin(t0)
+			fn(t_obj)
+			self._end(t0)
+		return cb
+
+	def _begin(self, t0):
+		if self.started:
+			p = self.period_us
+			dt = utime.ticks_diff(t0, self.t_last)
+			j = dt - p
+			if j > 0:
+				if j > self.late_max:
+					self.late_max = j
+				if dt >= p + (p >> 1):
+					self.missed += (dt + (p >> 1)) // p - 1
+			else:
+				j = -j
+			if j > self.jitter_max:
+				self.jitter_max = j
+		self.t_last = t0
+		self.started = True
+		pass
+
+	def _end(self, t0):
+		dt = utime.ticks_diff(utime.ticks_us(), t0)
+		self.calls += 1
+		self.exec_sum += dt
+		if dt > self.exec_max:
+			self.exec_max = dt
+		if dt > self.period_us:
+			self.overruns += 1
+		k = dt // self.bin_us
+		if k >= HOTSTAT_BINS:
+			k = HOTSTAT_BINS - 1
+		self.hist[k] += 1
+		if not (_mem_free is None) and self.calls % HOTSTAT_MEM_EVERY == 0:
+			m = _mem_free()
+			if m < self.mem_min:
+				self.mem_min = m
+		pass
+
+	def exec_mean(self):
+		if self.calls == 0:
+			return 0
+		return self.exec_sum // self.calls
+
+# Sends one status message per handler (I2cAcc, UartGps, ... anything with
+# a `hotstat` attribute) every period_ms, from its own timer.
+class HotReport:
+	def __init__(self, uardu, owners, period_ms=HOTSTAT_REPORT_MS, out_mode=OUT_MODE_TEXT, \
+		timer_id=HOTSTAT_TIMER_ID):
+		self.uardu = uardu
+		self.owners = owners
+		self.period_ms = period_ms
+		self.out_mode = out_mode
+		self.frame_enc = FrameEncoder(PROTO_MSG_STATUS)
+		self.sdlog = None # optional sdlog.SdLogger receiving every frame
+		self.timer = machine.Timer(timer_id)
+		pass
+
+	def start(self):
+		self.timer.init(period=self.period_ms, callback=self._timed_cb)
+		pass
+
+	def stop(self):
+		self.timer.deinit()
+		pass
+
+	def _timed_cb(self, t_obj):
+		self.report()
+		pass
+
+	def report(self):
+		t = utime.ticks_ms()
+		for o in self.owners:
+			hs = o.hotstat
+			if hs is None:
+				continue
+			if self.out_mode == OUT_MODE_BIN:
+				f = self._encode_frame(hs, t)
+				if not (self.uardu is None):
+					self.uardu.send_bytes(f)
+				if not (self.sdlog is None):
+					self.sdlog.log(f)
+			else:
+				if not (self.uardu is None):
+					self.uardu.send_str(self._to_text(hs, t))
+				if not (self.sdlog is None):
+					self.sdlog.log(self._encode_frame(hs, t))
+			hs.reset()
+		pass
+
+	def _encode_frame(self, hs, t):
+		h = hs.hist
+		pack_into(PROTO_FMT_STATUS, self.frame_enc.frame, PROTO_HEADER_LEN, t & 0xFFFFFFFF, \
+			hs.src, _sat16(hs.bin_us), hs.calls, _sat16(hs.exec_mean()), _sat16(hs.exec_max), \
+			_sat16(hs.overruns), _sat16(hs.missed), _sat16(hs.jitter_max), _sat16(hs.late_max), \
+			hs.mem_min, _sat16(h[0]), _sat16(h[1]), _sat16(h[2]), _sat16(h[3]), \
+			_sat16(h[4]), _sat16(h[5]), _sat16(h[6]), _sat16(h[7]))
+		return self.frame_enc.finalize()
+
+	# same fields as the binary frame; the histogram is '/' separated
+	def _to_text(self, hs, t):
+		if hs.src < len(HOTSTAT_SRC_NAMES):
+			name = HOTSTAT_SRC_NAMES[hs.src]
+		else:
+			name = str(hs.src)
+		mem = -1 if hs.mem_min == HOTSTAT_MEM_UNKNOWN else hs.mem_min
+		return "{:.1f}\tSTA\t{:s},{:d},{:d},{:d},{:d},{:d},{:d},{:d},{:d},{:d},{:s}".format(t, \
+			name, hs.bin_us, hs.calls, hs.exec_mean(), hs.exec_max, hs.overruns, hs.missed, \
+			hs.jitter_max, hs.late_max, mem, '/'.join([str(v) for v in hs.hist]))
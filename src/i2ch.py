@@ -3,8 +3,20 @@
 
 
 import machine
-from ustruct import unpack
+from ustruct import unpack, unpack_from, pack_into, pack
+from array import array
 import utime
+from vsproto import FrameEncoder, PROTO_MSG_IMU, PROTO_FMT_IMU, PROTO_HEADER_LEN, \
+	PROTO_MSG_IMU_UTC, PROTO_FMT_IMU_UTC, OUT_MODE_TEXT, OUT_MODE_BIN, clamp16, crc16
+from hotstat import HotStat, HOTSTAT_SRC_IMU
+from vsfmt import LineFormat, field_prec, put_byte, put_bytes, put_uint, VSFMT_SCALED
+
+# viper fast path, only available on the device
+try:
+	from imufast import unpack_be16, sub_offsets
+except Exception:
+	unpack_be16 = None
+	sub_offsets = None
 
 I2C_PIN_VCC = 25
 I2C_PIN_SDA = 21
@@ -18,13 +30,74 @@ MPU_LSB_TO_MS2 = (9.806/4096.0)
 MPU_LSB_TO_RADS = (3.1415/180.0)*(205.0/32768.0)
 MPU_SAMPLING_RATE_DEFAULT = 50
 
+# FIFO burst mode
+MPU_REG_SMPLRT_DIV = 25
+MPU_REG_CONFIG = 26
+MPU_REG_FIFO_EN = 35
+MPU_REG_INT_ENABLE = 56
+MPU_REG_INT_STATUS = 58
+MPU_REG_USER_CTRL = 106
+MPU_REG_FIFO_COUNT = 114
+MPU_REG_FIFO_RW = 116
+MPU_FIFO_EN_ALL = 0xF8 # temp, gyro x/y/z, accel: same layout as MPU_REG_SENSORVAL
+MPU_USER_CTRL_FIFO_EN = 0x40
+MPU_USER_CTRL_FIFO_RESET = 0x04
+MPU_INT_FIFO_OFLOW = 0x10
+MPU_FIFO_SIZE = 1024
+MPU_FIFO_SAMPLE_LEN = 14
+MPU_FIFO_MAX_SAMPLES = MPU_FIFO_SIZE // MPU_FIFO_SAMPLE_LEN
+MPU_DLPF_DEFAULT = 3 # 44 Hz bandwidth, 1 kHz gyro output rate
+MPU_FIFO_POLL_MS_DEFAULT = 50
+
+# hardware offset registers (big-endian words). The accel ones hold factory
+# trims in +/-16g units with bit 0 reserved: they are adjusted, not set.
+# The gyro ones are in +/-1000 dps units, zero at power-up.
+MPU_REG_XA_OFFS = 6
+MPU_REG_XG_OFFS = 19
+MPU_ACC_LSB_PER_G = 4096 # +/-8g, set_default_range()
+MPU_ACC_HW_DIV = 2 # counts per accel offset LSB at +/-8g
+MPU_GYRO_HW_DIV = 4 # counts per gyro offset LSB at +/-250 dps (power-up range)
+
+# stationary calibration, see I2cAcc.calibrate()
+CAL_SAMPLES_DEFAULT = 500
+CAL_RATE_HZ = 200
+CAL_POLL_MS = 100
+CAL_GYRO_MAX_PTP = 100 # larger gyro swings [counts] mean the sensor moved
+# calibration file on the flash filesystem
+CAL_FILE = 'imucal.bin'
+CAL_MAGIC = b'VSCA'
+CAL_VERSION = 1
+CAL_FLAG_HW = 0x01 # hardware offset registers are in use
+CAL_FMT = '<4sBBH7h6h' # magic, version, flags, n samples, offsets (MPU_CHANNELS), accel + gyro hw offsets
+CAL_LEN = 34 # calcsize(CAL_FMT), followed by a CRC16 (vsproto.crc16)
+
+# channel order of the MPU_REG_SENSORVAL block
+MPU_CHANNELS = ('ax', 'ay', 'az', 'temp', 'rx', 'ry', 'rz')
+MPU_N_CHANNELS = 7
+# temperature is not converted (sensor_dict['temp'] has always been 0.0)
+MPU_SCALES = (MPU_LSB_TO_MS2, MPU_LSB_TO_MS2, MPU_LSB_TO_MS2, 0.0, \
+	MPU_LSB_TO_RADS, MPU_LSB_TO_RADS, MPU_LSB_TO_RADS)
+
+# MPU_SCALES as exact ratios, for the text output (vsfmt.py)
+MPU_RATIO_MS2 = (9806, 4096000)
+MPU_RATIO_RADS = (31415 * 205, 10000 * 180 * 32768)
+MPU_RATIOS = (MPU_RATIO_MS2, MPU_RATIO_MS2, MPU_RATIO_MS2, (0, 1), \
+	MPU_RATIO_RADS, MPU_RATIO_RADS, MPU_RATIO_RADS)
+
+# text output: channels printed, in order, and their decimals
+IMU_TEXT_FIELDS = ('ax', 'ay', 'az', 'rx', 'ry', 'rz')
+IMU_TEXT_PREC = 4
+IMU_TEXT_UTC_LEN = 29 # ",<UTC s>.<us>,<state>" appended with timesync, at most
+
 MPU_OFFSETS = dict({'ax': 0, 'ay': 0, 'az': 0, 'temp': 0, 'rx': 0, 'ry': 0, 'rz': 0})
 IMU_TIMER_ID = 0
 
 class I2cAcc:
 	def __init__(self, addr=MPU_DEFAULT_ADDR, pin_vcc=I2C_PIN_VCC, \
 		pin_sda=I2C_PIN_SDA, pin_scl=I2C_PIN_SCL, offsets=MPU_OFFSETS, \
-		dt_sampling_ms=MPU_SAMPLING_RATE_DEFAULT, uardu=None, raw_print = False):
+		dt_sampling_ms=MPU_SAMPLING_RATE_DEFAULT, uardu=None, raw_print = False, out_mode=OUT_MODE_TEXT, \
+		zero_alloc=False, fifo_rate_hz=0, fifo_poll_ms=MPU_FIFO_POLL_MS_DEFAULT, \
+		dlpf=MPU_DLPF_DEFAULT):
 		self.addr = addr
 		self.id_pin_vcc = pin_vcc
 		self.id_pin_sda = pin_sda
@@ -35,6 +108,14 @@ class I2cAcc:
 		self.pin_scl = machine.Pin(self.id_pin_scl, machine.Pin.IN, machine.Pin.PULL_UP)
 		self.offsets = offsets.copy()
 		self.raw_print = raw_print
+		self.out_mode = out_mode
+		self.frame_enc = FrameEncoder(PROTO_MSG_IMU)
+		self.frame_enc_utc = FrameEncoder(PROTO_MSG_IMU_UTC)
+		self.timesync = None # optional timesync.TimeSync: samples then carry GPS UTC
+		self.dsp = None # optional imudsp.ImuDsp between offset removal and output
+		self.sdlog = None # optional sdlog.SdLogger receiving every frame
+		self.txpolicy = None # optional txpolicy.TxPolicy filtering the Uarduino output
+		self.batch = None # optional txbatch.ImuBatch grouping samples on the Uarduino link
 		self.dt_sampling_ms = dt_sampling_ms
 		self.i2c = None
 		self.is_powered = False
@@ -42,24 +123,126 @@ class I2cAcc:
 		self.bytebuf = memoryview(self.buffer[0:1])
 		self.wordbuf = memoryview(self.buffer[0:2])
 		self.sensors = bytearray(14)
-		self.sensor_dict_raw = dict({'t': 0.0, 'ax': 0, 'ay': 0, 'az': 0, 'temp': 0, 'rx': 0, 'ry': 0, 'rz': 0})
-		self.sensor_dict = dict({'t': 0.0, 'ax': 0.0, 'ay': 0.0, 'az': 0.0, 'temp': 0.0, 'rx': 0.0, 'ry': 0.0, 'rz': 0.0})
+		self._sensor_dict_raw = dict({'t': 0.0, 'ax': 0, 'ay': 0, 'az': 0, 'temp': 0, 'rx': 0, 'ry': 0, 'rz': 0})
+		self._sensor_dict = dict({'t': 0.0, 'ax': 0.0, 'ay': 0.0, 'az': 0.0, 'temp': 0.0, 'rx': 0.0, 'ry': 0.0, 'rz': 0.0})
+		# zero-allocation mode: samples live in these arrays and the dicts
+		# above are only rebuilt when somebody reads them.
+		self.zero_alloc = zero_alloc
+		self.t_sample = 0 # ticks_ms and ticks_us taken right before the read
+		self.t_us = 0
+		self.raw = array('h', [0] * MPU_N_CHANNELS)
+		self.offs = array('i', [0] * MPU_N_CHANNELS)
+		self.counts = array('i', [0] * MPU_N_CHANNELS) # raw minus offsets
+		self.scales = array('f', MPU_SCALES)
+		self.set_text_format()
+		self._views_stale = False
+		self._load_offsets()
+		self.hw_offs = array('h', [0] * 6) # accel x/y/z, gyro x/y/z registers
+		self.cal_flags = 0
+		self.cal_samples = 0
+		# FIFO mode (fifo_rate_hz > 0): the MPU samples on its own clock and
+		# the timer only drains the FIFO every fifo_poll_ms. Always decodes
+		# into the arrays above.
+		self.fifo_rate_hz = fifo_rate_hz
+		self.fifo_poll_ms = fifo_poll_ms
+		self.dlpf = dlpf
+		self.fifo_period_us = 0
+		self.fifo_buf = None
+		self.fifo_raw = None
+		self.fifo_reads = 0
+		self.fifo_samples = 0
+		self.fifo_overflows = 0
+		if fifo_rate_hz > 0:
+			self.zero_alloc = True
+		self.hotstat = None # callback statistics, see enable_hotstat()
 		self.timer = machine.Timer(IMU_TIMER_ID)
 		self.paused = True
 		pass
 	
+	@property
+	def sensor_dict_raw(self):
+		if self._views_stale:
+			self._refresh_views()
+		return self._sensor_dict_raw
+	
+	@property
+	def sensor_dict(self):
+		if self._views_stale:
+			self._refresh_views()
+		return self._sensor_dict
+	
+	def _refresh_views(self):
+		rd = self._sensor_dict_raw
+		d = self._sensor_dict
+		for k in range(MPU_N_CHANNELS):
+			name = MPU_CHANNELS[k]
+			rd[name] = self.raw[k]
+			d[name] = self.counts[k] * self.scales[k]
+		rd['t'] = self.t_sample
+		d['t'] = self.t_sample
+		self._views_stale = False
+		pass
+	
+	# copies self.offsets (the user-facing dict) into the offsets array
+	def _load_offsets(self):
+		for k in range(MPU_N_CHANNELS):
+			self.offs[k] = self.offsets[MPU_CHANNELS[k]]
+		pass
+	
 	def start(self):
+		self.configure()
 		print("Starting IMU Timer...")
-		self.timer.init(period=self.dt_sampling_ms, callback=self._timed_cb)
+		self._start_timer()
 		print("Timer started.")
 		self.paused = False
 		pass
+	
+	# everything start() does but the timer (used by vsasync.py)
+	def configure(self):
+		self._load_offsets()
+		if self.fifo_rate_hz > 0:
+			self.fifo_setup(self.fifo_rate_hz, self.dlpf)
+		if not (self.dsp is None):
+			self.zero_alloc = True # the DSP works on the arrays
+			if self.fifo_rate_hz > 0:
+				self.dsp.setup(self.fifo_period_us)
+			else:
+				self.dsp.setup(self.dt_sampling_ms * 1000)
+		pass
+	
+	def _start_timer(self):
+		if self.fifo_rate_hz > 0:
+			period = self.fifo_poll_ms
+			cb = self._fifo_cb
+		else:
+			period = self.dt_sampling_ms
+			cb = self._timed_cb
+		if not (self.hotstat is None):
+			self.hotstat.period_us = period * 1000
+			cb = self.hotstat.wrap(cb)
+		self.timer.init(period=period, callback=cb)
+		pass
+	
+	# Turns the callback statistics (hotstat.py) on or off, also while
+	# running. Off, the timer calls the bare callback.
+	def enable_hotstat(self, on=True):
+		if on and self.hotstat is None:
+			self.hotstat = HotStat(HOTSTAT_SRC_IMU, self.dt_sampling_ms)
+		elif not on:
+			self.hotstat = None
+		if not self.paused:
+			self._start_timer()
+		pass
 		
 	def pause(self):
 		if self.paused:
 			self.start()
 		else:
 			self.timer.deinit()
+			if self.fifo_rate_hz > 0:
+				self.write_byte(MPU_REG_USER_CTRL, 0)
+			if not (self.batch is None):
+				self.batch.flush()
 			self.paused = True
 		pass
 	
@@ -91,17 +274,123 @@ class I2cAcc:
 	
 	def _timed_cb(self, t_obj):
 		self.sample_all()
-		self._print_on_repl()
+		self._process_output()
+		pass
+	
+	# outputs the current sample, or what the DSP stage makes of it
+	def _process_output(self):
+		d = self.dsp
+		if d is None or d.process(self):
+			self._output()
+		pass
+	
+	def _output(self):
+		if self.out_mode == OUT_MODE_BIN:
+			self._send_frame()
+		else:
+			f = None
+			if not (self.sdlog is None and self.txpolicy is None):
+				f = self._encode_frame()
+			if self.txpolicy is None or not (self.txpolicy.filter(f, False) is None):
+				self._print_on_repl()
+			if not (self.sdlog is None):
+				self.sdlog.log(f)
+		if not (self.dsp is None) and self.dsp.fusion:
+			self._output_att()
+		pass
+	
+	def _output_att(self):
+		d = self.dsp
+		if self.out_mode == OUT_MODE_BIN:
+			f = d.att_frame()
+			if not (self.uardu is None):
+				self.uardu.send_bytes(f)
+			if not (self.sdlog is None):
+				self.sdlog.log(f)
+		else:
+			s2send = d.att_text()
+			if self.raw_print:
+				print(s2send)
+			if not (self.uardu is None):
+				self.uardu.send_str(s2send)
+			if not (self.sdlog is None):
+				self.sdlog.log(d.att_frame())
+		pass
+	
+	# sends the current sample as a binary frame (see vsproto.py)
+	def _send_frame(self):
+		f = self._encode_frame()
+		if not (self.sdlog is None):
+			self.sdlog.log(f)
+		if not (self.batch is None):
+			self.batch.add_frame(f) # full samples only: the batch replaces delta frames
+			return
+		if not (self.txpolicy is None):
+			f = self.txpolicy.filter(f)
+		if not (self.uardu is None or f is None):
+			self.uardu.send_bytes(f)
 		pass
+	
+	# raw minus offsets of the current sample, in MPU_CHANNELS order
+	def _counts(self):
+		if self.zero_alloc:
+			return self.counts
+		r = self._sensor_dict_raw
+		o = self.offsets
+		return (r['ax'] - o['ax'], r['ay'] - o['ay'], r['az'] - o['az'], 0, \
+			r['rx'] - o['rx'], r['ry'] - o['ry'], r['rz'] - o['rz'])
+	
+	def _encode_frame(self):
+		c = self._counts()
+		t = self.t_sample
+		ts = self.timesync
+		if not (ts is None):
+			sync = ts.convert(self.t_us)
+			enc = self.frame_enc_utc
+			pack_into(PROTO_FMT_IMU_UTC, enc.frame, PROTO_HEADER_LEN, self.t_us, \
+				ts.utc_ms, ts.utc_us, sync, clamp16(c[0]), clamp16(c[1]), clamp16(c[2]), \
+				clamp16(c[4]), clamp16(c[5]), clamp16(c[6]))
+			return enc.finalize()
+		enc = self.frame_enc
+		pack_into(PROTO_FMT_IMU, enc.frame, PROTO_HEADER_LEN, t & 0xFFFFFFFF, \
+			clamp16(c[0]), clamp16(c[1]), clamp16(c[2]), \
+			clamp16(c[4]), clamp16(c[5]), clamp16(c[6]))
+		return enc.finalize()
 		
+	# Compiles the text line: fields are MPU_CHANNELS names, prec the
+	# printed decimals, one for all or a dict per field.
+	def set_text_format(self, fields=IMU_TEXT_FIELDS, prec=IMU_TEXT_PREC):
+		spec = []
+		for name in fields:
+			k = MPU_CHANNELS.index(name)
+			spec.append((VSFMT_SCALED, k, MPU_RATIOS[k], field_prec(prec, name, IMU_TEXT_PREC)))
+		self.text_fmt = LineFormat(b'ACC', spec, extra=IMU_TEXT_UTC_LEN)
+		pass
+	
 	# prints the current contents of sensor_dict on the repl prompt.
 	def _print_on_repl(self):
 		#s2send="{t:.1f}\tACC\t{ax:.7f},{ay:.7f},{az:.7f},{rx:.7f},{ry:.7f},{rz:.7f}".format(**self.sensor_dict)
-		s2send="{t:.1f}\tACC\t{ax:.4f},{ay:.4f},{az:.4f},{rx:.4f},{ry:.4f},{rz:.4f}".format(**self.sensor_dict)
+		f = self.text_fmt
+		b = f.buf
+		n = f.render(self.t_sample, self._counts())
+		ts = self.timesync
+		if not (ts is None):
+			# UTC seconds of day and sync state appended
+			if ts.convert(self.t_us):
+				n = put_byte(b, n, 44)
+				n = put_uint(b, n, ts.utc_ms // 1000, 0)
+				n = put_byte(b, n, 46)
+				n = put_uint(b, n, (ts.utc_ms % 1000) * 1000 + ts.utc_us, 6)
+				n = put_byte(b, n, 44)
+				n = put_uint(b, n, ts.state, 0)
+			else:
+				n = put_bytes(b, n, b',-1,0')
 		if self.raw_print:
-			print(s2send)
-		if not (self.uardu is None):
-			self.uardu.send_str(s2send)
+			print(f.text(n))
+		if not (self.batch is None):
+			self.batch.add_line(f.line(n), self.t_sample)
+		elif not (self.uardu is None):
+			self.uardu.send_line(f.line(n))
 		pass
 	
 	def _power_off(self):
@@ -126,35 +415,287 @@ class I2cAcc:
 		self.write_byte(MPU_REG_RANGE_MGM, 16)
 		pass
 	
+	def _read_hw_offsets(self):
+		b = bytearray(6)
+		self.i2c.readfrom_mem_into(self.addr, MPU_REG_XA_OFFS, b)
+		v = unpack('>3h', b)
+		self.i2c.readfrom_mem_into(self.addr, MPU_REG_XG_OFFS, b)
+		v = v + unpack('>3h', b)
+		for j in range(6):
+			self.hw_offs[j] = v[j]
+		pass
+	
+	def _write_hw_offsets(self):
+		h = self.hw_offs
+		self.i2c.writeto_mem(self.addr, MPU_REG_XA_OFFS, pack('>3h', h[0], h[1], h[2]))
+		self.i2c.writeto_mem(self.addr, MPU_REG_XG_OFFS, pack('>3h', h[3], h[4], h[5]))
+		pass
+	
+	# Stationary calibration: averages n samples, read in FIFO bursts, and
+	# takes the means as offsets, except on the gravity axis (the accel axis
+	# with the largest mean, or the one named by `gravity`) which has to
+	# read +/-1 g. The temperature offset is left alone.
+	# With hw=True the accel and gyro biases go into the MPU offset
+	# registers, and only what they cannot represent stays in self.offsets.
+	# With hw=False the registers are left as they are: after a loaded hw
+	# calibration the offsets are measured on top of them, so CAL_FLAG_HW
+	# stays and the saved file writes them back.
+	# The sensor must be powered, ranged and not sampling. Returns False,
+	# leaving the offsets as they were, if it moved or did not answer.
+	def calibrate(self, n=CAL_SAMPLES_DEFAULT, gravity=None, hw=False):
+		if not self.paused:
+			raise ValueError("pause the IMU before calibrating")
+		if hw:
+			self._read_hw_offsets()
+		self.fifo_setup(CAL_RATE_HZ)
+		fr = self.fifo_raw
+		sums = [0] * MPU_N_CHANNELS
+		gmin = [32767] * 3
+		gmax = [-32768] * 3
+		got = 0
+		timeout_ms = 2 * n * 1000 // CAL_RATE_HZ + 1000
+		t0 = utime.ticks_ms()
+		while got < n and utime.ticks_diff(utime.ticks_ms(), t0) < timeout_ms:
+			utime.sleep_ms(CAL_POLL_MS)
+			m = min(self.fifo_read(), n - got)
+			for base in range(0, m * MPU_N_CHANNELS, MPU_N_CHANNELS):
+				for j in range(MPU_N_CHANNELS):
+					sums[j] += fr[base + j]
+				for j in range(3):
+					v = fr[base + 4 + j]
+					if v < gmin[j]:
+						gmin[j] = v
+					if v > gmax[j]:
+						gmax[j] = v
+			got += m
+		# back to the power-up state; configure() sets the FIFO up again if used
+		self.write_byte(MPU_REG_USER_CTRL, 0)
+		self.write_byte(MPU_REG_FIFO_EN, 0)
+		self.write_byte(MPU_REG_INT_ENABLE, 0)
+		self.write_byte(MPU_REG_CONFIG, 0)
+		self.write_byte(MPU_REG_SMPLRT_DIV, 0)
+		if got < n:
+			print("IMU calibration: {} of {} samples".format(got, n))
+			return False
+		for j in range(3):
+			if gmax[j] - gmin[j] > CAL_GYRO_MAX_PTP:
+				print("IMU calibration: sensor moving")
+				return False
+		bias = [int(round(s / got)) for s in sums]
+		if gravity is None:
+			g = 0
+			for j in range(1, 3):
+				if abs(bias[j]) > abs(bias[g]):
+					g = j
+		else:
+			g = MPU_CHANNELS.index(gravity)
+		if bias[g] > 0:
+			bias[g] -= MPU_ACC_LSB_PER_G
+		else:
+			bias[g] += MPU_ACC_LSB_PER_G
+		bias[3] = self.offsets['temp']
+		self.cal_flags &= CAL_FLAG_HW
+		if hw:
+			h = self.hw_offs
+			for j in range(3):
+				# steps of 2 LSB, keeping bit 0
+				d = int(round(bias[j] / (2 * MPU_ACC_HW_DIV)))
+				h[j] = clamp16(h[j] - 2 * d)
+				bias[j] -= 2 * d * MPU_ACC_HW_DIV
+				d = int(round(bias[4 + j] / MPU_GYRO_HW_DIV))
+				h[3 + j] = clamp16(h[3 + j] - d)
+				bias[4 + j] -= d * MPU_GYRO_HW_DIV
+			self._write_hw_offsets()
+			self.cal_flags = CAL_FLAG_HW
+		for k in range(MPU_N_CHANNELS):
+			self.offsets[MPU_CHANNELS[k]] = bias[k]
+		self._load_offsets()
+		self.cal_samples = got
+		print("IMU calibration: {} samples, gravity on {}".format(got, MPU_CHANNELS[g]))
+		return True
+	
+	# Stores the offsets (and the offset registers, if calibrated with hw=True).
+	def save_calibration(self, path=CAL_FILE):
+		buf = bytearray(CAL_LEN + 2)
+		o = [self.offsets[name] for name in MPU_CHANNELS]
+		pack_into(CAL_FMT, buf, 0, CAL_MAGIC, CAL_VERSION, self.cal_flags, self.cal_samples, \
+			*(o + list(self.hw_offs)))
+		pack_into('<H', buf, CAL_LEN, crc16(buf, 0, CAL_LEN))
+		with open(path, 'wb') as f:
+			f.write(buf)
+		pass
+	
+	# Loads the offsets stored by save_calibration(), writing the offset
+	# registers back when they were used (the sensor must be powered).
+	# Returns False if there is no valid file.
+	def load_calibration(self, path=CAL_FILE):
+		try:
+			with open(path, 'rb') as f:
+				buf = f.read()
+		except OSError:
+			return False
+		if len(buf) != CAL_LEN + 2 or unpack_from('<H', buf, CAL_LEN)[0] != crc16(buf, 0, CAL_LEN):
+			return False
+		v = unpack_from(CAL_FMT, buf, 0)
+		if v[0] != CAL_MAGIC or v[1] != CAL_VERSION:
+			return False
+		self.cal_flags = v[2]
+		self.cal_samples = v[3]
+		for k in range(MPU_N_CHANNELS):
+			self.offsets[MPU_CHANNELS[k]] = v[4 + k]
+		for j in range(6):
+			self.hw_offs[j] = v[4 + MPU_N_CHANNELS + j]
+		if self.cal_flags & CAL_FLAG_HW:
+			self._write_hw_offsets()
+		self._load_offsets()
+		return True
+	
 	def _read_sensors_buffer(self):
+		self.t_sample = utime.ticks_ms()
+		self.t_us = utime.ticks_us()
 		self.i2c.readfrom_mem_into(self.addr, MPU_REG_SENSORVAL, self.sensors)
 		pass
 	
 	def _unpack_sensors_values(self):
-		self.sensor_dict_raw['ax'] = unpack('>h', self.sensors[0:2])[0]
-		self.sensor_dict_raw['ay'] = unpack('>h', self.sensors[2:4])[0]
-		self.sensor_dict_raw['az'] = unpack('>h', self.sensors[4:6])[0]
-		self.sensor_dict_raw['temp'] = unpack('>h', self.sensors[6:8])[0]
-		self.sensor_dict_raw['rx'] = unpack('>h', self.sensors[8:10])[0]
-		self.sensor_dict_raw['ry'] = unpack('>h', self.sensors[10:12])[0]
-		self.sensor_dict_raw['rz'] = unpack('>h', self.sensors[12:14])[0]
-		self.sensor_dict_raw['t'] = utime.ticks_ms()
+		sr = self._sensor_dict_raw
+		sr['ax'] = unpack('>h', self.sensors[0:2])[0]
+		sr['ay'] = unpack('>h', self.sensors[2:4])[0]
+		sr['az'] = unpack('>h', self.sensors[4:6])[0]
+		sr['temp'] = unpack('>h', self.sensors[6:8])[0]
+		sr['rx'] = unpack('>h', self.sensors[8:10])[0]
+		sr['ry'] = unpack('>h', self.sensors[10:12])[0]
+		sr['rz'] = unpack('>h', self.sensors[12:14])[0]
+		sr['t'] = self.t_sample
 		pass
 	
 	def _to_physical_units(self):
-		self.sensor_dict['ax'] = (self.sensor_dict_raw['ax'] - self.offsets['ax']) * MPU_LSB_TO_MS2
-		self.sensor_dict['ay'] = (self.sensor_dict_raw['ay'] - self.offsets['ay']) * MPU_LSB_TO_MS2
-		self.sensor_dict['az'] = (self.sensor_dict_raw['az'] - self.offsets['az']) * MPU_LSB_TO_MS2
-		self.sensor_dict['rx'] = (self.sensor_dict_raw['rx'] - self.offsets['rx']) * MPU_LSB_TO_RADS
-		self.sensor_dict['ry'] = (self.sensor_dict_raw['ry'] - self.offsets['ry']) * MPU_LSB_TO_RADS
-		self.sensor_dict['rz'] = (self.sensor_dict_raw['rz'] - self.offsets['rz']) * MPU_LSB_TO_RADS
-		self.sensor_dict['t'] = self.sensor_dict_raw['t']
+		sr = self._sensor_dict_raw
+		s = self._sensor_dict
+		s['ax'] = (sr['ax'] - self.offsets['ax']) * MPU_LSB_TO_MS2
+		s['ay'] = (sr['ay'] - self.offsets['ay']) * MPU_LSB_TO_MS2
+		s['az'] = (sr['az'] - self.offsets['az']) * MPU_LSB_TO_MS2
+		s['rx'] = (sr['rx'] - self.offsets['rx']) * MPU_LSB_TO_RADS
+		s['ry'] = (sr['ry'] - self.offsets['ry']) * MPU_LSB_TO_RADS
+		s['rz'] = (sr['rz'] - self.offsets['rz']) * MPU_LSB_TO_RADS
+		s['t'] = sr['t']
+		pass
+	
+	# zero-allocation counterpart of _unpack_sensors_values + _to_physical_units:
+	# leaves the sample in self.raw / self.counts, physical units are only
+	# computed when the dict views are read.
+	def _unpack_to_arrays(self):
+		if unpack_be16 is None:
+			v = unpack_from('>7h', self.sensors)
+			raw = self.raw
+			offs = self.offs
+			c = self.counts
+			for k in range(MPU_N_CHANNELS):
+				raw[k] = v[k]
+				c[k] = v[k] - offs[k]
+		else:
+			unpack_be16(self.sensors, self.raw, MPU_N_CHANNELS)
+			sub_offsets(self.raw, self.offs, self.counts, MPU_N_CHANNELS)
+		self._views_stale = True
+		pass
+	
+	# Programs DLPF, sample rate divider and FIFO. The effective rate is
+	# the gyro output rate (1 kHz, 8 kHz with the DLPF off) divided by an
+	# integer, so it is rounded to the closest achievable value.
+	def fifo_setup(self, rate_hz, dlpf=MPU_DLPF_DEFAULT):
+		if dlpf == 0 or dlpf == 7:
+			base_hz = 8000
+		else:
+			base_hz = 1000
+		div = (base_hz + rate_hz // 2) // rate_hz - 1
+		if div < 0:
+			div = 0
+		elif div > 255:
+			div = 255
+		self.fifo_period_us = (div + 1) * 1000000 // base_hz
+		if self.fifo_buf is None:
+			self.fifo_buf = bytearray(MPU_FIFO_MAX_SAMPLES * MPU_FIFO_SAMPLE_LEN)
+			self.fifo_mv = memoryview(self.fifo_buf)
+			self.fifo_raw = array('h', [0] * (MPU_FIFO_MAX_SAMPLES * MPU_N_CHANNELS))
+		self.write_byte(MPU_REG_CONFIG, dlpf & 0x07)
+		self.write_byte(MPU_REG_SMPLRT_DIV, div)
+		self.write_byte(MPU_REG_FIFO_EN, MPU_FIFO_EN_ALL)
+		self.write_byte(MPU_REG_INT_ENABLE, MPU_INT_FIFO_OFLOW)
+		self.fifo_reset()
+		pass
+	
+	def fifo_reset(self):
+		self.write_byte(MPU_REG_USER_CTRL, MPU_USER_CTRL_FIFO_RESET)
+		self.write_byte(MPU_REG_USER_CTRL, MPU_USER_CTRL_FIFO_EN)
+		pass
+	
+	def fifo_count(self):
+		self.i2c.readfrom_mem_into(self.addr, MPU_REG_FIFO_COUNT, self.wordbuf)
+		return (self.wordbuf[0] << 8) | self.wordbuf[1]
+	
+	# Drains the FIFO with a single burst read and decodes the samples into
+	# self.fifo_raw. Returns the number of samples read; on overflow the
+	# FIFO is reset (its content is no longer aligned) and 0 is returned.
+	def fifo_read(self):
+		self.fifo_reads += 1
+		status = self.read_uint8(MPU_REG_INT_STATUS)
+		count = self.fifo_count()
+		if (status & MPU_INT_FIFO_OFLOW) or count >= MPU_FIFO_SIZE:
+			self.fifo_overflows += 1
+			self.fifo_reset()
+			return 0
+		n = count // MPU_FIFO_SAMPLE_LEN
+		if n == 0:
+			return 0
+		nbytes = n * MPU_FIFO_SAMPLE_LEN
+		self.i2c.readfrom_mem_into(self.addr, MPU_REG_FIFO_RW, self.fifo_mv[0:nbytes])
+		if unpack_be16 is None:
+			fr = self.fifo_raw
+			buf = self.fifo_buf
+			for k in range(0, n * MPU_N_CHANNELS, MPU_N_CHANNELS):
+				v = unpack_from('>7h', buf, 2 * k)
+				for j in range(MPU_N_CHANNELS):
+					fr[k + j] = v[j]
+		else:
+			unpack_be16(self.fifo_buf, self.fifo_raw, n * MPU_N_CHANNELS)
+		self.fifo_samples += n
+		return n
+	
+	# loads sample k of the last fifo_read() into self.raw / self.counts
+	def _fifo_select(self, k, t, t_us):
+		fr = self.fifo_raw
+		raw = self.raw
+		offs = self.offs
+		c = self.counts
+		base = k * MPU_N_CHANNELS
+		for j in range(MPU_N_CHANNELS):
+			v = fr[base + j]
+			raw[j] = v
+			c[j] = v - offs[j]
+		self.t_sample = t
+		self.t_us = t_us
+		self._views_stale = True
+		pass
+	
+	# The time the read starts at is assigned to the newest sample, older
+	# ones are spaced back by the FIFO sample period.
+	def _fifo_cb(self, t_obj):
+		t_last = utime.ticks_ms()
+		t_last_us = utime.ticks_us()
+		n = self.fifo_read()
+		for k in range(n):
+			back_us = (n - 1 - k) * self.fifo_period_us
+			self._fifo_select(k, utime.ticks_add(t_last, -(back_us // 1000)), \
+				utime.ticks_add(t_last_us, -back_us))
+			self._process_output()
 		pass
 	
 	def sample_all(self):
 		self._read_sensors_buffer()
-		self._unpack_sensors_values()
-		self._to_physical_units()
+		if self.zero_alloc:
+			self._unpack_to_arrays()
+		else:
+			self._unpack_sensors_values()
+			self._to_physical_units()
 		pass
 		
 	
@@ -0,0 +1,257 @@
+# On-device preprocessing of the IMU samples, between the offset removal
+# and the output of I2cAcc (set I2cAcc.dsp): a low-pass filter (first-order
+# IIR, or windowed-sinc FIR), integer decimation and a complementary
+# attitude filter (roll/pitch integrated from the gyro, pulled towards the
+# accelerometer tilt, which comes from an integer CORDIC atan2).
+# It works on the offset-removed counts, in fixed point and on
+# preallocated arrays; the inner loops are the viper versions from
+# imufast.py on the device, the plain Python ones below elsewhere.
+#
+# process() runs for every sample and returns True every `decim` samples,
+# after writing the filtered counts back into imu.counts and moving the
+# sample time back by the filter delay; only those samples are output.
+# Yaw is not estimated: without a magnetometer it only drifts.
+
+import math
+import utime
+from array import array
+from ustruct import pack_into
+from vsproto import FrameEncoder, PROTO_MSG_ATT, PROTO_FMT_ATT, PROTO_HEADER_LEN
+from i2ch import MPU_N_CHANNELS, MPU_LSB_TO_RADS
+
+DSP_LPF_NONE = 0
+DSP_LPF_IIR = 1
+DSP_LPF_FIR = 2
+
+DSP_FIR_TAPS_DEFAULT = 15
+DSP_FC_OF_OUT_RATE = 0.4 # default cutoff, as a fraction of the output rate
+DSP_IIR_SHIFT_MAX = 12
+DSP_FUSION_TAU_MS = 1000 # time constant of the accelerometer correction
+DSP_CORDIC_ITERS = 20
+DSP_CORDIC_GAIN_Q15 = 53962 # 1.64676 * 2**15
+DSP_PI_URAD = 3141593
+DSP_2PI_URAD = 6283185
+
+# Python versions of the imufast.py kernels, with the same arithmetic
+def _iir_step(x, y, n, shift):
+	for i in range(n):
+		v = y[i]
+		y[i] = v + (((x[i] << 8) - v) >> shift)
+
+def _iir_out(y, out, n):
+	for i in range(n):
+		out[i] = (y[i] + 128) >> 8
+
+def _fir_push(x, hist, pos, n):
+	base = pos * n
+	for i in range(n):
+		hist[base + i] = x[i]
+
+def _fir_out(hist, taps, pos, ntaps, out, n):
+	for i in range(n):
+		acc = 0
+		r = pos
+		for k in range(ntaps):
+			acc += taps[k] * hist[r * n + i]
+			r -= 1
+			if r < 0:
+				r = ntaps - 1
+		out[i] = (acc + 8192) >> 14
+
+def _cordic_vec(y, x, tbl, iters, res):
+	z = 0
+	if x < 0:
+		z = DSP_PI_URAD if y >= 0 else -DSP_PI_URAD
+		x = -x
+		y = -y
+	x = x << 13
+	y = y << 13
+	for i in range(iters):
+		if y > 0:
+			x, y = x + (y >> i), y - (x >> i)
+			z += tbl[i]
+		else:
+			x, y = x - (y >> i), y + (x >> i)
+			z -= tbl[i]
+	res[0] = z
+	res[1] = x >> 13
+
+try:
+	from imufast import iir_step, iir_out, fir_push, fir_out, cordic_vec
+except Exception:
+	iir_step = _iir_step
+	iir_out = _iir_out
+	fir_push = _fir_push
+	fir_out = _fir_out
+	cordic_vec = _cordic_vec
+
+def _wrap(a):
+	if a > DSP_PI_URAD:
+		return a - DSP_2PI_URAD
+	if a < -DSP_PI_URAD:
+		return a + DSP_2PI_URAD
+	return a
+
+class ImuDsp:
+	def __init__(self, decim=1, lpf=DSP_LPF_NONE, fc_hz=0, taps=DSP_FIR_TAPS_DEFAULT, \
+		fusion=False, tau_ms=DSP_FUSION_TAU_MS):
+		self.decim = max(1, decim)
+		self.lpf = lpf
+		self.fc_hz = fc_hz # 0: DSP_FC_OF_OUT_RATE of the output rate
+		self.ntaps = taps | 1 # odd: linear phase with a whole-sample delay
+		self.fusion = fusion
+		self.tau_ms = tau_ms
+		self.n = MPU_N_CHANNELS
+		self.y = array('i', [0] * self.n)
+		self.hist = array('i', [0] * (self.n * self.ntaps))
+		self.taps = array('i', [0] * self.ntaps)
+		self.shift = 1
+		self.pos = 0
+		self.k = 0
+		self.primed = False
+		self.delay_us = 0
+		self.delay_ms = 0
+		# attitude [urad]
+		self.atan_tbl = array('i', [int(round(math.atan(2.0 ** -i) * 1e6)) \
+			for i in range(DSP_CORDIC_ITERS)])
+		self.cres = array('i', [0, 0])
+		self.kg = 0 # gyro count -> urad per sample, scaled by 2**kg_shift
+		self.kg_shift = 0
+		self.beta_shift = 1
+		self.roll = 0
+		self.pitch = 0
+		self.att_ok = False
+		self.t_att = 0
+		self.att_enc = FrameEncoder(PROTO_MSG_ATT)
+		self.n_in = 0
+		self.n_out = 0
+		pass
+
+	# Derives the coefficients from the input sample period; called by
+	# I2cAcc.configure().
+	def setup(self, period_us):
+		fs = 1e6 / period_us
+		fc = self.fc_hz if self.fc_hz > 0 else DSP_FC_OF_OUT_RATE * fs / self.decim
+		if fc > 0.45 * fs:
+			fc = 0.45 * fs
+		self.delay_us = 0
+		if self.lpf == DSP_LPF_IIR:
+			alpha = 1.0 - math.exp(-2.0 * math.pi * fc / fs)
+			self.shift = min(DSP_IIR_SHIFT_MAX, max(1, int(round(-math.log(alpha) / math.log(2.0)))))
+			a = 2.0 ** -self.shift
+			self.delay_us = int((1.0 - a) / a * period_us) # at DC
+		elif self.lpf == DSP_LPF_FIR:
+			self._design_fir(fc / fs)
+			self.delay_us = (self.ntaps // 2) * period_us
+		self.delay_ms = (self.delay_us + 500) // 1000
+		dt = period_us * 1e-6
+		kg_f = MPU_LSB_TO_RADS * 1e6 * dt
+		s = 0
+		while s < 20 and kg_f * (2 ** (s + 1)) < 32768:
+			s += 1
+		self.kg = int(round(kg_f * 2 ** s))
+		self.kg_shift = s
+		b = int(round(math.log(max(2.0, self.tau_ms * 1000.0 / period_us)) / math.log(2.0)))
+		self.beta_shift = min(16, max(1, b))
+		self.reset()
+		pass
+
+	# Hamming-windowed sinc, cutoff f (fraction of the sample rate), taps in
+	# Q14 summing to exactly 1.0
+	def _design_fir(self, f):
+		m = self.ntaps // 2
+		h = []
+		for k in range(self.ntaps):
+			x = k - m
+			s = 2.0 * f if x == 0 else math.sin(2.0 * math.pi * f * x) / (math.pi * x)
+			h.append(s * (0.54 - 0.46 * math.cos(2.0 * math.pi * k / (self.ntaps - 1))))
+		g = sum(h)
+		q = [int(round(16384.0 * v / g)) for v in h]
+		q[m] += 16384 - sum(q)
+		for k in range(self.ntaps):
+			self.taps[k] = q[k]
+		pass
+
+	def reset(self):
+		self.k = 0
+		self.pos = 0
+		self.primed = False
+		self.att_ok = False
+		pass
+
+	def process(self, imu):
+		c = imu.counts
+		n = self.n
+		self.n_in += 1
+		if self.fusion:
+			self._fuse(c)
+		lpf = self.lpf
+		if not self.primed:
+			# start from the first sample instead of ramping up from zero
+			for i in range(n):
+				self.y[i] = c[i] << 8
+			for r in range(self.ntaps):
+				fir_push(c, self.hist, r, n)
+			self.primed = True
+		elif lpf == DSP_LPF_IIR:
+			iir_step(c, self.y, n, self.shift)
+		elif lpf == DSP_LPF_FIR:
+			pos = self.pos + 1
+			if pos == self.ntaps:
+				pos = 0
+			self.pos = pos
+			fir_push(c, self.hist, pos, n)
+		self.k += 1
+		if self.k < self.decim:
+			return False
+		self.k = 0
+		if lpf == DSP_LPF_IIR:
+			iir_out(self.y, c, n)
+		elif lpf == DSP_LPF_FIR:
+			fir_out(self.hist, self.taps, self.pos, self.ntaps, c, n)
+		self.t_att = imu.t_sample
+		if self.delay_us:
+			imu.t_us = utime.ticks_add(imu.t_us, -self.delay_us)
+			imu.t_sample = utime.ticks_add(imu.t_sample, -self.delay_ms)
+		self.n_out += 1
+		return True
+
+	# Complementary filter on the raw counts of every sample. Euler rates
+	# are taken as the body rates (small angles).
+	def _fuse(self, c):
+		r = self.cres
+		tbl = self.atan_tbl
+		cordic_vec(c[1], c[2], tbl, DSP_CORDIC_ITERS, r)
+		roll_acc = r[0]
+		# |(ay, az)| comes out times the CORDIC gain: scale ax alike
+		cordic_vec(-((c[0] * DSP_CORDIC_GAIN_Q15) >> 15), r[1], tbl, DSP_CORDIC_ITERS, r)
+		pitch_acc = r[0]
+		if not self.att_ok:
+			self.roll = roll_acc
+			self.pitch = pitch_acc
+			self.att_ok = True
+			return
+		kg = self.kg
+		ks = self.kg_shift
+		b = self.beta_shift
+		half = 1 << (b - 1)
+		roll = _wrap(self.roll + ((c[4] * kg) >> ks))
+		pitch = self.pitch + ((c[5] * kg) >> ks)
+		self.roll = _wrap(roll + ((_wrap(roll_acc - roll) + half) >> b))
+		self.pitch = pitch + ((pitch_acc - pitch + half) >> b)
+		pass
+
+	# attitude at the (undelayed) time of the last output sample
+	def att_frame(self):
+		enc = self.att_enc
+		pack_into(PROTO_FMT_ATT, enc.frame, PROTO_HEADER_LEN, self.t_att & 0xFFFFFFFF, \
+			self.roll, self.pitch)
+		return enc.finalize()
+
+	def att_text(self):
+		return "{:.1f}\tATT\t{:.5f},{:.5f}".format(self.t_att, self.roll * 1e-6, self.pitch * 1e-6)
+
+	def stats(self):
+		return dict({'in': self.n_in, 'out': self.n_out, 'iir_shift': self.shift, \
+			'delay_us': self.delay_us, 'beta_shift': self.beta_shift, \
+			'roll_urad': self.roll, 'pitch_urad': self.pitch})
@@ -0,0 +1,143 @@
+# Viper-compiled inner loops for the IMU sample path and the text output
+# (device only). i2ch, imudsp and vsfmt fall back to plain Python when this
+# module cannot be imported.
+
+import micropython
+from array import array
+
+# big endian int16 buffer -> array('h')
+@micropython.viper
+def unpack_be16(src, dst, n: int):
+	s = ptr8(src)
+	d = ptr16(dst)
+	i = 0
+	while i < n:
+		d[i] = (s[2 * i] << 8) | s[2 * i + 1]
+		i += 1
+
+# out[i] = raw[i] - offs[i]; raw is array('h'), offs and out array('i')
+@micropython.viper
+def sub_offsets(raw, offs, out, n: int):
+	r = ptr16(raw)
+	o = ptr32(offs)
+	c = ptr32(out)
+	i = 0
+	while i < n:
+		v = r[i]
+		if v & 0x8000:
+			v -= 0x10000
+		c[i] = v - o[i]
+		i += 1
+
+# --- DSP stage (imudsp.py), same arithmetic as its Python fallbacks ---
+
+# first-order low-pass: y += (x * 256 - y) >> shift; y in 1/256 LSB
+@micropython.viper
+def iir_step(x, y, n: int, shift: int):
+	xs = ptr32(x)
+	ys = ptr32(y)
+	i = 0
+	while i < n:
+		v = ys[i]
+		ys[i] = v + (((xs[i] << 8) - v) >> shift)
+		i += 1
+
+@micropython.viper
+def iir_out(y, out, n: int):
+	ys = ptr32(y)
+	o = ptr32(out)
+	i = 0
+	while i < n:
+		o[i] = (ys[i] + 128) >> 8
+		i += 1
+
+# copies one sample into row `pos` of the history (ntaps rows of n)
+@micropython.viper
+def fir_push(x, hist, pos: int, n: int):
+	xs = ptr32(x)
+	h = ptr32(hist)
+	base = pos * n
+	i = 0
+	while i < n:
+		h[base + i] = xs[i]
+		i += 1
+
+# out[i] = sum_k taps[k] * sample(newest - k)[i], taps in Q14
+@micropython.viper
+def fir_out(hist, taps, pos: int, ntaps: int, out, n: int):
+	h = ptr32(hist)
+	t = ptr32(taps)
+	o = ptr32(out)
+	i = 0
+	while i < n:
+		acc = 0
+		r = pos
+		k = 0
+		while k < ntaps:
+			acc += t[k] * h[r * n + i]
+			r -= 1
+			if r < 0:
+				r = ntaps - 1
+			k += 1
+		o[i] = (acc + 8192) >> 14
+		i += 1
+
+# CORDIC vectoring: res[0] = atan2(y, x) [urad], res[1] = gain * |(x, y)|
+# (gain ~1.6468); |x|, |y| up to 2**16, tbl = atan(2**-i) [urad]
+@micropython.viper
+def cordic_vec(y: int, x: int, tbl, iters: int, res):
+	a = ptr32(tbl)
+	r = ptr32(res)
+	z = 0
+	if x < 0:
+		if y >= 0:
+			z = 3141593
+		else:
+			z = -3141593
+		x = -x
+		y = -y
+	x = x << 13
+	y = y << 13
+	i = 0
+	while i < iters:
+		if y > 0:
+			xn = x + (y >> i)
+			y = y - (x >> i)
+			z += a[i]
+		else:
+			xn = x - (y >> i)
+			y = y + (x >> i)
+			z -= a[i]
+		x = xn
+		i += 1
+	r[0] = z
+	r[1] = x >> 13
+
+# --- text output (vsfmt.py) ---
+
+_POW10 = array('i', [1, 10, 100, 1000, 10000, 100000, 1000000, 10000000, 100000000, 1000000000])
+
+# decimal digits of x >= 0 at buf[p], at least width (< 10) of them;
+# returns the new end. Digits by subtraction: no division in viper.
+@micropython.viper
+def put_uint(buf, p: int, x: int, width: int) -> int:
+	b = ptr8(buf)
+	pw = ptr32(_POW10)
+	n = 1
+	while n < 10:
+		if x < pw[n]:
+			break
+		n += 1
+	if width > n:
+		n = width
+	k = n - 1
+	while k >= 0:
+		q = pw[k]
+		d = 48
+		while x >= q:
+			x -= q
+			d += 1
+		b[p] = d
+		p += 1
+		k -= 1
+	return p
@@ -6,34 +6,138 @@ from gpsh import *
 from i2ch import *
 import uarduino
 import utime
+import machine
+
+# raw logging of the binary frames to the SD card (sdlog.py).
+# The card is used without a filesystem from SD_LOG_START_BLOCK on:
+# reserve that area (e.g. leave it out of the partition table) and set it,
+# there is no default. SD_LOG_FORMAT erases the area's session index at
+# start-up: needed once, before the first session.
+SD_LOGGING = False
+SD_LOG_START_BLOCK = None
+SD_LOG_FORMAT = False
+SD_SPI_BAUDRATE = 10000000 # after card init
+# periodic callback timing/jitter/memory status lines (hotstat.py);
+# i.enable_hotstat(False) / u.enable_hotstat(False) switch them off at runtime
+HOTSTAT = False
+# cooperative uasyncio runtime (vsasync.py) instead of the timer callbacks
+RUNTIME_ASYNC = False
+# two threads, acquisition and output (vsdual.py)
+RUNTIME_DUAL = False
+# IMU samples stamped with GPS UTC (timesync.py), sent as IMU_UTC frames
+# (binary) or with UTC appended (text). With the receiver timepulse wired
+# to TIMESYNC_PPS_PIN the clock follows its edges, else the fix arrivals.
+TIMESYNC = False
+TIMESYNC_PPS_PIN = None
+# on-device low-pass, decimation and roll/pitch (imudsp.py): samples every
+# IMU_DSP_SAMPLING_MS, outputs every IMU_DSP_DECIM-th one, plus ATT lines
+IMU_DSP = False
+IMU_DSP_SAMPLING_MS = 10
+IMU_DSP_DECIM = 5
+# stationary IMU calibration at power-up, stored in i2ch.CAL_FILE; without
+# it the stored calibration is loaded. IMU_CAL_HW uses the MPU offset registers.
+IMU_CALIBRATE = False
+IMU_CAL_HW = False
+# link bandwidth policy (txpolicy.py): deadbands [fixed-point units of the
+# binary frames, see vsproto.py], delta frames in binary mode, keyframes,
+# rate reduction while the Uarduino queue backs up. The SD log gets everything.
+TX_POLICY = False
+TX_IMU_DEADBAND = (0, 8, 8, 8, 16, 16, 16) # t, ax ay az rx ry rz [LSB]
+TX_GPS_DEADBAND = (0, 0, 0, 20, 20, 20, 5, 100, 10, 0) # ~2 cm, 20 cm alt, 0.05 kts, 1 deg
+# IMU samples sent IMU_BATCH at a time (txbatch.py; 0: as many as fit one
+# Uarduino chunk), after IMU_BATCH_WAIT_MS at the latest. 1: off.
+# In binary mode it takes the place of the IMU transmit policy.
+IMU_BATCH = 1
+IMU_BATCH_WAIT_MS = 200
 
 a = uarduino.Uarduino()
 u = UartGps(uardu=a)
-i = I2cAcc(uardu=a)
-i.offsets['ax'] = 175
-i.offsets['ay'] = 0
-i.offsets['az'] = -670
-i.offsets['rx'] = -400
-i.offsets['ry'] = -370
-i.offsets['rz'] = 20
+i = I2cAcc(uardu=a, zero_alloc=True)
+if IMU_DSP:
+	import imudsp
+	i.dt_sampling_ms = IMU_DSP_SAMPLING_MS
+	i.dsp = imudsp.ImuDsp(decim=IMU_DSP_DECIM, lpf=imudsp.DSP_LPF_FIR, fusion=True)
+if TX_POLICY:
+	import txpolicy
+	from vsproto import PROTO_MSG_IMU, PROTO_MSG_IMU_UTC, PROTO_MSG_GPS
+	i.txpolicy = txpolicy.TxPolicy(PROTO_MSG_IMU_UTC if TIMESYNC else PROTO_MSG_IMU, a, \
+		TX_IMU_DEADBAND[0:1] + (0, 0, 0) + TX_IMU_DEADBAND[1:] if TIMESYNC else TX_IMU_DEADBAND)
+	u.txpolicy = txpolicy.TxPolicy(PROTO_MSG_GPS, a, TX_GPS_DEADBAND)
+if IMU_BATCH != 1:
+	import txbatch
+	i.batch = txbatch.ImuBatch(a, IMU_BATCH, IMU_BATCH_WAIT_MS)
+if TIMESYNC:
+	import timesync
+	ts = timesync.TimeSync(TIMESYNC_PPS_PIN)
+	i.timesync = ts
+	u.timesync = ts
+	ts.start()
 # Performing turn-on sequence externally
 #u.start()
 #i.start()
 
-'''spi = machine.SPI(1)
-spi.init(baudrate=500000, sck=machine.Pin(18), miso=machine.Pin(19), \
-	mosi=machine.Pin(23))
-p_sd = machine.Pin(27)
-p_sd.init(27, machine.Pin.OUT)
-p_cs = machine.Pin(5)'''
+lg = None # sdlog.SdLogger of this session
+if SD_LOGGING and SD_LOG_START_BLOCK is None:
+	print("SD logging off: set SD_LOG_START_BLOCK to the reserved area")
+elif SD_LOGGING:
+	import sdcard
+	import sdlog
+	spi = machine.SPI(1)
+	spi.init(baudrate=500000, sck=machine.Pin(18), miso=machine.Pin(19), \
+		mosi=machine.Pin(23))
+	p_sd = machine.Pin(27)
+	p_sd.init(27, machine.Pin.OUT)
+	p_cs = machine.Pin(5)
+	sd = sdcard.SDCard(spi, p_cs, baudrate=SD_SPI_BAUDRATE)
+	region = sdlog.SdRegion(sd, SD_LOG_START_BLOCK)
+	if SD_LOG_FORMAT:
+		region.format()
+	if not (SD_LOG_FORMAT or region.mount()):
+		print("SD logging off: no session index at block {}, set SD_LOG_FORMAT once".format( \
+			SD_LOG_START_BLOCK))
+	else:
+		lg = region.new_session()
+		if lg is None:
+			print("SD logging off: the region is full")
+		else:
+			i.sdlog = lg
+			u.sdlog = lg
+			lg.start()
 
 
 
 
 i.power_on()
 i.set_default_range()
+if IMU_CALIBRATE:
+	if i.calibrate(hw=IMU_CAL_HW):
+		i.save_calibration()
+elif not i.load_calibration():
+	print("No IMU calibration stored, offsets at zero")
+
+if RUNTIME_ASYNC:
+	import vsasync
+	rt = vsasync.VsRuntime(i, u, a)
+	rt.sdlog = lg
+	rt.run() # until Ctrl-C, then flushes
+elif RUNTIME_DUAL:
+	import vsdual
+	rt = vsdual.VsDual(i, u, a)
+	rt.sdlog = lg
+	rt.run() # until Ctrl-C, then flushes
+else:
+	u.start()
+	utime.sleep_ms(1000)
+	i.start()
+
+	if HOTSTAT:
+		import hotstat
+		i.enable_hotstat()
+		u.enable_hotstat()
+		# STA as frames when the sensors send frames
+		hs_report = hotstat.HotReport(a, (i, u), \
+			out_mode=OUT_MODE_BIN if OUT_MODE_BIN in (i.out_mode, u.out_mode) else OUT_MODE_TEXT)
+		hs_report.start()
 
-u.start()
-utime.sleep_ms(1000)
-i.start()
-
+	if not (lg is None):
+		lg.run() # until Ctrl-C, then flushes
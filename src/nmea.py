@@ -0,0 +1,300 @@
+# Streaming NMEA parser.
+# Takes raw bytes as they come out of the UART (any chunking), resyncs on
+# '$', verifies the *hh checksum and parses RMC/GGA fields in place,
+# without splitting the sentence into strings, into the fixed-point
+# fields of a gpsrec.GpsRecord. A checksum-valid sentence with a value the
+# record cannot hold (over 9 digits, angles out of range) is not counted as
+# good but as bad_value, its fields left at their defaults.
+# Pure Python: runs on the host as well, e.g. on recorded NMEA streams.
+
+from array import array
+from gpsrec import GPSR_TIME, GPSR_DATE, GPSR_STATUS, GPSR_LAT, GPSR_LON, GPSR_SPEED, \
+	GPSR_COURSE, GPSR_MVAR, GPSR_MODE, GPSR_FIX, GPSR_SATS, GPSR_HDOP, GPSR_ALT, \
+	GPSR_ALT_REF, GPSR_LAT_INVALID, GPSR_LON_INVALID
+
+NMEA_MAX_LEN = 96 # NMEA 0183 limits sentences to 82 characters
+NMEA_MAX_FIELDS = 24
+NMEA_VALUE_MAX = 999999999 # fields fit the int32 record
+NMEA_LAT_MAX = 900000000 # degrees * 1e7
+NMEA_LON_MAX = 1800000000
+
+# indices of the per sentence type counters
+NMEA_IDX_RMC = 0
+NMEA_IDX_GGA = 1
+NMEA_IDX_OTHER = 2
+NMEA_TYPE_NAMES = ('RMC', 'GGA', 'other')
+
+_DOLLAR = 36
+_STAR = 42
+_COMMA = 44
+_DOT = 46
+_CR = 13
+_LF = 10
+_TIMES10_MAX = NMEA_VALUE_MAX // 10 # above it, one more digit overflows
+
+def _hexval(c):
+	if 48 <= c <= 57:
+		return c - 48
+	if 65 <= c <= 70:
+		return c - 55
+	if 97 <= c <= 102:
+		return c - 87
+	return -1
+
+class NmeaParser:
+	def __init__(self, rec):
+		self.rec = rec
+		self.v = rec.v
+		self.line = bytearray(NMEA_MAX_LEN)
+		self.n = 0
+		self.in_sentence = False
+		# start offset of every field, plus the position of the '*'
+		self.fpos = array('B', [0] * (NMEA_MAX_FIELDS + 1))
+		self.nfields = 0
+		self.good = array('I', [0, 0, 0])
+		self.bad_checksum = array('I', [0, 0, 0])
+		self.truncated = array('I', [0, 0, 0])
+		self.bad_value = array('I', [0, 0, 0])
+		self.bad = False # a field of the sentence being parsed was out of range
+		pass
+
+	# Feeds n bytes of buf (all of it by default). Returns the number of
+	# valid sentences parsed.
+	def feed(self, buf, n=-1):
+		if n < 0:
+			n = len(buf)
+		line = self.line
+		parsed = 0
+		for i in range(n):
+			b = buf[i]
+			if b == _DOLLAR:
+				if self.in_sentence:
+					self.truncated[self._type_idx()] += 1
+				self.in_sentence = True
+				self.n = 0
+			elif not self.in_sentence:
+				continue
+			elif b == _CR or b == _LF:
+				self.in_sentence = False
+				if self._end():
+					parsed += 1
+			elif self.n >= NMEA_MAX_LEN:
+				self.truncated[self._type_idx()] += 1
+				self.in_sentence = False
+			else:
+				line[self.n] = b
+				self.n += 1
+		return parsed
+
+	def counters(self):
+		d = dict()
+		for k in range(len(NMEA_TYPE_NAMES)):
+			d[NMEA_TYPE_NAMES[k]] = (self.good[k], self.bad_checksum[k], self.truncated[k])
+		return d
+
+	# type of the sentence currently in the buffer (talker id is ignored)
+	def _type_idx(self):
+		line = self.line
+		if self.n < 5:
+			return NMEA_IDX_OTHER
+		if line[2] == 82 and line[3] == 77 and line[4] == 67: # RMC
+			return NMEA_IDX_RMC
+		if line[2] == 71 and line[3] == 71 and line[4] == 65: # GGA
+			return NMEA_IDX_GGA
+		return NMEA_IDX_OTHER
+
+	def _end(self):
+		line = self.line
+		n = self.n
+		idx = self._type_idx()
+		if n < 4 or line[n - 3] != _STAR:
+			self.truncated[idx] += 1
+			return False
+		hi = _hexval(line[n - 2])
+		lo = _hexval(line[n - 1])
+		cs = 0
+		for i in range(n - 3):
+			cs ^= line[i]
+		if hi < 0 or lo < 0 or cs != ((hi << 4) | lo):
+			self.bad_checksum[idx] += 1
+			return False
+		# locate fields
+		fpos = self.fpos
+		nf = 1
+		fpos[0] = 0
+		for i in range(n - 3):
+			if line[i] == _COMMA and nf < NMEA_MAX_FIELDS:
+				fpos[nf] = i + 1
+				nf += 1
+		fpos[nf] = n - 2 # one past the '*', so that every field ends at fpos[k + 1] - 1
+		self.nfields = nf
+		self.bad = False
+		if idx == NMEA_IDX_RMC:
+			if nf < 12:
+				self.truncated[idx] += 1
+				return False
+			self._parse_rmc()
+		elif idx == NMEA_IDX_GGA:
+			if nf < 12:
+				self.truncated[idx] += 1
+				return False
+			self._parse_gga()
+		if self.bad:
+			self.bad_value[idx] += 1
+			return False
+		self.good[idx] += 1
+		return True
+
+	# field boundaries: [start, end)
+	def _fs(self, k):
+		return self.fpos[k]
+
+	def _fe(self, k):
+		return self.fpos[k + 1] - 1
+
+	def _flen(self, k):
+		return self.fpos[k + 1] - 1 - self.fpos[k]
+
+	# first char of field k (a char code)
+	def _fchar(self, k, default):
+		if self._flen(k) > 0:
+			return self.line[self._fs(k)]
+		return default
+
+	# an out of range field: the sentence is rejected, default stored meanwhile
+	def _bad(self, default):
+		self.bad = True
+		return default
+
+	def _fint(self, k, default):
+		s = self._fs(k)
+		e = self._fe(k)
+		if e <= s:
+			return default
+		v = 0
+		line = self.line
+		for i in range(s, e):
+			c = line[i] - 48
+			if c < 0 or c > 9:
+				return default
+			if v > _TIMES10_MAX:
+				return self._bad(default)
+			v = v * 10 + c
+		if v > NMEA_VALUE_MAX:
+			return self._bad(default)
+		return v
+
+	# decimal field as a fixed-point integer with `dec` decimals (default
+	# beyond NMEA_VALUE_MAX)
+	def _ffix(self, k, dec, start=-1, default=0):
+		s = self._fs(k) if start < 0 else start
+		e = self._fe(k)
+		line = self.line
+		v = 0
+		neg = False
+		frac = -1
+		for i in range(s, e):
+			c = line[i]
+			if c == _DOT:
+				frac = 0
+			elif c == 45 and i == s:
+				neg = True
+			elif 48 <= c <= 57:
+				if frac < dec:
+					if v > _TIMES10_MAX:
+						return self._bad(default)
+					v = v * 10 + c - 48
+					if frac >= 0:
+						frac += 1
+		if frac < 0:
+			frac = 0
+		while frac < dec:
+			if v > _TIMES10_MAX:
+				return self._bad(default)
+			v *= 10
+			frac += 1
+		if v > NMEA_VALUE_MAX:
+			return self._bad(default)
+		if neg:
+			return -v
+		return v
+
+	def _ffix_or(self, k, dec, default):
+		if self._flen(k) == 0:
+			return default
+		return self._ffix(k, dec, -1, default)
+
+	# "hhmmss.ss" -> ms of day, 0 if too short
+	def _ftime_ms(self, k):
+		if self._flen(k) < 6:
+			return 0
+		s = self._fs(k)
+		line = self.line
+		hh = (line[s] - 48) * 10 + line[s + 1] - 48
+		mm = (line[s + 2] - 48) * 10 + line[s + 3] - 48
+		return (hh * 60 + mm) * 60000 + self._ffix(k, 3, s + 4)
+
+	# "ddmm.mmmmm" / "dddmm.mmmmm" -> degrees * 1e7, or None if missing or
+	# beyond max_e7
+	def _fangle_e7(self, k, deg_digits, max_e7):
+		if self._flen(k) <= 2:
+			return None
+		s = self._fs(k)
+		line = self.line
+		deg = 0
+		for i in range(s, s + deg_digits):
+			c = line[i] - 48
+			if c < 0 or c > 9:
+				return self._bad(None)
+			deg = deg * 10 + c
+		min_e5 = self._ffix(k, 5, s + deg_digits, -1)
+		if min_e5 < 0 or min_e5 >= 6000000:
+			return self._bad(None)
+		e7 = deg * 10000000 + (min_e5 * 100 + 30) // 60
+		if e7 > max_e7:
+			return self._bad(None)
+		return e7
+
+	def _parse_latlon(self, k):
+		v = self.v
+		lat = self._fangle_e7(k, 2, NMEA_LAT_MAX)
+		if lat is None:
+			v[GPSR_LAT] = GPSR_LAT_INVALID
+		elif self._fchar(k + 1, 78) == 78: # 'N'
+			v[GPSR_LAT] = lat
+		else:
+			v[GPSR_LAT] = -lat
+		lon = self._fangle_e7(k + 2, 3, NMEA_LON_MAX)
+		if lon is None:
+			v[GPSR_LON] = GPSR_LON_INVALID
+		elif self._fchar(k + 3, 69) == 69: # 'E'
+			v[GPSR_LON] = lon
+		else:
+			v[GPSR_LON] = -lon
+		pass
+
+	def _parse_rmc(self):
+		v = self.v
+		v[GPSR_TIME] = self._ftime_ms(1)
+		if self._fchar(2, 86) == 65: # 'A'
+			v[GPSR_STATUS] = 65
+		else:
+			v[GPSR_STATUS] = 86 # 'V'
+		self._parse_latlon(3)
+		v[GPSR_SPEED] = self._ffix_or(7, 3, -1000)
+		v[GPSR_COURSE] = self._ffix_or(8, 2, -100)
+		v[GPSR_DATE] = self._fint(9, 0)
+		v[GPSR_MVAR] = self._ffix_or(10, 2, 0)
+		v[GPSR_MODE] = self._fchar(12, 78) if self.nfields > 12 else 78 # 'N'
+		pass
+
+	def _parse_gga(self):
+		v = self.v
+		v[GPSR_TIME] = self._ftime_ms(1)
+		self._parse_latlon(2)
+		v[GPSR_FIX] = self._fint(6, -1)
+		v[GPSR_SATS] = self._fint(7, -1)
+		v[GPSR_HDOP] = self._ffix_or(8, 2, 10000)
+		v[GPSR_ALT] = self._ffix_or(9, 2, -100)
+		v[GPSR_ALT_REF] = self._ffix_or(11, 2, -100)
+		pass
@@ -31,18 +31,30 @@ _TOKEN_CMD25 = const(0xFC)
 _TOKEN_STOP_TRAN = const(0xFD)
 _TOKEN_DATA = const(0xFE)
 
+# bytes clocked per poll while waiting for a data token or for the end of
+# busy; must stay below the 16-byte CSD so a poll never reads past a block
+_POLL_LEN = const(8)
+_INIT_BAUDRATE = const(100000)
+
 
 class SDCard:
-    def __init__(self, spi, cs):
+    def __init__(self, spi, cs, baudrate=1320000):
         self.spi = spi
         self.cs = cs
+        self.baudrate = baudrate
 
         self.cmdbuf = bytearray(6)
         self.dummybuf = bytearray(512)
         self.tokenbuf = bytearray(1)
+        self.pollbuf = bytearray(_POLL_LEN)
         for i in range(512):
             self.dummybuf[i] = 0xFF
         self.dummybuf_memoryview = memoryview(self.dummybuf)
+        # dummy bytes for the rest of a block after k polled data bytes
+        self.dummy_tails = [self.dummybuf_memoryview[: 512 - k] for k in range(_POLL_LEN)]
+        # views buf[k:] of the last buffer read into, see _tail_view()
+        self.tail_buf = None
+        self.tail_views = [None] * _POLL_LEN
 
         # initialise the card
         self.init_card()
@@ -62,7 +74,7 @@ class SDCard:
         self.cs.init(self.cs.OUT, value=1)
 
         # init SPI bus; use low data rate for initialisation
-        self.init_spi(1320000)
+        self.init_spi(_INIT_BAUDRATE)
 
         # clock card at least 100 cycles with cs high
         for i in range(16):
@@ -106,7 +118,7 @@ class SDCard:
             raise OSError("can't set 512 block size")
 
         # set to high data rate now that it's initialised
-        self.init_spi(1320000)
+        self.init_spi(self.baudrate)
 
     def init_card_v1(self):
         for i in range(_CMD_TIMEOUT):
@@ -135,10 +147,10 @@ class SDCard:
         # create and send the command
         buf = self.cmdbuf
         buf[0] = 0x40 | cmd
-        buf[1] = arg >> 24
-        buf[2] = arg >> 16
-        buf[3] = arg >> 8
-        buf[4] = arg
+        buf[1] = (arg >> 24) & 0xFF
+        buf[2] = (arg >> 16) & 0xFF
+        buf[3] = (arg >> 8) & 0xFF
+        buf[4] = arg & 0xFF
         buf[5] = crc
         self.spi.write(buf)
 
@@ -166,62 +178,101 @@ class SDCard:
     def readinto(self, buf):
         self.cs(0)
 
-        # read until start byte (0xff)
+        # read until start byte (0xfe), _POLL_LEN bytes at a time
+        pb = self.pollbuf
+        k = -1
         for i in range(_CMD_TIMEOUT):
-            self.spi.readinto(self.tokenbuf, 0xFF)
-            print(self.tokenbuf[0])
-            if self.tokenbuf[0] == _TOKEN_DATA:
+            self.spi.readinto(pb, 0xFF)
+            for j in range(_POLL_LEN):
+                if pb[j] == _TOKEN_DATA:
+                    k = j + 1
+                    break
+            if k >= 0:
                 break
         else:
             self.cs(1)
             raise OSError("timeout waiting for response")
 
+        # the bytes polled after the token are the start of the data
+        n = len(buf)
+        k = _POLL_LEN - k
+        for j in range(k):
+            buf[j] = pb[_POLL_LEN - k + j]
+
         # read data
-        mv = self.dummybuf_memoryview
-        if len(buf) != len(mv):
-            mv = mv[: len(buf)]
-        self.spi.write_readinto(mv, buf)
+        if n == 512:
+            mv = self.dummy_tails[k]
+        else:
+            mv = self.dummybuf_memoryview[: n - k]  # CSD/CID, at init only
+        if k:
+            self.spi.write_readinto(mv, self._tail_view(buf, k))
+        else:
+            self.spi.write_readinto(mv, buf)
 
         # read checksum
-        self.spi.write(b"\xff")
-        self.spi.write(b"\xff")
+        self.spi.write(b"\xff\xff")
 
         self.cs(1)
         self.spi.write(b"\xff")
 
+    # buf[k:], kept for the next reads into the same buffer (the SD log
+    # reads into its own blocks)
+    def _tail_view(self, buf, k):
+        if buf is not self.tail_buf:
+            self.tail_buf = buf
+            for j in range(_POLL_LEN):
+                self.tail_views[j] = None
+        v = self.tail_views[k]
+        if v is None:
+            v = memoryview(buf)[k:]
+            self.tail_views[k] = v
+        return v
+
     def write(self, token, buf):
         self.cs(0)
 
         # send: start of block, data, checksum
-        self.spi.read(1, token)
+        self.spi.readinto(self.tokenbuf, token)
         self.spi.write(buf)
-        self.spi.write(b"\xff")
-        self.spi.write(b"\xff")
+        self.spi.write(b"\xff\xff")
 
         # check the response
-        if (self.spi.read(1, 0xFF)[0] & 0x1F) != 0x05:
+        self.spi.readinto(self.tokenbuf, 0xFF)
+        if (self.tokenbuf[0] & 0x1F) != 0x05:
             self.cs(1)
             self.spi.write(b"\xff")
             return
 
         # wait for write to finish
-        while self.spi.read(1, 0xFF)[0] == 0:
-            pass
+        self.wait_busy()
 
         self.cs(1)
         self.spi.write(b"\xff")
 
     def write_token(self, token):
         self.cs(0)
-        self.spi.read(1, token)
+        self.spi.readinto(self.tokenbuf, token)
         self.spi.write(b"\xff")
         # wait for write to finish
-        while self.spi.read(1, 0xFF)[0] == 0x00:
-            pass
+        self.wait_busy()
 
         self.cs(1)
         self.spi.write(b"\xff")
 
+    # the card holds MISO low while busy; once the last polled byte is
+    # non-zero it has released the line. _CMD_TIMEOUT polls back to back,
+    # then as many 1 ms apart (the write timeout of the spec is 250 ms)
+    def wait_busy(self):
+        pb = self.pollbuf
+        for i in range(2 * _CMD_TIMEOUT):
+            self.spi.readinto(pb, 0xFF)
+            if pb[_POLL_LEN - 1] != 0:
+                return
+            if i >= _CMD_TIMEOUT:
+                time.sleep_ms(1)
+        self.cs(1)
+        raise OSError("timeout waiting for the card")
+
     def readblocks(self, block_num, buf):
         nblocks = len(buf) // 512
         assert nblocks and not len(buf) % 512, "Buffer length is invalid"
@@ -0,0 +1,275 @@
+# On-device logging of the binary telemetry frames (vsproto.py) to an SD
+# card, written as raw 512-byte sectors through SDCard.writeblocks.
+#
+# Frames are packed into two preallocated buffers of `burst` sectors each.
+# log() only copies into the active buffer; when it is full the buffers
+# are swapped and the full one is written by service() with a single
+# multi-block (CMD25) write, outside of the sampling callbacks.
+# A frame never spans two sectors: the tail of a sector is zero-padded.
+#
+# Session layout, starting at start_block:
+#   sector 0    header: SDLOG_MAGIC, version, session id, start ticks
+#   sector 1..  frames; every sync_every sectors the first frame is a
+#               PROTO_MSG_SYNC frame (ticks, sector index, session)
+# The card area is used raw: it must not hold a filesystem.
+#
+# SdRegion manages a reserved raw area (e.g. the tail of the card, left
+# out of the partition table) holding consecutive sessions. Its first
+# block is a superblock indexing them, so host tools can find session
+# boundaries without scanning. It never starts at block 0 (the MBR), and
+# an area without a valid superblock is only written after an explicit
+# format(). Nothing goes through FAT, so there are no
+# metadata updates or cluster allocation stalls while logging.
+
+import utime
+from ustruct import pack_into, unpack_from
+from vsproto import FrameEncoder, PROTO_MSG_SYNC, PROTO_FMT_SYNC, PROTO_HEADER_LEN
+
+SDLOG_SECTOR = 512
+SDLOG_BURST_SECTORS = 8
+SDLOG_SYNC_EVERY = 64
+SDLOG_MAGIC = b'VSLG'
+SDLOG_VERSION = 1
+SDLOG_FMT_HEADER = '<4sBBHIII' # magic, version, burst, session, t0 [ms], start block, sync_every
+
+SDREG_MAGIC = b'VSRG'
+SDREG_VERSION = 1
+SDREG_FMT_SUPER = '<4sBBHII' # magic, version, reserved, n sessions, region start, region blocks
+SDREG_ENTRY_OFS = 32
+SDREG_FMT_ENTRY = '<HHIII' # session, flags, start block, n blocks, t0 [ms]
+SDREG_ENTRY_LEN = 16
+SDREG_MAX_SESSIONS = (SDLOG_SECTOR - SDREG_ENTRY_OFS) // SDREG_ENTRY_LEN
+SDREG_FLAG_OPEN = 0x01 # n blocks is a lower bound (not stopped cleanly)
+SDREG_INDEX_EVERY = 32 # bursts between superblock updates
+SDREG_MIN_START = 1 # block 0 holds the MBR / partition table
+
+class SdLogger:
+	def __init__(self, sd, start_block, n_blocks=0, burst=SDLOG_BURST_SECTORS, \
+		sync_every=SDLOG_SYNC_EVERY, session=0, region=None, entry=-1):
+		self.sd = sd
+		self.start_block = start_block
+		if n_blocks <= 0:
+			n_blocks = sd.ioctl(4, 0) - start_block
+		self.end_block = start_block + n_blocks
+		self.burst = burst
+		self.sync_every = sync_every
+		self.session = session
+		self.region = region
+		self.entry = entry
+		self.buf_len = SDLOG_SECTOR * burst
+		self.bufs = (bytearray(self.buf_len), bytearray(self.buf_len))
+		self.mvs = (memoryview(self.bufs[0]), memoryview(self.bufs[1]))
+		self.sync_enc = FrameEncoder(PROTO_MSG_SYNC)
+		self.active = 0
+		self.pos = 0
+		self.sec_end = 0 # end of the open sector in the active buffer
+		self.pending = -1 # buffer waiting for service(), -1 if none
+		self.next_block = start_block
+		self.sector_index = 0 # sectors handed out so far in this session
+		self.running = False
+		self.full = False
+		self.frames_logged = 0
+		self.frames_dropped = 0
+		self.bytes_logged = 0
+		self.sectors_written = 0
+		self.bursts = 0
+		self.write_ms_max = 0
+		pass
+
+	def start(self):
+		self.active = 0
+		self.pending = -1
+		self.next_block = self.start_block
+		self.sector_index = 0
+		self.full = False
+		buf = self.bufs[0]
+		for i in range(SDLOG_SECTOR):
+			buf[i] = 0
+		pack_into(SDLOG_FMT_HEADER, buf, 0, SDLOG_MAGIC, SDLOG_VERSION, self.burst, \
+			self.session, utime.ticks_ms(), self.start_block, self.sync_every)
+		self.pos = SDLOG_SECTOR
+		self.sec_end = SDLOG_SECTOR
+		self._next_sector()
+		self.running = True
+		pass
+
+	# Copies one frame into the active buffer. Never touches the card.
+	def log(self, frame):
+		if not self.running:
+			return False
+		n = len(frame)
+		if self.pos + n > self.sec_end:
+			if not self._next_sector():
+				self.frames_dropped += 1
+				return False
+		p = self.pos
+		self.mvs[self.active][p:p + n] = frame
+		self.pos = p + n
+		self.frames_logged += 1
+		self.bytes_logged += n
+		return True
+
+	# Pads the current sector and moves to the next one, swapping buffers
+	# when needed. Returns False if the other buffer is still unwritten.
+	def _next_sector(self):
+		buf = self.bufs[self.active]
+		p = self.sec_end
+		for i in range(self.pos, p):
+			buf[i] = 0
+		self.pos = p
+		if p >= self.buf_len:
+			if self.pending >= 0:
+				return False
+			self.pending = self.active
+			self.active ^= 1
+			p = 0
+		self.pos = p
+		self.sec_end = p + SDLOG_SECTOR
+		self.sector_index += 1
+		if (self.sector_index - 1) % self.sync_every == 0:
+			pack_into(PROTO_FMT_SYNC, self.sync_enc.frame, PROTO_HEADER_LEN, \
+				utime.ticks_ms(), self.sector_index, self.session)
+			f = self.sync_enc.finalize()
+			self.mvs[self.active][p:p + len(f)] = f
+			self.pos = p + len(f)
+		return True
+
+	# Writes the pending buffer, if any. Call it from the main loop.
+	def service(self):
+		if self.pending < 0:
+			return False
+		self._write(self.bufs[self.pending])
+		self.pending = -1
+		return True
+
+	def _write(self, buf):
+		nblocks = len(buf) // SDLOG_SECTOR
+		if self.next_block + nblocks > self.end_block:
+			self.full = True
+			self.running = False
+			return
+		t0 = utime.ticks_ms()
+		self.sd.writeblocks(self.next_block, buf)
+		self.next_block += nblocks
+		self.sectors_written += nblocks
+		self.bursts += 1
+		if not (self.region is None) and self.bursts % SDREG_INDEX_EVERY == 0:
+			self.region.update_session(self.entry, self.next_block - self.start_block, True)
+		dt = utime.ticks_diff(utime.ticks_ms(), t0)
+		if dt > self.write_ms_max:
+			self.write_ms_max = dt
+		pass
+
+	# Flushes everything, including the partially filled sector.
+	def stop(self):
+		self.running = False
+		self.service()
+		end = self.sec_end
+		if end > 0:
+			buf = self.bufs[self.active]
+			for i in range(self.pos, end):
+				buf[i] = 0
+			self._write(self.mvs[self.active][0:end])
+			self.pos = 0
+			self.sec_end = 0
+		if not (self.region is None):
+			self.region.update_session(self.entry, self.next_block - self.start_block, False)
+		pass
+
+	# Services the buffers until interrupted (Ctrl-C), then flushes.
+	def run(self, idle_ms=2):
+		try:
+			while self.running:
+				if not self.service():
+					utime.sleep_ms(idle_ms)
+		finally:
+			self.stop()
+		pass
+
+	def stats(self):
+		return dict({'frames': self.frames_logged, 'dropped': self.frames_dropped, \
+			'bytes': self.bytes_logged, 'sectors': self.sectors_written, \
+			'bursts': self.bursts, 'write_ms_max': self.write_ms_max})
+
+class SdRegion:
+	def __init__(self, sd, start_block, n_blocks=0):
+		if start_block < SDREG_MIN_START:
+			raise ValueError("sdlog: the region cannot start at block 0 (MBR)")
+		self.sd = sd
+		self.start_block = start_block
+		if n_blocks <= 0:
+			n_blocks = sd.ioctl(4, 0) - start_block
+		self.n_blocks = n_blocks
+		self.sb = bytearray(SDLOG_SECTOR)
+		self.n_sessions = 0
+		pass
+
+	# Reads the superblock. False (and nothing written) for an area without
+	# one, or with one for a different geometry: format() it explicitly.
+	def mount(self):
+		self.sd.readblocks(self.start_block, self.sb)
+		magic, version, res, n, start, blocks = unpack_from(SDREG_FMT_SUPER, self.sb, 0)
+		if magic != SDREG_MAGIC or version != SDREG_VERSION or start != self.start_block \
+			or blocks != self.n_blocks or n > SDREG_MAX_SESSIONS:
+			self.n_sessions = 0
+			return False
+		self.n_sessions = n
+		return True
+
+	def format(self):
+		for i in range(SDLOG_SECTOR):
+			self.sb[i] = 0
+		self.n_sessions = 0
+		self._write_super()
+		pass
+
+	def _write_super(self):
+		pack_into(SDREG_FMT_SUPER, self.sb, 0, SDREG_MAGIC, SDREG_VERSION, 0, \
+			self.n_sessions, self.start_block, self.n_blocks)
+		self.sd.writeblocks(self.start_block, self.sb)
+		pass
+
+	def session(self, k):
+		return unpack_from(SDREG_FMT_ENTRY, self.sb, SDREG_ENTRY_OFS + k * SDREG_ENTRY_LEN)
+
+	def free_block(self):
+		if self.n_sessions == 0:
+			return self.start_block + 1
+		sess, flags, start, n, t0 = self.session(self.n_sessions - 1)
+		if flags & SDREG_FLAG_OPEN:
+			# not stopped cleanly: up to SDREG_INDEX_EVERY bursts (plus the
+			# two buffers in flight) may have been written after the last
+			# index update. The burst size is in the session header.
+			hdr = bytearray(SDLOG_SECTOR)
+			self.sd.readblocks(start, hdr)
+			burst = hdr[5] if hdr[0:4] == SDLOG_MAGIC else SDLOG_BURST_SECTORS
+			n += (SDREG_INDEX_EVERY + 2) * burst
+		return start + n
+
+	# Registers a new session after the last one and returns its logger,
+	# or None when the index or the area is full.
+	def new_session(self, burst=SDLOG_BURST_SECTORS, sync_every=SDLOG_SYNC_EVERY):
+		k = self.n_sessions
+		if k >= SDREG_MAX_SESSIONS:
+			return None
+		start = self.free_block()
+		end = self.start_block + self.n_blocks
+		if start + 2 * burst > end:
+			return None
+		if k == 0:
+			sess = 1
+		else:
+			sess = (self.session(k - 1)[0] + 1) & 0xFFFF
+		pack_into(SDREG_FMT_ENTRY, self.sb, SDREG_ENTRY_OFS + k * SDREG_ENTRY_LEN, \
+			sess, SDREG_FLAG_OPEN, start, 0, utime.ticks_ms())
+		self.n_sessions = k + 1
+		self._write_super()
+		return SdLogger(self.sd, start, end - start, burst, sync_every, sess, self, k)
+
+	def update_session(self, k, n_blocks, still_open):
+		ofs = SDREG_ENTRY_OFS + k * SDREG_ENTRY_LEN
+		sess, flags, start, n, t0 = unpack_from(SDREG_FMT_ENTRY, self.sb, ofs)
+		flags = SDREG_FLAG_OPEN if still_open else 0
+		pack_into(SDREG_FMT_ENTRY, self.sb, ofs, sess, flags, start, n_blocks, t0)
+		self._write_super()
+		pass
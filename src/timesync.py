@@ -0,0 +1,181 @@
+# Local clock to GPS UTC mapping, so that IMU samples (stamped with
+# ticks_us when they are read) can be given the time of the GPS fixes.
+#
+# With the receiver's timepulse (PPS) wired to a pin, every rising edge is
+# captured with ticks_us in the pin IRQ; the fix that follows and carries a
+# whole second pairs with it: that edge is the local time of that UTC
+# second. Consecutive edges also give the rate error of the local clock,
+# which is removed from the elapsed time (in 1/16 ppm steps).
+# Without PPS the fix arrival times are used instead: they lag the epoch by
+# the receiver output delay plus transmission and polling, so the earliest
+# arrival of every TIMESYNC_MINFILT_FIXES fixes is taken as the bound
+# (accuracy is then a few ms, at best the UART character time).
+#
+# All the arithmetic uses ticks_diff against an anchor at most
+# TIMESYNC_HOLDOVER_MS old, so ticks_us wrapping (every 2**30 us) does not
+# matter and everything stays in small ints: convert() does not allocate.
+# UTC is kept as ms of day plus us within the ms; the date is in the GPS
+# frames.
+
+import machine
+import utime
+from array import array
+
+TIMESYNC_NONE = 0 # no reference yet, or held over too long
+TIMESYNC_FIX = 1 # referenced on the fix arrival times
+TIMESYNC_PPS = 2 # referenced on the PPS edges
+TIMESYNC_NAMES = ('none', 'fix', 'pps')
+
+TIMESYNC_UTC_INVALID = 0xFFFFFFFF
+TIMESYNC_DAY_MS = 86400000
+TIMESYNC_HOLDOVER_MS = 60000 # keeps ticks_diff well within its +/-2**29 us
+TIMESYNC_PPS_WINDOW_US = 1000000 # a fix is paired with an edge at most this old
+TIMESYNC_WHOLE_TOL_MS = 5 # UBX time is floored to the ms: 11:59:59.999 is a whole second
+TIMESYNC_RATE_SPAN_MS = 10000 # longest PPS interval used for the rate estimate
+TIMESYNC_RATE_MAX = 16 * 500 # [1/16 ppm]
+TIMESYNC_MINFILT_FIXES = 10
+TIMESYNC_FIX_MAX_LAG_US = 1000000 # later arrivals are not trusted to bound anything
+
+class TimeSync:
+	def __init__(self, pps_pin=None, fix_latency_us=0):
+		self.pps_pin = pps_pin
+		self.pin = None
+		self.fix_latency_us = fix_latency_us # known receiver output delay, without PPS
+		self.pps_buf = array('I', [0, 0]) # ticks_us of the last edge, edge count (IRQ)
+		self._pps_cb = self._pps_irq # bound once, the IRQ must not allocate
+		self.pps_used = 0
+		self.state = TIMESYNC_NONE
+		self.ref_us = 0 # local ticks_us of the anchor
+		self.ref_ms = 0 # UTC ms of day of the anchor
+		self.rate16 = 0 # local clock rate error [1/16 ppm], > 0 runs fast
+		self.rate_ok = False
+		self.win_min = 0
+		self.win_n = 0
+		self.utc_ms = TIMESYNC_UTC_INVALID # result of the last convert()
+		self.utc_us = 0
+		self.fixes = 0
+		self.pps_pairs = 0
+		self.pps_misses = 0
+		self.reanchors = 0
+		self.lost = 0
+		pass
+
+	def start(self):
+		if self.pps_pin is None:
+			return
+		self.pin = machine.Pin(self.pps_pin, machine.Pin.IN)
+		try:
+			self.pin.irq(trigger=machine.Pin.IRQ_RISING, handler=self._pps_cb, hard=True)
+		except TypeError:
+			# older ports: soft IRQ, the edge is stamped when it is scheduled
+			self.pin.irq(trigger=machine.Pin.IRQ_RISING, handler=self._pps_cb)
+		pass
+
+	def stop(self):
+		if not (self.pin is None):
+			self.pin.irq(handler=None)
+		pass
+
+	def _pps_irq(self, pin):
+		b = self.pps_buf
+		b[0] = utime.ticks_us()
+		b[1] += 1
+
+	# Called for every new fix with the ticks_us its bytes were read at and
+	# its UTC time of day [ms].
+	def on_fix(self, t_us, utc_ms):
+		self.fixes += 1
+		b = self.pps_buf
+		n = b[1]
+		t_pps = b[0]
+		if n != b[1]: # an edge came in between
+			n = b[1]
+			t_pps = b[0]
+		r = (utc_ms + 500) % 1000 - 500
+		if n != self.pps_used and -TIMESYNC_WHOLE_TOL_MS <= r <= TIMESYNC_WHOLE_TOL_MS:
+			self.pps_used = n
+			d = utime.ticks_diff(t_us, t_pps)
+			if 0 <= d < TIMESYNC_PPS_WINDOW_US:
+				self._anchor_pps(t_pps, (utc_ms - r) % TIMESYNC_DAY_MS)
+				return
+			self.pps_misses += 1
+		if self.state == TIMESYNC_PPS and self._age_ms(t_us) < TIMESYNC_HOLDOVER_MS:
+			return # the PPS anchors are better, fixes only stand in when they stop
+		self._anchor_fix(utime.ticks_add(t_us, -self.fix_latency_us), utc_ms)
+		pass
+
+	def _anchor_pps(self, t_pps, utc_ms):
+		if self.state == TIMESYNC_PPS:
+			du = (utc_ms - self.ref_ms) % TIMESYNC_DAY_MS
+			if 0 < du <= TIMESYNC_RATE_SPAN_MS:
+				dl = utime.ticks_diff(t_pps, self.ref_us)
+				rate = ((dl - du * 1000) * 16000) // du
+				if -TIMESYNC_RATE_MAX <= rate <= TIMESYNC_RATE_MAX:
+					if self.rate_ok:
+						self.rate16 += (rate - self.rate16) >> 2
+					else:
+						self.rate16 = rate
+						self.rate_ok = True
+		self.ref_us = t_pps
+		self.ref_ms = utc_ms
+		self.state = TIMESYNC_PPS
+		self.pps_pairs += 1
+		pass
+
+	# The model places utc_ms at local time p; the fix arrived r us later.
+	# r < 0 means an earlier arrival than any seen: it becomes the anchor.
+	# Otherwise the anchor moves forward by the smallest r of the window.
+	def _anchor_fix(self, t_us, utc_ms):
+		if self.state != TIMESYNC_NONE and self._age_ms(t_us) < TIMESYNC_HOLDOVER_MS:
+			p = self._local_of(utc_ms)
+			r = utime.ticks_diff(t_us, p)
+			if 0 <= r < TIMESYNC_FIX_MAX_LAG_US:
+				if self.win_n == 0 or r < self.win_min:
+					self.win_min = r
+				self.win_n += 1
+				if self.win_n >= TIMESYNC_MINFILT_FIXES:
+					self.ref_us = utime.ticks_add(p, self.win_min)
+					self.ref_ms = utc_ms
+					self.state = TIMESYNC_FIX
+					self.win_n = 0
+				return
+		elif self.state != TIMESYNC_NONE:
+			self.lost += 1
+		self.ref_us = t_us
+		self.ref_ms = utc_ms
+		self.state = TIMESYNC_FIX
+		self.win_n = 0
+		self.reanchors += 1
+		pass
+
+	def _age_ms(self, t_us):
+		return utime.ticks_diff(t_us, self.ref_us) // 1000
+
+	# local ticks_us of a UTC time of day, from the current anchor
+	def _local_of(self, utc_ms):
+		du = (utc_ms - self.ref_ms) % TIMESYNC_DAY_MS
+		if du >= TIMESYNC_DAY_MS // 2:
+			du -= TIMESYNC_DAY_MS
+		return utime.ticks_add(self.ref_us, du * 1000 + (du * self.rate16) // 16000)
+
+	# UTC of a local ticks_us: sets utc_ms (ms of day) and utc_us (us within
+	# the ms) and returns the sync state; utc_ms is TIMESYNC_UTC_INVALID when
+	# there is no reference.
+	def convert(self, t_us):
+		if self.state != TIMESYNC_NONE:
+			dt = utime.ticks_diff(t_us, self.ref_us)
+			if -1000 * TIMESYNC_HOLDOVER_MS < dt < 1000 * TIMESYNC_HOLDOVER_MS:
+				dt -= ((dt // 1000) * self.rate16) // 16000
+				self.utc_ms = (self.ref_ms + dt // 1000) % TIMESYNC_DAY_MS
+				self.utc_us = dt % 1000
+				return self.state
+			self.state = TIMESYNC_NONE
+			self.lost += 1
+		self.utc_ms = TIMESYNC_UTC_INVALID
+		self.utc_us = 0
+		return TIMESYNC_NONE
+
+	def stats(self):
+		return dict({'state': TIMESYNC_NAMES[self.state], 'rate_ppm': self.rate16 / 16.0, \
+			'fixes': self.fixes, 'pps_pairs': self.pps_pairs, 'pps_misses': self.pps_misses, \
+			'reanchors': self.reanchors, 'lost': self.lost})
@@ -0,0 +1,139 @@
+# Batching of the IMU output on the Uarduino link (set I2cAcc.batch): up
+# to k samples, or those read within max_wait_ms of the first one, are
+# collected in a preallocated buffer and queued as one message, so the
+# per-message cost (enqueue, drain, uart.write) is paid once per batch
+# instead of once per sample. A batch never exceeds UARDUINO_BUFFER_LIMIT
+# bytes, i.e. one drain() chunk: the Arduino gets it in a single write no
+# larger than what it gets today.
+#   binary: one PROTO_MSG_IMU_BATCH frame (vsproto.py), 13 bytes a sample;
+#           samples in other formats (IMU_UTC) are sent as they are
+#   text:   the ACC lines, CRLF terminated, back to back
+# The wait is only checked when a sample arrives, so a batch can be up
+# to one sample period older than max_wait_ms when it leaves.
+# The latency added (sample read -> queued) is accounted in stats().
+
+import utime
+from ustruct import pack_into, unpack_from
+from uarduino import UARDUINO_BUFFER_LIMIT
+from vsproto import PROTO_MSG_IMU, PROTO_MSG_IMU_BATCH, PROTO_FMT_IMU_BATCH, \
+	PROTO_HEADER_LEN, PROTO_CRC_LEN, PROTO_IMU_BATCH_HEADER_LEN, \
+	PROTO_IMU_BATCH_SAMPLE_LEN, frame_close
+
+TXB_WAIT_MS_DEFAULT = 200
+TXB_OVERHEAD = PROTO_HEADER_LEN + PROTO_IMU_BATCH_HEADER_LEN + PROTO_CRC_LEN
+TXB_DT_MAX = 255 # [ms] between consecutive samples of a batch
+
+_CRLF = b'\r\n'
+
+class ImuBatch:
+	# k: samples per batch, 0 (or too many) for as many as fit
+	def __init__(self, uardu, k=0, max_wait_ms=TXB_WAIT_MS_DEFAULT, limit=UARDUINO_BUFFER_LIMIT):
+		self.uardu = uardu
+		self.limit = limit
+		self.k_max = (limit - TXB_OVERHEAD) // PROTO_IMU_BATCH_SAMPLE_LEN
+		if k <= 0 or k > self.k_max:
+			k = self.k_max
+		self.k = k
+		self.max_wait_ms = max_wait_ms
+		self.buf = bytearray(limit)
+		self.mv = memoryview(self.buf)
+		self.seq = 0
+		self.n = 0
+		self.pos = 0
+		self.text = False # what the pending batch holds
+		self.t0 = 0 # ticks_ms of its first sample
+		self.t_last = 0
+		self.t_rel = 0 # sum of the sample times, relative to t0
+		self.samples = 0
+		self.batches = 0
+		self.bytes_out = 0
+		self.lat_sum = 0 # [ms], over all samples
+		self.lat_max = 0
+		pass
+
+	# binary: takes the IMU frame of one sample (PROTO_FMT_IMU)
+	def add_frame(self, f):
+		if f[2] != PROTO_MSG_IMU:
+			self.flush()
+			self.uardu.send_bytes(f)
+			return
+		t = unpack_from('<I', f, PROTO_HEADER_LEN)[0]
+		dt = utime.ticks_diff(t, self.t_last)
+		if self.n > 0 and (self.text or dt < 0 or dt > TXB_DT_MAX):
+			self.flush()
+		if self.n == 0:
+			self.pos = PROTO_HEADER_LEN + PROTO_IMU_BATCH_HEADER_LEN
+			self.text = False
+			self._first(t)
+			dt = 0
+		self.buf[self.pos] = dt
+		p = self.pos + 1
+		self.mv[p:p + 12] = f[PROTO_HEADER_LEN + 4:PROTO_HEADER_LEN + 16]
+		self.pos = p + 12
+		self._added(t)
+		pass
+
+	# text: takes one output line (without terminator), as a str or
+	# already encoded (vsfmt.LineFormat.line())
+	def add_line(self, s, t):
+		b = s.encode() if isinstance(s, str) else s
+		n = len(b) + 2
+		if n > self.limit:
+			self.flush()
+			self.uardu.send_line(b)
+			return
+		if self.n > 0 and (not self.text or self.pos + n > self.limit):
+			self.flush()
+		if self.n == 0:
+			self.pos = 0
+			self.text = True
+			self._first(t)
+		p = self.pos
+		self.mv[p:p + n - 2] = b
+		self.mv[p + n - 2:p + n] = _CRLF
+		self.pos = p + n
+		self._added(t)
+		if self.n > 0 and self.pos + n > self.limit:
+			self.flush() # a line like this one would not fit
+		pass
+
+	def _first(self, t):
+		self.t0 = t
+		self.t_rel = 0
+		pass
+
+	def _added(self, t):
+		self.n += 1
+		self.t_last = t
+		self.t_rel += utime.ticks_diff(t, self.t0)
+		if self.n >= self.k or utime.ticks_diff(t, self.t0) >= self.max_wait_ms:
+			self.flush()
+		pass
+
+	# queues the pending batch, if any
+	def flush(self):
+		n = self.n
+		if n == 0:
+			return
+		if self.text:
+			total = self.pos
+		else:
+			pack_into(PROTO_FMT_IMU_BATCH, self.buf, PROTO_HEADER_LEN, self.t0 & 0xFFFFFFFF, n)
+			total = frame_close(self.buf, PROTO_MSG_IMU_BATCH, self.seq, self.pos - PROTO_HEADER_LEN)
+			self.seq = (self.seq + 1) & 0xFF
+		self.uardu.send_bytes(self.mv[0:total])
+		age = utime.ticks_diff(utime.ticks_ms(), self.t0)
+		self.lat_sum += n * age - self.t_rel
+		if age > self.lat_max:
+			self.lat_max = age
+		self.samples += n
+		self.batches += 1
+		self.bytes_out += total
+		self.n = 0
+		pass
+
+	def stats(self):
+		s = self.samples
+		return dict({'k': self.k, 'samples': s, 'batches': self.batches, 'bytes': self.bytes_out, \
+			'bytes_per_sample': self.bytes_out / s if s else 0.0, \
+			'lat_mean_ms': self.lat_sum / s if s else 0.0, 'lat_max_ms': self.lat_max})
@@ -0,0 +1,207 @@
+# Transmit policy for the Uarduino link: decides, sample by sample, what
+# of a sensor's output is worth the bytes (set I2cAcc.txpolicy /
+# UartGps.txpolicy). It works on the fixed-point values of the binary
+# frame (vsproto.py), whatever the output mode:
+#   - deadband: a sample whose data fields all moved less than their
+#     deadband from the last sent values is suppressed (the time fields,
+#     the first TXP_TIME_FIELDS of the format, do not count);
+#   - delta: in binary mode, a sample is sent as a PROTO_MSG_DELTA frame
+#     holding only the fields that changed, as differences from the last
+#     sent frame, when that is shorter than the full frame;
+#   - keyframes: a full frame at least every keyframe_ms, so that the
+#     receiver can resync after a lost frame (or start listening late);
+#   - rate: while the Uarduino queue is above TXP_HIGH_FRAC of its size
+#     only one sample in `div` is considered, div doubling up to
+#     TXP_DIV_MAX; it halves again once the queue is below TXP_LOW_FRAC.
+# Sent frames (full and delta) have their own sequence numbers, continuous
+# over what goes on the link: a gap means a lost frame, and the receiver
+# (vsproto.DeltaExpander) waits for the next keyframe.
+# The SD log is not filtered. Byte counts are in binary frame bytes, also
+# in text mode.
+
+import utime
+from ustruct import unpack_from, pack_into
+from vsproto import FrameEncoder, PROTO_FORMATS, PROTO_FIELDS, PROTO_HEADER_LEN, \
+	PROTO_CRC_LEN, PROTO_MSG_DELTA, PROTO_DELTA_I8, PROTO_DELTA_T32, PROTO_DELTA_HEADER_LEN, \
+	PROTO_DELTA_TIME_FIELDS, frame_close
+
+TXP_KEYFRAME_MS = 2000
+TXP_DIV_MAX = 16
+TXP_HIGH_FRAC = 0.75 # of the Uarduino queue size
+TXP_LOW_FRAC = 0.25
+# leading fields carrying time: they change every sample
+TXP_TIME_FIELDS = PROTO_DELTA_TIME_FIELDS
+
+class TxPolicy:
+	# deadband: one value per field of the message format (0: any change
+	# counts), or None to send every sample
+	def __init__(self, msg_type, uardu=None, deadband=None, keyframe_ms=TXP_KEYFRAME_MS, \
+		div_max=TXP_DIV_MAX):
+		self.msg_type = msg_type
+		self.fmt = PROTO_FORMATS[msg_type]
+		self.n = len(PROTO_FIELDS[msg_type])
+		self.n_time = TXP_TIME_FIELDS.get(msg_type, 0)
+		self.uardu = uardu
+		if deadband is None:
+			self.deadband = None
+		else:
+			if len(deadband) != self.n:
+				raise ValueError("deadband needs {} values".format(self.n))
+			self.deadband = tuple(deadband)
+		self.keyframe_ms = keyframe_ms
+		self.div_max = div_max
+		self.key_enc = FrameEncoder(msg_type)
+		self.full_len = len(self.key_enc.frame)
+		self.last = [0] * self.n # values of the last sent frame
+		self.has_last = False
+		self.t_key = 0
+		self.dframe = bytearray(PROTO_HEADER_LEN + PROTO_DELTA_HEADER_LEN + 2 * self.n + \
+			2 * self.n_time + PROTO_CRC_LEN) # time fields up to int32
+		self.dmv = memoryview(self.dframe)
+		self.div = 1
+		self.k = 0
+		self.offered = 0
+		self.keyframes = 0
+		self.deltas = 0
+		self.suppressed = 0
+		self.rate_skipped = 0
+		self.bytes_in = 0
+		self.bytes_out = 0
+		pass
+
+	def reset(self):
+		self.has_last = False
+		self.div = 1
+		self.k = 0
+		pass
+
+	# Takes the full frame of one sample and returns what to send for it:
+	# None (nothing), a keyframe or, with delta_ok, a DELTA frame. The
+	# returned buffer is reused by the next call.
+	def filter(self, frame, delta_ok=True):
+		self.offered += 1
+		self.bytes_in += self.full_len
+		if not self._rate_ok():
+			self.rate_skipped += 1
+			return None
+		v = unpack_from(self.fmt, frame, PROTO_HEADER_LEN)
+		now = utime.ticks_ms()
+		if not self.has_last or utime.ticks_diff(now, self.t_key) >= self.keyframe_ms:
+			return self._key(v, now)
+		last = self.last
+		db = self.deadband
+		if not (db is None):
+			moved = False
+			for i in range(self.n_time, self.n):
+				d = v[i] - last[i]
+				if d > db[i] or d < -db[i]:
+					moved = True
+					break
+			if not moved:
+				self.suppressed += 1
+				return None
+		if delta_ok:
+			f = self._delta(v)
+			if not (f is None):
+				return f
+		return self._key(v, now)
+
+	# while the queue backs up, only one sample in div goes through
+	def _rate_ok(self):
+		u = self.uardu
+		if u is None:
+			return True
+		k = self.k + 1
+		if k < self.div:
+			self.k = k
+			return False
+		self.k = 0
+		size = len(u.txbuf)
+		p = u.pending()
+		if p > size * TXP_HIGH_FRAC:
+			if self.div < self.div_max:
+				self.div *= 2
+		elif p < size * TXP_LOW_FRAC and self.div > 1:
+			self.div //= 2
+		return True
+
+	def _key(self, v, now):
+		f = self.key_enc.encode(*v)
+		last = self.last
+		for i in range(self.n):
+			last[i] = v[i]
+		self.has_last = True
+		self.t_key = now
+		self.keyframes += 1
+		self.bytes_out += self.full_len
+		return f
+
+	# Builds the DELTA frame against self.last; None when a difference does
+	# not fit (16 bits, 32 for the time fields) or the result is not shorter
+	# than the full frame. The time fields go as int32 only when they do not
+	# fit the width of the others (IMU_UTC t_us moves by the period in us).
+	def _delta(self, v):
+		last = self.last
+		db = self.deadband
+		nt = self.n_time
+		mask = 0
+		nch = 0
+		n_time = 0
+		small = True # data differences within int8
+		t_small = True # time differences within int8
+		t32 = False # time differences beyond int16
+		for i in range(self.n):
+			d = v[i] - last[i]
+			if d == 0 or (i >= nt and not (db is None) and -db[i] <= d <= db[i]):
+				continue # within the deadband the receiver keeps the old value
+			if i < nt:
+				if d < -2147483648 or d > 2147483647:
+					return None
+				if d < -32768 or d > 32767:
+					t32 = True
+				if d < -128 or d > 127:
+					t_small = False
+				n_time += 1
+			else:
+				if d < -32768 or d > 32767:
+					return None
+				if d < -128 or d > 127:
+					small = False
+			mask |= 1 << i
+			nch += 1
+		if not t32:
+			small = small and t_small
+		width = 1 if small else 2
+		plen = PROTO_DELTA_HEADER_LEN + width * nch
+		if t32:
+			plen += (4 - width) * n_time
+		total = PROTO_HEADER_LEN + plen + PROTO_CRC_LEN
+		if total >= self.full_len:
+			return None
+		f = self.dframe
+		f[PROTO_HEADER_LEN] = self.msg_type | (PROTO_DELTA_I8 if small else 0) | \
+			(PROTO_DELTA_T32 if t32 else 0)
+		pack_into('<H', f, PROTO_HEADER_LEN + 1, mask)
+		p = PROTO_HEADER_LEN + PROTO_DELTA_HEADER_LEN
+		fmt = '<b' if small else '<h'
+		for i in range(self.n):
+			if mask & (1 << i):
+				if t32 and i < nt:
+					pack_into('<i', f, p, v[i] - last[i])
+					p += 4
+				else:
+					pack_into(fmt, f, p, v[i] - last[i])
+					p += width
+				last[i] = v[i]
+		enc = self.key_enc
+		frame_close(f, PROTO_MSG_DELTA, enc.seq, plen)
+		enc.seq = (enc.seq + 1) & 0xFF
+		self.deltas += 1
+		self.bytes_out += total
+		return self.dmv[0:total]
+
+	def stats(self):
+		return dict({'offered': self.offered, 'key': self.keyframes, 'delta': self.deltas, \
+			'suppressed': self.suppressed, 'rate_skipped': self.rate_skipped, 'div': self.div, \
+			'bytes_in': self.bytes_in, 'bytes_out': self.bytes_out, \
+			'bytes_saved': self.bytes_in - self.bytes_out})
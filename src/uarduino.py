@@ -2,40 +2,244 @@
 
 import machine
 import utime
+from array import array
 
 UARDUINO_PIN_TX = 16
 UARDUINO_PIN_RX = 17
 UARDUINO_BAUDRATE = 38400
 UARDUINO_UART_ID = 1
 UARDUINO_BUFFER_LIMIT = 128
+UARDUINO_CHUNK_GAP_MS = 50
+UARDUINO_TXBUF_SIZE = 2048 # at most 65535 (message ends are kept as 'H')
+UARDUINO_MSG_SLOTS = 256 # messages queued at once
+
+# what to do when a message does not fit in the transmit buffer
+UARDUINO_POLICY_DROP_OLDEST = 0
+UARDUINO_POLICY_DROP_NEWEST = 1
+UARDUINO_POLICY_BLOCK = 2 # waits for the link: never use it from a timer callback
+
+_CRLF = b'\r\n'
 
 class Uarduino:
 	def __init__(self, pin_tx=UARDUINO_PIN_TX, pin_rx=UARDUINO_PIN_RX, \
-		baudrate=UARDUINO_BAUDRATE, uartid=UARDUINO_UART_ID):
+		baudrate=UARDUINO_BAUDRATE, uartid=UARDUINO_UART_ID, \
+		txbuf_size=UARDUINO_TXBUF_SIZE, policy=UARDUINO_POLICY_DROP_OLDEST):
 		self.pin_tx = pin_tx
 		self.pin_rx = pin_rx
 		self.uartid = uartid
 		self.baudrate = baudrate
 		self.uart = machine.UART(self.uartid, baudrate=self.baudrate, \
 			tx=self.pin_tx, rx=self.pin_rx)
-		self.str2send = ""
+		self.policy = policy
+		# send_* drain right away; a runtime with its own transmit task
+		# (vsasync.py) turns this off
+		self.auto_drain = True
+		# ring buffer: head is written by send_*, tail by drain. One slot
+		# is always left empty so that head == tail means "empty".
+		self.txbuf = bytearray(txbuf_size)
+		self.txmv = memoryview(self.txbuf)
+		self.head = 0
+		self.tail = 0
+		# ends of the queued messages, oldest at msg_tail, so that only
+		# whole messages are dropped; msg_start is where the oldest begins
+		# (before tail while it is partly sent). _retire() runs before each
+		# message goes in, while no sent end can have been written over.
+		self.msg_end = array('H', [0] * UARDUINO_MSG_SLOTS)
+		self.msg_head = 0
+		self.msg_tail = 0
+		self.msg_start = 0
+		self.t_next_write = utime.ticks_ms()
+		self.bytes_queued = 0
+		self.bytes_sent = 0
+		self.bytes_dropped = 0 # rejected or evicted
+		self.bytes_evicted = 0 # of those, queued and then dropped unsent
+		self.msgs_dropped = 0
+		self.writes = 0 # uart.write calls
 		pass
-	
+
+	# number of bytes waiting to be sent
+	def pending(self):
+		return (self.head - self.tail) % len(self.txbuf)
+
+	def free(self):
+		return len(self.txbuf) - 1 - self.pending()
+
 	def send_str(self, str_in):
-		self.str2send = self.str2send + str_in + '\r\n'
-		keep_writing = True
-		while keep_writing:
-			b = bytearray()
-			b.extend(self.str2send[0:UARDUINO_BUFFER_LIMIT])
-			self.str2send = self.str2send[UARDUINO_BUFFER_LIMIT:]
-			self.uart.write(b)
-			if len(self.str2send) < 1:
-				keep_writing = False
-			else:
-				utime.sleep_ms(50)
-		#self.uart.write('\r\n')
+		self._enqueue(str_in.encode(), _CRLF)
+		if self.auto_drain:
+			self.drain()
 		pass
-		
-		
-	
-
+
+	# send_str for a line already encoded (bytes, bytearray, memoryview)
+	def send_line(self, buf):
+		self._enqueue(buf, _CRLF)
+		if self.auto_drain:
+			self.drain()
+		pass
+
+	# sends a binary frame as-is (no line terminator)
+	def send_bytes(self, buf):
+		self._enqueue(buf, None)
+		if self.auto_drain:
+			self.drain()
+		pass
+
+	# Queues one message (plus optional terminator) as a whole: either all of
+	# it ends up in the buffer or, depending on the policy, none of it.
+	# Dropping the oldest drops whole messages, never the one being sent.
+	def _enqueue(self, buf, term):
+		n = len(buf)
+		if not (term is None):
+			n += len(term)
+		if n == 0:
+			return True
+		size = len(self.txbuf)
+		if n > size - 1:
+			self.bytes_dropped += n
+			self.msgs_dropped += 1
+			return False
+		self._retire()
+		slot = self.msg_head + 1
+		if slot == UARDUINO_MSG_SLOTS:
+			slot = 0
+		if n > self.free() or slot == self.msg_tail:
+			if self.policy == UARDUINO_POLICY_BLOCK:
+				while n > self.free() or slot == self.msg_tail:
+					if not self.drain():
+						utime.sleep_ms(1)
+					self._retire()
+			elif self.policy == UARDUINO_POLICY_DROP_NEWEST or not self._drop_oldest(n):
+				self.bytes_dropped += n
+				self.msgs_dropped += 1
+				return False
+		self._copy_in(buf)
+		if not (term is None):
+			self._copy_in(term)
+		self.msg_end[self.msg_head] = self.head
+		self.msg_head = slot
+		self.bytes_queued += n
+		return True
+
+	# forgets the messages already sent
+	def _retire(self):
+		k = self.msg_tail
+		h = self.msg_head
+		if k == h:
+			return
+		ends = self.msg_end
+		t = self.tail
+		size = len(self.txbuf)
+		p = (self.head - t) % size
+		e = -1
+		while k != h:
+			d = (ends[k] - t) % size
+			if d > 0 and d <= p:
+				break # not sent yet
+			e = ends[k]
+			k += 1
+			if k == UARDUINO_MSG_SLOTS:
+				k = 0
+		if e >= 0:
+			self.msg_start = e
+			self.msg_tail = k
+		pass
+
+	# Drops the oldest whole messages until n bytes and a slot are free; the
+	# one partly sent stays, its rest moved up to the end of the dropped
+	# ones. False, dropping nothing, if that cannot make enough room.
+	def _drop_oldest(self, n):
+		size = len(self.txbuf)
+		ends = self.msg_end
+		k = self.msg_tail
+		partial = self.tail != self.msg_start
+		first = k
+		start = self.msg_start
+		if partial:
+			first = (k + 1) % UARDUINO_MSG_SLOTS
+			start = ends[k]
+		free = self.free()
+		used = (self.msg_head - k) % UARDUINO_MSG_SLOTS
+		j = first
+		e = start
+		lost = 0
+		while (free + lost < n or used >= UARDUINO_MSG_SLOTS - 1) and j != self.msg_head:
+			e = ends[j]
+			lost = (e - start) % size
+			used -= 1
+			j = (j + 1) % UARDUINO_MSG_SLOTS
+		if free + lost < n or used >= UARDUINO_MSG_SLOTS - 1:
+			return False
+		if partial:
+			buf = self.txbuf
+			rest = (start - self.tail) % size
+			sent = (self.tail - self.msg_start) % size
+			for i in range(rest - 1, -1, -1): # moves up: copy from the end
+				buf[(e - rest + i) % size] = buf[(self.tail + i) % size]
+			self.tail = (e - rest) % size
+			self.msg_start = (self.tail - sent) % size
+			self.msg_tail = (j - 1) % UARDUINO_MSG_SLOTS
+			ends[self.msg_tail] = e
+		else:
+			self.tail = e
+			self.msg_start = e
+			self.msg_tail = j
+		self.bytes_dropped += lost
+		self.bytes_evicted += lost
+		self.msgs_dropped += (j - first) % UARDUINO_MSG_SLOTS
+		return True
+
+	def _copy_in(self, buf):
+		n = len(buf)
+		size = len(self.txbuf)
+		h = self.head
+		first = size - h
+		if n <= first:
+			self.txmv[h:h + n] = buf
+		else:
+			mv = memoryview(buf)
+			self.txmv[h:size] = mv[0:first]
+			self.txmv[0:n - first] = mv[first:n]
+		self.head = (h + n) % size
+		pass
+
+	# Writes at most one chunk of UARDUINO_BUFFER_LIMIT bytes and never
+	# sleeps. After a full chunk the next one is held back for
+	# UARDUINO_CHUNK_GAP_MS so that the Arduino can keep up. A chunk
+	# crossing the end of the ring goes out in two writes, back to back.
+	# Returns the number of bytes written.
+	def drain(self):
+		if self.head == self.tail:
+			return 0
+		now = utime.ticks_ms()
+		if utime.ticks_diff(now, self.t_next_write) < 0:
+			return 0
+		t = self.tail
+		if self.head > t:
+			n = self.head - t
+		else:
+			n = len(self.txbuf) - t
+		if n > UARDUINO_BUFFER_LIMIT:
+			n = UARDUINO_BUFFER_LIMIT
+		self.uart.write(self.txmv[t:t + n])
+		self.writes += 1
+		self.tail = (t + n) % len(self.txbuf)
+		if self.tail == 0 and self.head > 0 and n < UARDUINO_BUFFER_LIMIT:
+			m = min(self.head, UARDUINO_BUFFER_LIMIT - n)
+			self.uart.write(self.txmv[0:m])
+			self.writes += 1
+			self.tail = m
+			n += m
+		self.bytes_sent += n
+		if n == UARDUINO_BUFFER_LIMIT:
+			self.t_next_write = utime.ticks_add(now, UARDUINO_CHUNK_GAP_MS)
+		return n
+
+	# empties the buffer, sleeping between chunks (not for timer callbacks)
+	def flush(self):
+		while self.head != self.tail:
+			if not self.drain():
+				utime.sleep_ms(1)
+		pass
+
+	def stats(self):
+		return (self.bytes_queued, self.bytes_sent, self.bytes_dropped)
@@ -0,0 +1,251 @@
+# Streaming UBX (u-blox binary protocol) decoder.
+# Frame: 0xB5 0x62 CLASS ID LEN(2, LE) PAYLOAD CK_A CK_B, with the 8-bit
+# Fletcher checksum computed over CLASS..PAYLOAD.
+# Only NAV-PVT is decoded; it carries a complete fix in one message,
+# written into the fixed-point fields of a gpsrec.GpsRecord.
+
+try:
+	from ustruct import unpack_from, pack_into
+except ImportError:
+	from struct import unpack_from, pack_into
+from gpsrec import GPSR_TIME, GPSR_DATE, GPSR_STATUS, GPSR_LAT, GPSR_LON, GPSR_SPEED, \
+	GPSR_COURSE, GPSR_MVAR, GPSR_MODE, GPSR_FIX, GPSR_SATS, GPSR_HDOP, GPSR_ALT, \
+	GPSR_ALT_REF, GPSR_VEL_N, GPSR_VEL_E, GPSR_VEL_D, GPSR_HACC, GPSR_VACC, GPSR_SACC, \
+	GPSR_LAT_INVALID, GPSR_LON_INVALID
+
+UBX_SYNC1 = 0xB5
+UBX_SYNC2 = 0x62
+UBX_MAX_PAYLOAD = 100
+
+UBX_CLS_NAV = 0x01
+UBX_CLS_ACK = 0x05
+UBX_CLS_CFG = 0x06
+UBX_CLS_NMEA = 0xF0
+UBX_ID_ACK_NAK = 0x00
+UBX_ID_ACK_ACK = 0x01
+UBX_ID_CFG_PRT = 0x00
+UBX_ID_CFG_MSG = 0x01
+UBX_ID_CFG_RATE = 0x08
+UBX_ID_NAV_PVT = 0x07
+UBX_NAV_PVT_LEN = 92
+UBX_FMT_NAV_PVT = '<IHBBBBBBIiBBBBiiiiIIiiiiiIIH6xihH'
+
+UBX_MM_S_PER_KT = 514.444
+# mm/s -> 1e-3 kts: * 1.94384, as (* UBX_KT_MUL) >> UBX_KT_SHIFT, within
+# small ints up to 130 m/s
+UBX_KT_MUL = 7962
+UBX_KT_SHIFT = 12
+UBX_I32_MAX = 0x7FFFFFFF
+
+# result of the last ACK-ACK / ACK-NAK
+UBX_ACK_NONE = -1
+UBX_ACK_NAK = 0
+UBX_ACK_ACK = 1
+
+UBX_PRT_UART1 = 1
+UBX_PRT_MODE_8N1 = 0x08D0
+UBX_PROTO_UBX = 0x01
+UBX_PROTO_NMEA = 0x02
+
+def ubx_checksum(buf, start, end):
+	a = 0
+	b = 0
+	for i in range(start, end):
+		a = (a + buf[i]) & 0xFF
+		b = (b + a) & 0xFF
+	return a, b
+
+# complete frame (sync, header, payload, checksum) for any message
+def ubx_build(cls, mid, payload=b''):
+	n = len(payload)
+	f = bytearray(8 + n)
+	f[0] = UBX_SYNC1
+	f[1] = UBX_SYNC2
+	f[2] = cls
+	f[3] = mid
+	f[4] = n & 0xFF
+	f[5] = n >> 8
+	f[6:6 + n] = payload
+	f[6 + n], f[7 + n] = ubx_checksum(f, 2, 6 + n)
+	return f
+
+# CFG-RATE: one measurement every meas_ms, navigation solution every
+# measurement, aligned to GPS time
+def ubx_cfg_rate(meas_ms):
+	p = bytearray(6)
+	pack_into('<HHH', p, 0, meas_ms, 1, 1)
+	return ubx_build(UBX_CLS_CFG, UBX_ID_CFG_RATE, p)
+
+# CFG-MSG, short form: output rate of a message on the current port
+def ubx_cfg_msg(msg_cls, msg_id, rate):
+	return ubx_build(UBX_CLS_CFG, UBX_ID_CFG_MSG, bytes([msg_cls, msg_id, rate]))
+
+# CFG-PRT for a UART port: 8N1 at `baudrate`, UBX+NMEA in and out
+def ubx_cfg_prt_uart(baudrate, port=UBX_PRT_UART1, \
+	in_proto=UBX_PROTO_UBX | UBX_PROTO_NMEA, out_proto=UBX_PROTO_UBX | UBX_PROTO_NMEA):
+	p = bytearray(20)
+	pack_into('<BBHIIHHHH', p, 0, port, 0, 0, UBX_PRT_MODE_8N1, baudrate, \
+		in_proto, out_proto, 0, 0)
+	return ubx_build(UBX_CLS_CFG, UBX_ID_CFG_PRT, p)
+
+# parser states
+_S_SYNC1 = 0
+_S_SYNC2 = 1
+_S_CLS = 2
+_S_ID = 3
+_S_LEN1 = 4
+_S_LEN2 = 5
+_S_PAYLOAD = 6
+_S_CK_A = 7
+_S_CK_B = 8
+
+class UbxParser:
+	def __init__(self, rec):
+		self.rec = rec
+		self.v = rec.v
+		self.payload = bytearray(UBX_MAX_PAYLOAD)
+		self.state = _S_SYNC1
+		self.cls = 0
+		self.id = 0
+		self.length = 0
+		self.n = 0
+		self.ck_a = 0
+		self.ck_b = 0
+		self.frames_ok = 0
+		self.bad_checksum = 0
+		self.too_long = 0
+		self.pvt_count = 0
+		self.ack_result = UBX_ACK_NONE
+		self.ack_cls = 0
+		self.ack_id = 0
+		pass
+
+	def _ck(self, b):
+		self.ck_a = (self.ck_a + b) & 0xFF
+		self.ck_b = (self.ck_b + self.ck_a) & 0xFF
+		pass
+
+	# Feeds n bytes of buf (all of it by default). Returns the number of
+	# valid frames decoded. Anything that is not UBX (e.g. NMEA) is skipped.
+	def feed(self, buf, n=-1):
+		if n < 0:
+			n = len(buf)
+		parsed = 0
+		for i in range(n):
+			b = buf[i]
+			st = self.state
+			if st == _S_PAYLOAD:
+				self.payload[self.n] = b
+				self.n += 1
+				self._ck(b)
+				if self.n == self.length:
+					self.state = _S_CK_A
+			elif st == _S_SYNC1:
+				if b == UBX_SYNC1:
+					self.state = _S_SYNC2
+			elif st == _S_SYNC2:
+				if b == UBX_SYNC2:
+					self.state = _S_CLS
+					self.ck_a = 0
+					self.ck_b = 0
+				elif b != UBX_SYNC1:
+					self.state = _S_SYNC1
+			elif st == _S_CLS:
+				self.cls = b
+				self._ck(b)
+				self.state = _S_ID
+			elif st == _S_ID:
+				self.id = b
+				self._ck(b)
+				self.state = _S_LEN1
+			elif st == _S_LEN1:
+				self.length = b
+				self._ck(b)
+				self.state = _S_LEN2
+			elif st == _S_LEN2:
+				self.length |= b << 8
+				self._ck(b)
+				self.n = 0
+				if self.length > UBX_MAX_PAYLOAD:
+					self.too_long += 1
+					self.state = _S_SYNC1
+				elif self.length == 0:
+					self.state = _S_CK_A
+				else:
+					self.state = _S_PAYLOAD
+			elif st == _S_CK_A:
+				if b == self.ck_a:
+					self.state = _S_CK_B
+				else:
+					self.bad_checksum += 1
+					self.state = _S_SYNC1
+			else:
+				self.state = _S_SYNC1
+				if b == self.ck_b:
+					self.frames_ok += 1
+					self._dispatch()
+					parsed += 1
+				else:
+					self.bad_checksum += 1
+		return parsed
+
+	def _dispatch(self):
+		if self.cls == UBX_CLS_ACK and self.length == 2:
+			self.ack_cls = self.payload[0]
+			self.ack_id = self.payload[1]
+			if self.id == UBX_ID_ACK_ACK:
+				self.ack_result = UBX_ACK_ACK
+			else:
+				self.ack_result = UBX_ACK_NAK
+		elif self.cls == UBX_CLS_NAV and self.id == UBX_ID_NAV_PVT and self.length == UBX_NAV_PVT_LEN:
+			self._parse_nav_pvt()
+		pass
+
+	def _parse_nav_pvt(self):
+		(itow, year, month, day, hour, minute, sec, valid, tacc, nano, \
+			fix_type, flags, flags2, num_sv, lon, lat, height, hmsl, hacc, vacc, \
+			vel_n, vel_e, vel_d, g_speed, head_mot, s_acc, head_acc, p_dop, \
+			head_veh, mag_dec, mag_acc) = unpack_from(UBX_FMT_NAV_PVT, self.payload)
+		v = self.v
+		# nano is within -1e9..1e9 around the (rounded) second
+		ms = ((hour * 60 + minute) * 60 + sec) * 1000 + nano // 1000000
+		if ms < 0:
+			ms = 0
+		v[GPSR_TIME] = ms
+		v[GPSR_DATE] = (day * 100 + month) * 100 + year % 100
+		fix_ok = flags & 0x01
+		diff = flags & 0x02
+		if fix_ok:
+			v[GPSR_STATUS] = 65 # 'A'
+			v[GPSR_LAT] = lat
+			v[GPSR_LON] = lon
+		else:
+			v[GPSR_STATUS] = 86 # 'V'
+			v[GPSR_LAT] = GPSR_LAT_INVALID
+			v[GPSR_LON] = GPSR_LON_INVALID
+		v[GPSR_SPEED] = (g_speed * UBX_KT_MUL) >> UBX_KT_SHIFT
+		v[GPSR_COURSE] = (head_mot + 500) // 1000
+		v[GPSR_MVAR] = mag_dec
+		if not fix_ok or fix_type < 2:
+			v[GPSR_MODE] = 78 # 'N'
+			v[GPSR_FIX] = 0
+		elif diff:
+			v[GPSR_MODE] = 68 # 'D'
+			v[GPSR_FIX] = 2
+		else:
+			v[GPSR_MODE] = 65 # 'A'
+			v[GPSR_FIX] = 1
+		v[GPSR_SATS] = num_sv
+		# NAV-PVT has no HDOP: position DOP is the closest match
+		v[GPSR_HDOP] = p_dop
+		v[GPSR_ALT] = hmsl // 10
+		v[GPSR_ALT_REF] = (height - hmsl) // 10
+		v[GPSR_VEL_N] = vel_n
+		v[GPSR_VEL_E] = vel_e
+		v[GPSR_VEL_D] = vel_d
+		# unsigned, and huge without a fix
+		v[GPSR_HACC] = hacc if hacc <= UBX_I32_MAX else UBX_I32_MAX
+		v[GPSR_VACC] = vacc if vacc <= UBX_I32_MAX else UBX_I32_MAX
+		v[GPSR_SACC] = s_acc if s_acc <= UBX_I32_MAX else UBX_I32_MAX
+		self.pvt_count += 1
+		pass
@@ -0,0 +1,259 @@
+# Cooperative runtime for main.py on uasyncio, alternative to the
+# machine.Timer callbacks started by I2cAcc.start() / UartGps.start().
+#
+# Tasks:
+#   imu  samples on a fixed schedule (deadlines, no drift) and queues its
+#        output in Uarduino. It has priority: the other tasks do bounded
+#        work per step and step aside when a sample is due within
+#        VSASYNC_IMU_GUARD_MS.
+#   gps  waits on a StreamReader over the GPS UART, feeds the parser and
+#        outputs once per navigation epoch (no polling with any()).
+#   tx   the only writer of the Uarduino UART: drains its queue chunk by
+#        chunk, sleeping through the inter-chunk gap.
+#   sd   services the SD logger, when there is one.
+# All of them run in one thread, so nothing preempts a handler in the
+# middle of a Uarduino or parser update, as soft timer callbacks can.
+#
+# End-to-end latency is measured per source, from acquisition to the last
+# byte of the message handed to the UART (approximate when Uarduino drops).
+# Only steps that queue something count (not a decimated, suppressed or
+# batched sample); a batch counts from its first sample.
+# Up to VSASYNC_LAT_SLOTS messages per source wait for their last byte;
+# the ones beyond that are not measured (lat_skipped).
+
+import uasyncio as asyncio
+import utime
+from array import array
+
+VSASYNC_IMU_GUARD_MS = 3
+VSASYNC_SD_IDLE_MS = 20
+VSASYNC_LAT_SLOTS = 16
+
+VSASYNC_SRC_IMU = 0
+VSASYNC_SRC_GPS = 1
+VSASYNC_SRC_NAMES = ('imu', 'gps')
+
+class VsRuntime:
+	def __init__(self, imu, gps, uardu, sdlog=None):
+		self.imu = imu
+		self.gps = gps
+		self.uardu = uardu
+		self.sdlog = sdlog
+		self.tasks = []
+		self.running = False
+		self.paused = False
+		self.resume_ev = asyncio.Event()
+		self.tx_ev = asyncio.Event()
+		self.done_ev = asyncio.Event()
+		self.imu_next = 0
+		self.imu_samples = 0
+		self.imu_missed = 0
+		self.gps_fixes = 0
+		self.gps_bytes = 0
+		# pending messages per source, oldest at lat_tail: Uarduino byte
+		# count that completes each one and its acquisition ticks_us
+		self.lat_mark = [array('i', [0] * VSASYNC_LAT_SLOTS) for s in VSASYNC_SRC_NAMES]
+		self.lat_t0 = [array('i', [0] * VSASYNC_LAT_SLOTS) for s in VSASYNC_SRC_NAMES]
+		self.lat_head = [0, 0]
+		self.lat_tail = [0, 0]
+		self.lat_skipped = [0, 0]
+		self.lat_n = [0, 0]
+		self.lat_sum = [0, 0]
+		self.lat_max = [0, 0]
+		self.imu_batch_t0 = 0 # acquisition of the first sample in the pending batch
+		pass
+
+	# Blocking receiver/sensor configuration, then the event loop until
+	# stop() or Ctrl-C.
+	def run(self):
+		if not (self.gps is None):
+			self.gps.configure()
+		if not (self.imu is None):
+			self.imu.configure()
+		try:
+			asyncio.run(self._main())
+		finally:
+			if self.running:
+				self.stop()
+			asyncio.new_event_loop()
+		pass
+
+	async def _main(self):
+		self.start()
+		await self.done_ev.wait()
+
+	# creates the tasks; to be called from within the event loop
+	def start(self):
+		self.uardu.auto_drain = False
+		self.paused = False
+		self.done_ev.clear()
+		self.tasks = [asyncio.create_task(self._tx_task())]
+		if not (self.imu is None):
+			self.tasks.append(asyncio.create_task(self._imu_task()))
+		if not (self.gps is None):
+			self.tasks.append(asyncio.create_task(self._gps_task()))
+		if not (self.sdlog is None):
+			self.tasks.append(asyncio.create_task(self._sd_task()))
+		self.running = True
+		pass
+
+	def pause(self):
+		if self.paused:
+			self.paused = False
+			self.resume_ev.set()
+		else:
+			self.resume_ev.clear()
+			self.paused = True
+		pass
+
+	def stop(self):
+		for t in self.tasks:
+			t.cancel()
+		self.tasks = []
+		self.running = False
+		self.uardu.auto_drain = True
+		self.uardu.flush()
+		if not (self.sdlog is None):
+			self.sdlog.stop()
+		self.done_ev.set()
+		pass
+
+	# only for a step that queued something: q is bytes_queued before it
+	def _mark(self, src, t0, q):
+		if self.uardu.bytes_queued == q:
+			return
+		k = self.lat_head[src]
+		nxt = k + 1
+		if nxt == VSASYNC_LAT_SLOTS:
+			nxt = 0
+		if nxt == self.lat_tail[src]:
+			self.lat_skipped[src] += 1
+		else:
+			self.lat_mark[src][k] = self.uardu.bytes_queued
+			self.lat_t0[src][k] = t0
+			self.lat_head[src] = nxt
+		self.tx_ev.set()
+
+	# resolves, in order, the messages whose last byte is out
+	def _check_latency(self):
+		u = self.uardu
+		done = u.bytes_sent + u.bytes_evicted
+		for s in (VSASYNC_SRC_IMU, VSASYNC_SRC_GPS):
+			k = self.lat_tail[s]
+			head = self.lat_head[s]
+			if k == head:
+				continue
+			mark = self.lat_mark[s]
+			t = utime.ticks_us()
+			while k != head and done >= mark[k]:
+				lat = utime.ticks_diff(t, self.lat_t0[s][k])
+				self.lat_n[s] += 1
+				self.lat_sum[s] += lat
+				if lat > self.lat_max[s]:
+					self.lat_max[s] = lat
+				k += 1
+				if k == VSASYNC_LAT_SLOTS:
+					k = 0
+			self.lat_tail[s] = k
+		pass
+
+	# lower priority work waits when an IMU sample is about to be due
+	async def _imu_guard(self):
+		if self.imu is None or self.paused:
+			return
+		d = utime.ticks_diff(self.imu_next, utime.ticks_ms())
+		if d < VSASYNC_IMU_GUARD_MS:
+			await asyncio.sleep_ms(d + 1 if d >= 0 else 0)
+
+	async def _imu_task(self):
+		imu = self.imu
+		u = self.uardu
+		fifo = imu.fifo_rate_hz > 0
+		period = imu.fifo_poll_ms if fifo else imu.dt_sampling_ms
+		self.imu_next = utime.ticks_add(utime.ticks_ms(), period)
+		while True:
+			if self.paused:
+				await self.resume_ev.wait()
+				self.imu_next = utime.ticks_add(utime.ticks_ms(), period)
+			d = utime.ticks_diff(self.imu_next, utime.ticks_ms())
+			if d > 0:
+				await asyncio.sleep_ms(d)
+			t0 = utime.ticks_us()
+			q = u.bytes_queued
+			batch = imu.batch
+			nb = 0 if batch is None else batch.n
+			if fifo:
+				imu._fifo_cb(None)
+			else:
+				imu.sample_all()
+				imu._process_output()
+			# a batch going out dates from its first sample
+			self._mark(VSASYNC_SRC_IMU, self.imu_batch_t0 if nb > 0 else t0, q)
+			if not (batch is None) and batch.n > 0 and (nb == 0 or u.bytes_queued != q):
+				self.imu_batch_t0 = t0
+			self.imu_samples += 1
+			# whole periods already gone are skipped, not bunched up
+			nxt = utime.ticks_add(self.imu_next, period)
+			late = utime.ticks_diff(utime.ticks_ms(), nxt)
+			if late >= 0:
+				k = late // period + 1
+				self.imu_missed += k
+				nxt = utime.ticks_add(nxt, k * period)
+			self.imu_next = nxt
+
+	async def _gps_task(self):
+		gps = self.gps
+		reader = asyncio.StreamReader(gps.uart)
+		buf = gps.rxbuf
+		last = gps.fix_count()
+		while True:
+			n = await reader.readinto(buf)
+			if not n or self.paused:
+				continue # paused: keep the UART drained, drop the data
+			t0 = utime.ticks_us()
+			t_ms = utime.ticks_ms()
+			self.gps_bytes += n
+			gps.parser.feed(buf, n)
+			c = gps.fix_count()
+			if c != last:
+				last = c
+				gps._on_fix(t_ms, t0)
+				await self._imu_guard()
+				q = self.uardu.bytes_queued
+				gps._output()
+				self._mark(VSASYNC_SRC_GPS, t0, q)
+				self.gps_fixes += 1
+
+	async def _tx_task(self):
+		u = self.uardu
+		while True:
+			n = u.drain()
+			self._check_latency()
+			if n:
+				await asyncio.sleep_ms(0)
+			elif u.pending():
+				# inside the gap after a full chunk
+				d = utime.ticks_diff(u.t_next_write, utime.ticks_ms())
+				await asyncio.sleep_ms(d if d > 0 else 1)
+			else:
+				self.tx_ev.clear()
+				await self.tx_ev.wait()
+
+	async def _sd_task(self):
+		lg = self.sdlog
+		while True:
+			if lg.pending >= 0:
+				await self._imu_guard()
+				lg.service()
+			await asyncio.sleep_ms(VSASYNC_SD_IDLE_MS)
+
+	def stats(self):
+		out = dict({'imu_samples': self.imu_samples, 'imu_missed': self.imu_missed, \
+			'gps_fixes': self.gps_fixes, 'gps_bytes': self.gps_bytes})
+		for s in (VSASYNC_SRC_IMU, VSASYNC_SRC_GPS):
+			name = VSASYNC_SRC_NAMES[s]
+			n = self.lat_n[s]
+			out[name + '_lat_mean_us'] = self.lat_sum[s] // n if n else 0
+			out[name + '_lat_max_us'] = self.lat_max[s]
+			out[name + '_lat_skipped'] = self.lat_skipped[s]
+		return out
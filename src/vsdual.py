@@ -0,0 +1,274 @@
+# Two-thread runtime for main.py: an acquisition thread owns the I2C bus
+# and the GPS UART and only moves raw bytes into single-producer/single-
+# consumer rings; an output thread decodes, encodes and sends them
+# (Uarduino, SD). Output stalls then only fill the rings (and are counted
+# as drops when they overflow) instead of shifting the sampling instants.
+#
+# Note on cores: the ESP32 port runs every Python thread on the core of
+# the MicroPython task and under the GIL, so this gives preemption (the
+# acquisition thread wakes on time while output work is pending, the GIL
+# being released on sleeps and every few bytecodes), not parallelism.
+# True core pinning needs C (a FreeRTOS task, e.g. in a user module).
+
+import _thread
+import utime
+from array import array
+from i2ch import MPU_REG_SENSORVAL, MPU_FIFO_SAMPLE_LEN
+
+VSDUAL_IMU_SLOTS = 32
+VSDUAL_GPS_SLOTS = 16
+VSDUAL_GPS_SLOT_LEN = 64
+VSDUAL_GPS_POLL_MS = 20
+VSDUAL_OUT_IDLE_MS = 2
+VSDUAL_STOP_TIMEOUT_MS = 1000
+VSDUAL_STACK_SIZE = 16384
+
+# Ring of fixed size slots, each with a length and ticks_ms/ticks_us stamps.
+# The producer only writes `head`, the consumer only writes `tail`; a
+# slot is handed over by moving the index after the data is in place,
+# so no lock is needed. One slot stays empty to tell full from empty.
+# When full the new data is dropped: the producer never waits (`drops`
+# counts the refused reserve() calls).
+class SpscRing:
+	def __init__(self, slot_len, n_slots):
+		self.slot_len = slot_len
+		self.n = n_slots
+		self.buf = bytearray(slot_len * n_slots)
+		mv = memoryview(self.buf)
+		self.slots = [mv[k * slot_len:(k + 1) * slot_len] for k in range(n_slots)]
+		self.lens = array('H', [0] * n_slots)
+		self.t = array('I', [0] * n_slots)
+		self.t_us = array('I', [0] * n_slots)
+		self.head = 0
+		self.tail = 0
+		self.pushed = 0
+		self.drops = 0
+		self.fill_max = 0
+		pass
+
+	# producer: slot index to fill, or -1 (and a drop) when full
+	def reserve(self):
+		nxt = self.head + 1
+		if nxt == self.n:
+			nxt = 0
+		if nxt == self.tail:
+			self.drops += 1
+			return -1
+		return self.head
+
+	def publish(self, n, t, t_us):
+		k = self.head
+		self.lens[k] = n
+		self.t[k] = t
+		self.t_us[k] = t_us
+		nxt = k + 1
+		if nxt == self.n:
+			nxt = 0
+		self.head = nxt
+		self.pushed += 1
+		fill = (nxt - self.tail) % self.n
+		if fill > self.fill_max:
+			self.fill_max = fill
+		pass
+
+	# consumer: slot index to read, or -1 when empty
+	def peek(self):
+		if self.tail == self.head:
+			return -1
+		return self.tail
+
+	def release(self):
+		nxt = self.tail + 1
+		if nxt == self.n:
+			nxt = 0
+		self.tail = nxt
+		pass
+
+class VsDual:
+	def __init__(self, imu, gps, uardu, sdlog=None):
+		self.imu = imu
+		self.gps = gps
+		self.uardu = uardu
+		self.sdlog = sdlog
+		self.imu_ring = SpscRing(MPU_FIFO_SAMPLE_LEN, VSDUAL_IMU_SLOTS)
+		self.gps_ring = SpscRing(VSDUAL_GPS_SLOT_LEN, VSDUAL_GPS_SLOTS)
+		self.running = False
+		self.acq_done = True
+		self.out_done = True
+		self.imu_samples = 0
+		self.imu_missed = 0
+		self.imu_late_max_us = 0
+		self.gps_fixes = 0
+		self.gps_drop_bytes = 0
+		self.gps_scratch = bytearray(VSDUAL_GPS_SLOT_LEN) # what a full ring drops
+		self.imu_sensors = None
+		pass
+
+	# Configures the sensors, starts both threads and waits for Ctrl-C.
+	def run(self):
+		if not (self.gps is None):
+			self.gps.configure()
+		if not (self.imu is None):
+			self.imu.configure()
+		self.start()
+		try:
+			while self.running:
+				utime.sleep_ms(200)
+		finally:
+			self.stop()
+		pass
+
+	def start(self):
+		if not (self.imu is None):
+			if self.imu.fifo_rate_hz > 0:
+				raise ValueError("FIFO mode is not supported by the dual runtime")
+			self.imu.zero_alloc = True
+			self.imu_sensors = self.imu.sensors # replaced by ring slots while running
+		self.uardu.auto_drain = False
+		self.running = True
+		self.acq_done = False
+		self.out_done = False
+		_thread.stack_size(VSDUAL_STACK_SIZE)
+		_thread.start_new_thread(self._out_thread, ())
+		_thread.start_new_thread(self._acq_thread, ())
+		pass
+
+	# Stops both threads (waiting up to VSDUAL_STOP_TIMEOUT_MS for them),
+	# then flushes what is left. If they do not stop, the sensors, the
+	# Uarduino and the SD log are left to them: False.
+	def stop(self):
+		self.running = False
+		t0 = utime.ticks_ms()
+		while not (self.acq_done and self.out_done):
+			if utime.ticks_diff(utime.ticks_ms(), t0) > VSDUAL_STOP_TIMEOUT_MS:
+				print("vsdual: threads did not stop")
+				return False
+			utime.sleep_ms(5)
+		if not (self.imu is None):
+			self.imu.sensors = self.imu_sensors
+		self.uardu.auto_drain = True
+		self.uardu.flush()
+		if not (self.sdlog is None):
+			self.sdlog.stop()
+		return True
+
+	def _acq_thread(self):
+		try:
+			self._acq_loop()
+		finally:
+			self.acq_done = True
+
+	def _acq_loop(self):
+		imu = self.imu
+		gps = self.gps
+		ir = self.imu_ring
+		gr = self.gps_ring
+		period_us = 0
+		if not (imu is None):
+			period_us = imu.dt_sampling_ms * 1000
+			i2c = imu.i2c
+			addr = imu.addr
+		t_imu = utime.ticks_us()
+		t_gps = utime.ticks_ms()
+		while self.running:
+			if not (imu is None):
+				late = utime.ticks_diff(utime.ticks_us(), t_imu)
+				if late >= 0:
+					k = ir.reserve()
+					if k >= 0:
+						t = utime.ticks_ms()
+						t_us = utime.ticks_us()
+						i2c.readfrom_mem_into(addr, MPU_REG_SENSORVAL, ir.slots[k])
+						ir.publish(MPU_FIFO_SAMPLE_LEN, t, t_us)
+					self.imu_samples += 1
+					if late > self.imu_late_max_us:
+						self.imu_late_max_us = late
+					t_imu = utime.ticks_add(t_imu, period_us)
+					if late >= period_us:
+						# whole periods already gone are skipped, not bunched up
+						skip = late // period_us
+						self.imu_missed += skip
+						t_imu = utime.ticks_add(t_imu, skip * period_us)
+			if not (gps is None) and utime.ticks_diff(utime.ticks_ms(), t_gps) >= 0:
+				t_gps = utime.ticks_add(t_gps, VSDUAL_GPS_POLL_MS)
+				while True:
+					k = gr.reserve()
+					if k < 0:
+						# ring full: drop what the UART holds, counting it
+						n = gps.uart.readinto(self.gps_scratch)
+						if not n:
+							break
+						self.gps_drop_bytes += n
+						if n < VSDUAL_GPS_SLOT_LEN:
+							break
+						continue
+					t = utime.ticks_ms()
+					t_us = utime.ticks_us()
+					n = gps.uart.readinto(gr.slots[k])
+					if not n:
+						break
+					gr.publish(n, t, t_us)
+					if n < VSDUAL_GPS_SLOT_LEN:
+						break
+			# sleep to the next deadline; the GIL goes to the output thread
+			d = utime.ticks_diff(t_imu, utime.ticks_us()) if not (imu is None) else VSDUAL_GPS_POLL_MS * 1000
+			if d > 1000:
+				utime.sleep_ms(d // 1000)
+			elif d > 0:
+				utime.sleep_us(d)
+		pass
+
+	def _out_thread(self):
+		try:
+			self._out_loop()
+		finally:
+			self.out_done = True
+
+	def _out_loop(self):
+		imu = self.imu
+		gps = self.gps
+		ir = self.imu_ring
+		gr = self.gps_ring
+		u = self.uardu
+		last_fix = 0 if gps is None else gps.fix_count()
+		while self.running:
+			busy = False
+			k = ir.peek()
+			while k >= 0:
+				imu.sensors = ir.slots[k]
+				imu._unpack_to_arrays()
+				imu.t_sample = ir.t[k]
+				imu.t_us = ir.t_us[k]
+				imu._process_output()
+				ir.release()
+				busy = True
+				k = ir.peek()
+			k = gr.peek()
+			while k >= 0:
+				gps.parser.feed(gr.slots[k], gr.lens[k])
+				t = gr.t[k]
+				t_us = gr.t_us[k]
+				gr.release()
+				c = gps.fix_count()
+				if c != last_fix:
+					last_fix = c
+					gps._on_fix(t, t_us)
+					gps._output()
+					self.gps_fixes += 1
+				busy = True
+				k = gr.peek()
+			if u.drain():
+				busy = True
+			if not (self.sdlog is None) and self.sdlog.service():
+				busy = True
+			if not busy:
+				utime.sleep_ms(VSDUAL_OUT_IDLE_MS)
+		pass
+
+	def stats(self):
+		ir = self.imu_ring
+		gr = self.gps_ring
+		return dict({'imu_samples': self.imu_samples, 'imu_missed': self.imu_missed, \
+			'imu_late_max_us': self.imu_late_max_us, 'imu_drops': ir.drops, \
+			'imu_ring_max': ir.fill_max, 'gps_chunks': gr.pushed, 'gps_drop_bytes': self.gps_drop_bytes, \
+			'gps_ring_max': gr.fill_max, 'gps_fixes': self.gps_fixes})
@@ -0,0 +1,255 @@
+# Precompiled text output lines, in place of the per-sample
+# str.format(**dict) of the _print_on_repl methods. A LineFormat is built
+# once from a field list and then renders integer (fixed-point) values
+# straight into its own bytearray: no kwargs dict, no format spec parsing,
+# no floats and no intermediate strings.
+#
+# Line layout: "<t>\t<TAG>\t<field>,<field>,...", t printed with t_prec
+# decimals (a ticks_ms value: "1234.0"), then whatever the caller appends
+# with put_byte / put_bytes / put_uint / put_fix (reserve its length with
+# `extra`: the buffer is sized for the widest line the fields can give,
+# any int32 value, plus extra). The numbers are the
+# correctly rounded decimals of the exact fixed-point values: where a float
+# product used to sit exactly on a rounding tie the last digit can differ
+# from the str.format output (see host/fmtcheck.py).
+#
+# A field is (kind, index, arg, prec), index being the position of its
+# value in the sequence passed to render():
+#   VSFMT_INT    integer, zero padded to arg digits (0: no padding)
+#   VSFMT_FIX    fixed point with arg decimals, printed with prec decimals
+#                (rounded half away from zero when prec < arg)
+#   VSFMT_SCALED value * num / den, arg = (num, den) as integers, printed
+#                with prec decimals (exact ties toward zero, as the float
+#                scales they replace, i2ch.MPU_LSB_TO_MS2, printed them);
+#                compiled into small-int multipliers
+#   VSFMT_TOD    ms of day as hhmmss plus prec (truncated) decimals
+#   VSFMT_CHAR   character code
+
+from array import array
+
+VSFMT_INT = 0
+VSFMT_FIX = 1
+VSFMT_SCALED = 2
+VSFMT_TOD = 3
+VSFMT_CHAR = 4
+
+VSFMT_INT_DIGITS = 10 # of an int32, sign excluded
+VSFMT_PREC_MAX = 9
+
+# SCALED: m = ip + (f1 + (f2 + f3 / 2**14) / 2**14) / 2**14, the partial
+# products within small ints for |value| < 2**16, truncated to 2**-42
+_SCALE_BITS = 14
+_SCALE_MASK = 0x3FFF
+_SCALE_HALF = 0x2000
+
+_POW10 = (1, 10, 100, 1000, 10000, 100000, 1000000, 10000000, 100000000, 1000000000)
+# two digits at a time
+_DIG_HI = bytes([48 + i // 10 for i in range(100)])
+_DIG_LO = bytes([48 + i % 10 for i in range(100)])
+
+# Writes x >= 0 at b[p], zero padded to width digits; returns the new end.
+# The viper version from imufast.py on the device.
+def _put_uint(b, p, x, width):
+	n = 1
+	while n < 10 and x >= _POW10[n]:
+		n += 1
+	while n < width:
+		b[p] = 48
+		p += 1
+		width -= 1
+	q = p + n
+	e = q
+	while x >= 100:
+		r = x % 100
+		x //= 100
+		q -= 2
+		b[q] = _DIG_HI[r]
+		b[q + 1] = _DIG_LO[r]
+	if x >= 10:
+		b[q - 2] = _DIG_HI[x]
+		b[q - 1] = _DIG_LO[x]
+	else:
+		b[q - 1] = 48 + x
+	return e
+
+try:
+	from imufast import put_uint
+except Exception:
+	put_uint = _put_uint
+
+# Writes x (an integer with dec decimals) with prec decimals.
+def put_fix(b, p, x, dec, prec):
+	if x < 0:
+		b[p] = 45 # '-'
+		p += 1
+		x = -x
+	if prec < dec:
+		d = _POW10[dec - prec]
+		x = (x + (d >> 1)) // d
+		dec = prec
+	if dec > 0:
+		d = _POW10[dec]
+		p = put_uint(b, p, x // d, 0)
+		b[p] = 46 # '.'
+		p = put_uint(b, p + 1, x % d, dec)
+	else:
+		p = put_uint(b, p, x, 0)
+		if prec > 0:
+			b[p] = 46
+			p += 1
+	while dec < prec:
+		b[p] = 48
+		p += 1
+		dec += 1
+	return p
+
+def put_byte(b, p, c):
+	b[p] = c
+	return p + 1
+
+def put_bytes(b, p, s):
+	for c in s:
+		b[p] = c
+		p += 1
+	return p
+
+# decimals of one field: prec is one value for all fields, a dict of
+# them per field name (default for the missing ones) or None
+def field_prec(prec, name, default):
+	if prec is None:
+		return default
+	if isinstance(prec, dict):
+		return prec.get(name, default)
+	return prec
+
+# (num, den) times 10**prec -> (ip, f1, f2, f3), see _SCALE_BITS
+def _compile_scale(num, den, prec):
+	n = num * _POW10[prec]
+	ip = n // den
+	r = n % den
+	f = [0, 0, 0]
+	for k in range(3):
+		r <<= _SCALE_BITS
+		f[k] = r // den
+		r %= den
+	if 2 * r >= den: # round the last one
+		f[2] += 1
+		for k in (2, 1):
+			if f[k] >> _SCALE_BITS:
+				f[k] = 0
+				f[k - 1] += 1
+		if f[0] >> _SCALE_BITS:
+			f[0] = 0
+			ip += 1
+	return ip, f[0], f[1], f[2]
+
+# widest rendering of one field, for any int32 value (ValueError if the
+# field cannot be rendered)
+def field_width(kind, arg, prec):
+	if prec < 0 or prec > VSFMT_PREC_MAX:
+		raise ValueError("vsfmt: precision {} out of 0..{}".format(prec, VSFMT_PREC_MAX))
+	if kind == VSFMT_INT:
+		return 1 + max(VSFMT_INT_DIGITS, arg)
+	if kind == VSFMT_FIX:
+		return 2 + VSFMT_INT_DIGITS + prec
+	if kind == VSFMT_SCALED:
+		# |value| * num / den, rounded, for |value| up to 2**31
+		return 2 + max(len(str(((1 << 31) * arg[0] * _POW10[prec]) // arg[1] + 1)), prec + 1)
+	if kind == VSFMT_TOD:
+		if prec > 3:
+			raise ValueError("vsfmt: time of day has at most 3 decimals")
+		return 8 + prec # hours up to 596 from an int32
+	if kind == VSFMT_CHAR:
+		return 1
+	raise ValueError("vsfmt: unknown field kind {}".format(kind))
+
+class LineFormat:
+	# extra: bytes the caller appends after render()
+	def __init__(self, tag, fields, t_prec=1, extra=0):
+		self.head = b'\t' + tag + b'\t'
+		self.t_prec = t_prec
+		self.fields = tuple(fields)
+		n = len(self.fields)
+		self.n = n
+		size = field_width(VSFMT_FIX, 0, t_prec) + len(self.head) + extra
+		for k in range(n):
+			kind, index, arg, prec = self.fields[k]
+			size += field_width(kind, arg, prec) + 1 # with the comma
+		self.buf = bytearray(size)
+		self.mv = memoryview(self.buf)
+		# compiled layout, one entry per field
+		self.kind = array('b', [0] * n)
+		self.index = array('b', [0] * n)
+		self.prec = array('b', [0] * n)
+		self.a = array('i', [0] * n)
+		self.f1 = array('i', [0] * n)
+		self.f2 = array('i', [0] * n)
+		self.f3 = array('i', [0] * n)
+		for k in range(n):
+			kind, index, arg, prec = self.fields[k]
+			self.kind[k] = kind
+			self.index[k] = index
+			self.prec[k] = prec
+			if kind == VSFMT_SCALED:
+				self.a[k], self.f1[k], self.f2[k], self.f3[k] = _compile_scale(arg[0], arg[1], prec)
+			elif kind == VSFMT_TOD:
+				self.a[k] = _POW10[3 - prec] # ms per last printed digit
+			else:
+				self.a[k] = arg
+		pass
+
+	# Renders t and the fields taken from v; returns the line length (the
+	# line is self.buf[0:length], or line(length)).
+	def render(self, t, v):
+		b = self.buf
+		p = put_fix(b, 0, t, 0, self.t_prec)
+		for c in self.head:
+			b[p] = c
+			p += 1
+		kind = self.kind
+		for k in range(self.n):
+			if k > 0:
+				b[p] = 44 # ','
+				p += 1
+			x = v[self.index[k]]
+			f = kind[k]
+			if f == VSFMT_SCALED:
+				if x < 0:
+					b[p] = 45
+					p += 1
+					x = -x
+				# floors all along: c is x * frac(m) in 2**-14, truncated
+				x3 = x * self.f3[k]
+				s = x * self.f2[k] + (x3 >> _SCALE_BITS)
+				c = x * self.f1[k] + (s >> _SCALE_BITS)
+				if (c & _SCALE_MASK) == _SCALE_HALF and (s & _SCALE_MASK) == 0 \
+					and (x3 & _SCALE_MASK) == 0:
+					c -= 1 # exact tie
+				x = x * self.a[k] + ((c + _SCALE_HALF) >> _SCALE_BITS)
+				p = put_fix(b, p, x, self.prec[k], self.prec[k])
+			elif f == VSFMT_FIX:
+				p = put_fix(b, p, x, self.a[k], self.prec[k])
+			elif f == VSFMT_INT:
+				if x < 0:
+					b[p] = 45
+					p += 1
+					x = -x
+				p = put_uint(b, p, x, self.a[k])
+			elif f == VSFMT_TOD:
+				p = put_uint(b, p, x // 3600000, 2)
+				p = put_uint(b, p, (x // 60000) % 60, 2)
+				p = put_uint(b, p, (x // 1000) % 60, 2)
+				if self.prec[k] > 0:
+					b[p] = 46
+					p = put_uint(b, p + 1, (x % 1000) // self.a[k], self.prec[k])
+			else:
+				b[p] = x
+				p += 1
+		return p
+
+	def line(self, n):
+		return self.mv[0:n]
+
+	# the line as a str (allocates: printing, tests)
+	def text(self, n):
+		return bytes(self.buf[0:n]).decode()
@@ -0,0 +1,302 @@
+# Compact binary telemetry frames for the Uarduino link.
+# Alternative to the text lines built by _print_on_repl: same information,
+# fixed-point payloads, a few times fewer bytes per sample.
+#
+# Frame layout (all multi-byte fields little endian):
+#   SYNC1 SYNC2 TYPE SEQ LEN PAYLOAD[LEN] CRC16
+# CRC16 is CCITT (poly 0x1021, init 0xFFFF) over TYPE..PAYLOAD.
+
+try:
+	from ustruct import pack_into, unpack_from, calcsize
+except ImportError:
+	from struct import pack_into, unpack_from, calcsize
+
+OUT_MODE_TEXT = 0
+OUT_MODE_BIN = 1
+
+PROTO_SYNC1 = 0xA5
+PROTO_SYNC2 = 0x5A
+PROTO_HEADER_LEN = 5
+PROTO_CRC_LEN = 2
+PROTO_MAX_PAYLOAD = 255
+
+PROTO_MSG_IMU = 0x01
+PROTO_MSG_GPS = 0x02
+PROTO_MSG_IMU_UTC = 0x03
+PROTO_MSG_ATT = 0x04
+PROTO_MSG_DELTA = 0x05
+PROTO_MSG_IMU_BATCH = 0x06
+PROTO_MSG_SYNC = 0x10
+PROTO_MSG_STATUS = 0x11
+
+# IMU: t [ms], ax ay az rx ry rz [LSB counts, offsets already removed]
+PROTO_FMT_IMU = '<I6h'
+# IMU with GPS time (timesync.py): t [ticks_us at the read, wraps at 2**30],
+# UTC [ms of day, 0xFFFFFFFF if unknown] + [us], sync state, ax .. rz as IMU
+PROTO_FMT_IMU_UTC = '<IIHB6h'
+# ATT (imudsp.py): t [ms], roll, pitch [urad]
+PROTO_FMT_ATT = '<Iii'
+# DELTA (txpolicy.py, link only): base type (| PROTO_DELTA_I8 when the
+# differences are int8, else int16; | PROTO_DELTA_T32 when those of the
+# leading PROTO_DELTA_TIME_FIELDS are int32 instead), u16 mask of the
+# fields present, then one difference per field present, against the
+# previous frame of the base type. Its SEQ follows the base type's;
+# variable length, so not in PROTO_FORMATS (see DeltaExpander).
+PROTO_DELTA_HEADER_LEN = 3
+PROTO_DELTA_I8 = 0x80
+PROTO_DELTA_T32 = 0x40
+PROTO_DELTA_FLAGS = PROTO_DELTA_I8 | PROTO_DELTA_T32
+# IMU_BATCH (txbatch.py, link only): t of the first sample [ms], n, then n
+# times PROTO_FMT_IMU_BATCH_SAMPLE: ms since the previous sample (0 for the
+# first), ax ay az rx ry rz as IMU. Variable length, see expand_batches().
+PROTO_FMT_IMU_BATCH = '<IB'
+PROTO_FMT_IMU_BATCH_SAMPLE = '<B6h'
+PROTO_IMU_BATCH_HEADER_LEN = 5
+PROTO_IMU_BATCH_SAMPLE_LEN = 13
+# GPS: t [ms], date [ddmmyy], time [ms of day], lat lon [1e-7 deg], alt [cm],
+# speed [0.01 kts], course [0.01 deg], hdop [0.01], sats
+PROTO_FMT_GPS = '<IIIiiiHHHB'
+# SYNC (SD log only): t [ms], sector index within the session, session id
+PROTO_FMT_SYNC = '<IIH'
+# STATUS (hotstat.py): t [ms], source, histogram bin width [us], calls,
+# exec mean/max [us], overruns, missed periods, jitter max [us],
+# lateness max [us], gc.mem_free low watermark [bytes], 8 histogram bins
+PROTO_FMT_STATUS = '<IBHIHHHHHHI8H'
+
+PROTO_FORMATS = dict({PROTO_MSG_IMU: PROTO_FMT_IMU, PROTO_MSG_GPS: PROTO_FMT_GPS, \
+	PROTO_MSG_IMU_UTC: PROTO_FMT_IMU_UTC, PROTO_MSG_ATT: PROTO_FMT_ATT, \
+	PROTO_MSG_SYNC: PROTO_FMT_SYNC, PROTO_MSG_STATUS: PROTO_FMT_STATUS})
+
+# payload field names, in PROTO_FMT_* order (used by the host tools)
+PROTO_FIELDS_IMU = ('t', 'ax', 'ay', 'az', 'rx', 'ry', 'rz')
+PROTO_FIELDS_IMU_UTC = ('t_us', 'utc_ms', 'utc_us', 'sync', 'ax', 'ay', 'az', 'rx', 'ry', 'rz')
+PROTO_FIELDS_ATT = ('t', 'roll', 'pitch')
+PROTO_FIELDS_GPS = ('t', 'date', 'time_ms', 'lat', 'lon', 'alt', 'speed', 'course', 'hdop', 'sats')
+PROTO_FIELDS_SYNC = ('t', 'sector', 'session')
+PROTO_FIELDS_STATUS = ('t', 'src', 'bin_us', 'calls', 'exec_mean', 'exec_max', 'overruns', \
+	'missed', 'jitter_max', 'late_max', 'mem_min', 'h0', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'h7')
+PROTO_FIELDS = dict({PROTO_MSG_IMU: PROTO_FIELDS_IMU, PROTO_MSG_GPS: PROTO_FIELDS_GPS, \
+	PROTO_MSG_IMU_UTC: PROTO_FIELDS_IMU_UTC, PROTO_MSG_ATT: PROTO_FIELDS_ATT, \
+	PROTO_MSG_SYNC: PROTO_FIELDS_SYNC, PROTO_MSG_STATUS: PROTO_FIELDS_STATUS})
+# leading fields carrying time: they change every sample
+PROTO_DELTA_TIME_FIELDS = dict({PROTO_MSG_IMU: 1, PROTO_MSG_IMU_UTC: 3, PROTO_MSG_GPS: 3, \
+	PROTO_MSG_ATT: 1})
+PROTO_NAMES = dict({PROTO_MSG_IMU: 'imu', PROTO_MSG_GPS: 'gps', PROTO_MSG_IMU_UTC: 'imu_utc', \
+	PROTO_MSG_ATT: 'att', PROTO_MSG_SYNC: 'sync', PROTO_MSG_STATUS: 'status'})
+
+PROTO_U16_INVALID = 0xFFFF
+PROTO_U8_INVALID = 0xFF
+
+def _make_crc_table():
+	tbl = []
+	for i in range(256):
+		crc = i << 8
+		for j in range(8):
+			if crc & 0x8000:
+				crc = ((crc << 1) ^ 0x1021) & 0xFFFF
+			else:
+				crc = (crc << 1) & 0xFFFF
+		tbl.append(crc)
+	return tbl
+
+try:
+	from array import array
+	_CRC_TABLE = array('H', _make_crc_table())
+except ImportError:
+	_CRC_TABLE = _make_crc_table()
+
+def crc16(buf, start, end, crc=0xFFFF):
+	tbl = _CRC_TABLE
+	for i in range(start, end):
+		crc = ((crc << 8) & 0xFFFF) ^ tbl[((crc >> 8) ^ buf[i]) & 0xFF]
+	return crc
+
+# Writes header and CRC of a frame whose plen-byte payload is already in
+# place at PROTO_HEADER_LEN (variable-length frames); returns its length.
+def frame_close(f, msg_type, seq, plen):
+	f[0] = PROTO_SYNC1
+	f[1] = PROTO_SYNC2
+	f[2] = msg_type
+	f[3] = seq
+	f[4] = plen
+	end = PROTO_HEADER_LEN + plen
+	crc = crc16(f, 2, end)
+	f[end] = crc & 0xFF
+	f[end + 1] = crc >> 8
+	return end + PROTO_CRC_LEN
+
+def clamp16(v):
+	if v > 32767:
+		return 32767
+	if v < -32768:
+		return -32768
+	return v
+
+# Holds one preallocated frame per message type; encode() packs the payload
+# in place and returns the frame ready to be sent.
+class FrameEncoder:
+	def __init__(self, msg_type, fmt=None):
+		if fmt is None:
+			fmt = PROTO_FORMATS[msg_type]
+		self.msg_type = msg_type
+		self.fmt = fmt
+		self.payload_len = calcsize(fmt)
+		self.seq = 0
+		self.frame = bytearray(PROTO_HEADER_LEN + self.payload_len + PROTO_CRC_LEN)
+		self.frame[0] = PROTO_SYNC1
+		self.frame[1] = PROTO_SYNC2
+		self.frame[2] = msg_type
+		self.frame[4] = self.payload_len
+		pass
+
+	def encode(self, *values):
+		pack_into(self.fmt, self.frame, PROTO_HEADER_LEN, *values)
+		return self.finalize()
+
+	# to be called after the payload has been written into self.frame
+	def finalize(self):
+		f = self.frame
+		f[3] = self.seq
+		self.seq = (self.seq + 1) & 0xFF
+		end = PROTO_HEADER_LEN + self.payload_len
+		crc = crc16(f, 2, end)
+		f[end] = crc & 0xFF
+		f[end + 1] = crc >> 8
+		return f
+
+# Streaming decoder, usable both on the host and on the device.
+# feed() accepts arbitrary chunks and returns a list of
+# (msg_type, seq, values) tuples for every valid frame found.
+class FrameDecoder:
+	def __init__(self, formats=PROTO_FORMATS):
+		self.formats = formats
+		self.buf = bytearray()
+		self.frames_ok = 0
+		self.crc_errors = 0
+		self.skipped_bytes = 0
+		self.seq_gaps = 0
+		self.last_seq = dict()
+		pass
+
+	def feed(self, data):
+		self.buf.extend(data)
+		buf = self.buf
+		out = []
+		pos = 0
+		n = len(buf)
+		while n - pos >= PROTO_HEADER_LEN:
+			if buf[pos] != PROTO_SYNC1 or buf[pos + 1] != PROTO_SYNC2:
+				pos += 1
+				self.skipped_bytes += 1
+				continue
+			plen = buf[pos + 4]
+			end = pos + PROTO_HEADER_LEN + plen
+			if end + PROTO_CRC_LEN > n:
+				break
+			crc = buf[end] | (buf[end + 1] << 8)
+			if crc != crc16(buf, pos + 2, end):
+				self.crc_errors += 1
+				pos += 1
+				continue
+			msg_type = buf[pos + 2]
+			seq = buf[pos + 3]
+			fmt = self.formats.get(msg_type)
+			if fmt is not None and calcsize(fmt) == plen:
+				values = unpack_from(fmt, buf, pos + PROTO_HEADER_LEN)
+			else:
+				values = bytes(buf[pos + PROTO_HEADER_LEN:end])
+			stream = msg_type
+			if msg_type == PROTO_MSG_DELTA and plen > 0:
+				stream = buf[pos + PROTO_HEADER_LEN] & ~PROTO_DELTA_FLAGS
+			last = self.last_seq.get(stream)
+			if last is not None and seq != ((last + 1) & 0xFF):
+				self.seq_gaps += 1
+			self.last_seq[stream] = seq
+			self.frames_ok += 1
+			out.append((msg_type, seq, values))
+			pos = end + PROTO_CRC_LEN
+		if pos:
+			self.buf = buf[pos:]
+		return out
+
+# Turns the DELTA frames in the output of FrameDecoder.feed() back into
+# frames of their base type, from the last values seen for it. After a
+# sequence gap the deltas are dropped until the next full frame.
+class DeltaExpander:
+	def __init__(self, formats=PROTO_FORMATS):
+		self.formats = formats
+		self.last = dict() # base type -> (seq, values)
+		self.expanded = 0
+		self.dropped = 0
+		pass
+
+	def expand(self, frames):
+		out = []
+		for msg_type, seq, values in frames:
+			if msg_type != PROTO_MSG_DELTA:
+				if msg_type in self.formats:
+					self.last[msg_type] = (seq, values)
+				out.append((msg_type, seq, values))
+				continue
+			if len(values) < PROTO_DELTA_HEADER_LEN:
+				self.dropped += 1
+				continue
+			base = values[0] & ~PROTO_DELTA_FLAGS
+			small = values[0] & PROTO_DELTA_I8
+			n_t32 = PROTO_DELTA_TIME_FIELDS.get(base, 0) if values[0] & PROTO_DELTA_T32 else 0
+			mask = values[1] | (values[2] << 8)
+			prev = self.last.get(base)
+			if prev is None or seq != ((prev[0] + 1) & 0xFF):
+				self.last.pop(base, None)
+				self.dropped += 1
+				continue
+			v = list(prev[1])
+			fmt = '<b' if small else '<h'
+			width = 1 if small else 2
+			p = PROTO_DELTA_HEADER_LEN
+			short = False
+			for i in range(len(v)):
+				if mask & (1 << i):
+					if i < n_t32:
+						if p + 4 > len(values):
+							short = True
+							break
+						v[i] += unpack_from('<i', values, p)[0]
+						p += 4
+						continue
+					if p + width > len(values):
+						short = True
+						break
+					v[i] += unpack_from(fmt, values, p)[0]
+					p += width
+			if short:
+				# half applied: the stream waits for the next keyframe
+				self.last.pop(base, None)
+				self.dropped += 1
+				continue
+			v = tuple(v)
+			self.last[base] = (seq, v)
+			self.expanded += 1
+			out.append((base, seq, v))
+		return out
+
+# Replaces the IMU_BATCH frames in the output of FrameDecoder.feed() by
+# the IMU frames they carry (with the SEQ of the batch).
+def expand_batches(frames):
+	out = []
+	for msg_type, seq, values in frames:
+		if msg_type != PROTO_MSG_IMU_BATCH:
+			out.append((msg_type, seq, values))
+			continue
+		if len(values) < PROTO_IMU_BATCH_HEADER_LEN:
+			continue
+		t, n = unpack_from(PROTO_FMT_IMU_BATCH, values, 0)
+		p = PROTO_IMU_BATCH_HEADER_LEN
+		for k in range(n):
+			if p + PROTO_IMU_BATCH_SAMPLE_LEN > len(values):
+				break
+			v = unpack_from(PROTO_FMT_IMU_BATCH_SAMPLE, values, p)
+			t = (t + v[0]) & 0xFFFFFFFF
+			out.append((PROTO_MSG_IMU, seq, (t,) + tuple(v[1:])))
+			p += PROTO_IMU_BATCH_SAMPLE_LEN
+	return out
@@ -1,6 +1,36 @@
 ampy -p /dev/ttyUSB0 rm main.py
 ampy -p /dev/ttyUSB0 rm gpsh.py
 ampy -p /dev/ttyUSB0 rm i2ch.py
+ampy -p /dev/ttyUSB0 rm vsproto.py
+ampy -p /dev/ttyUSB0 rm imufast.py
+ampy -p /dev/ttyUSB0 rm nmea.py
+ampy -p /dev/ttyUSB0 rm ubx.py
+ampy -p /dev/ttyUSB0 rm sdcard.py
+ampy -p /dev/ttyUSB0 rm sdlog.py
+ampy -p /dev/ttyUSB0 rm hotstat.py
+ampy -p /dev/ttyUSB0 rm vsasync.py
+ampy -p /dev/ttyUSB0 rm vsdual.py
+ampy -p /dev/ttyUSB0 rm timesync.py
+ampy -p /dev/ttyUSB0 rm imudsp.py
+ampy -p /dev/ttyUSB0 rm txpolicy.py
+ampy -p /dev/ttyUSB0 rm txbatch.py
+ampy -p /dev/ttyUSB0 rm gpsrec.py
+ampy -p /dev/ttyUSB0 rm vsfmt.py
 ampy -p /dev/ttyUSB0 put src/main.py
 ampy -p /dev/ttyUSB0 put src/gpsh.py
 ampy -p /dev/ttyUSB0 put src/i2ch.py
+ampy -p /dev/ttyUSB0 put src/vsproto.py
+ampy -p /dev/ttyUSB0 put src/imufast.py
+ampy -p /dev/ttyUSB0 put src/nmea.py
+ampy -p /dev/ttyUSB0 put src/ubx.py
+ampy -p /dev/ttyUSB0 put src/sdcard.py
+ampy -p /dev/ttyUSB0 put src/sdlog.py
+ampy -p /dev/ttyUSB0 put src/hotstat.py
+ampy -p /dev/ttyUSB0 put src/vsasync.py
+ampy -p /dev/ttyUSB0 put src/vsdual.py
+ampy -p /dev/ttyUSB0 put src/timesync.py
+ampy -p /dev/ttyUSB0 put src/imudsp.py
+ampy -p /dev/ttyUSB0 put src/txpolicy.py
+ampy -p /dev/ttyUSB0 put src/txbatch.py
+ampy -p /dev/ttyUSB0 put src/gpsrec.py
+ampy -p /dev/ttyUSB0 put src/vsfmt.py
\ No newline at end of file